@@ -7,20 +7,44 @@ SkyReels V2 Unlimited API Server
 import os
 import sys
 import gc
+import hashlib
 import logging
 import asyncio
+import math
+import base64
+import contextlib
+import heapq
+import importlib
+import itertools
+import json
+import multiprocessing
+import queue
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
 import uuid
-from typing import Dict, List, Optional, Any
+from collections import OrderedDict, deque
+from multiprocessing import shared_memory
+from concurrent.futures import Future, ThreadPoolExecutor, wait as wait_futures
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 from datetime import datetime, timedelta
 from pathlib import Path
+from email.utils import formatdate
+from urllib.parse import quote
 
+import numpy as np
 import torch
 import psutil
-from fastapi import FastAPI, HTTPException, BackgroundTasks, UploadFile, File
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 import uvicorn
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 # 启用无限制模式
 os.environ["SKYREELS_UNLIMITED_MODE"] = "true"
@@ -42,9 +66,10 @@ class MemoryOptimizer:
         """清理GPU和系统缓存"""
         if torch.cuda.is_available():
             for i in range(torch.cuda.device_count()):
-                torch.cuda.set_device(i)
-                torch.cuda.empty_cache()
-                torch.cuda.synchronize()
+                # 使用设备上下文，不改变调用线程的当前设备
+                with torch.cuda.device(i):
+                    torch.cuda.empty_cache()
+                    torch.cuda.synchronize()
         gc.collect()
         logger.info("Memory cache cleared")
     
@@ -56,7 +81,6 @@ class MemoryOptimizer:
         
         gpus = []
         for i in range(torch.cuda.device_count()):
-            torch.cuda.set_device(i)
             gpus.append({
                 "gpu_id": i,
                 "name": torch.cuda.get_device_name(i),
@@ -236,9 +260,3031 @@ class UnlimitedGPUDetector:
         
         return settings
 
-# 初始化检测器和优化器
+# GPU遥测后端
+class NVMLTelemetryBackend:
+    """通过NVML读取整卡显存和利用率，不创建CUDA上下文"""
+    name = "nvml"
+
+    def __init__(self):
+        import pynvml
+        pynvml.nvmlInit()
+        self._nvml = pynvml
+        self._handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(pynvml.nvmlDeviceGetCount())]
+        self._names = [self._decode(pynvml.nvmlDeviceGetName(h)) for h in self._handles]
+
+    @staticmethod
+    def _decode(value) -> str:
+        return value.decode() if isinstance(value, bytes) else value
+
+    def sample(self) -> List[Dict[str, Any]]:
+        gpus = []
+        for i, handle in enumerate(self._handles):
+            memory = self._nvml.nvmlDeviceGetMemoryInfo(handle)
+            utilization = self._nvml.nvmlDeviceGetUtilizationRates(handle)
+            gpus.append({
+                "gpu_id": i,
+                "name": self._names[i],
+                "allocated": memory.used / 1024**3,
+                "cached": memory.used / 1024**3,
+                "free": memory.free / 1024**3,
+                "total": memory.total / 1024**3,
+                "utilization": utilization.gpu
+            })
+        return gpus
+
+class TorchTelemetryBackend:
+    """NVML不可用时的回退，使用cudaMemGetInfo获取整卡空闲显存"""
+    name = "torch"
+
+    def __init__(self):
+        self._count = torch.cuda.device_count() if torch.cuda.is_available() else 0
+        self._props = [torch.cuda.get_device_properties(i) for i in range(self._count)]
+
+    def sample(self) -> List[Dict[str, Any]]:
+        gpus = []
+        for i in range(self._count):
+            free, total = torch.cuda.mem_get_info(i)
+            gpus.append({
+                "gpu_id": i,
+                "name": self._props[i].name,
+                "allocated": (total - free) / 1024**3,
+                "cached": torch.cuda.memory_reserved(i) / 1024**3,
+                "free": free / 1024**3,
+                "total": total / 1024**3,
+                "utilization": None
+            })
+        return gpus
+
+class FakeTelemetryBackend:
+    """测试用后端，返回固定的模拟GPU数据"""
+    name = "fake"
+
+    def __init__(self, gpu_count: int = 1, total_gb: float = 48.0, used_gb: float = 0.0):
+        self.gpu_count = gpu_count
+        self.total_gb = total_gb
+        self.used_gb = used_gb
+
+    def sample(self) -> List[Dict[str, Any]]:
+        return [{
+            "gpu_id": i,
+            "name": "Fake GPU",
+            "allocated": self.used_gb,
+            "cached": self.used_gb,
+            "free": self.total_gb - self.used_gb,
+            "total": self.total_gb,
+            "utilization": 0
+        } for i in range(self.gpu_count)]
+
+def create_telemetry_backend(name: str):
+    if name == "fake":
+        return FakeTelemetryBackend(gpu_count=int(os.getenv("SKYREELS_FAKE_GPU_COUNT", "1")))
+    if name in ("auto", "nvml"):
+        try:
+            return NVMLTelemetryBackend()
+        except Exception as e:
+            if name == "nvml":
+                raise
+            logger.info(f"NVML不可用，使用torch遥测后端: {e}")
+    return TorchTelemetryBackend()
+
+# GPU遥测采样器
+class GPUTelemetrySampler:
+    """后台线程定期采样GPU状态写入环形缓冲区，任务和接口只读缓存结果"""
+
+    def __init__(self, backend, interval: float = 2.0, history_size: int = 300):
+        self.backend = backend
+        self.interval = interval
+        self._history: deque = deque(maxlen=history_size)
+        self._latest: Dict[str, Any] = {"total_gpus": 0, "gpus": [], "total_memory": 0}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def sample_once(self):
+        try:
+            gpus = self.backend.sample()
+        except Exception as e:
+            logger.warning(f"GPU遥测采样失败: {e}")
+            return
+        timestamp = time.time()
+        self._latest = {
+            "total_gpus": len(gpus),
+            "gpus": gpus,
+            "total_memory": sum(gpu["total"] for gpu in gpus),
+            "sampled_at": datetime.fromtimestamp(timestamp).isoformat(),
+            "backend": self.backend.name
+        }
+        self._history.append((timestamp, [(gpu["allocated"], gpu.get("utilization")) for gpu in gpus]))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample_once()
+
+    def start(self):
+        self.sample_once()
+        self._thread = threading.Thread(target=self._run, name="gpu-telemetry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def latest(self) -> Dict[str, Any]:
+        return self._latest
+
+    def history(self, window_seconds: float = 300) -> List[Dict[str, Any]]:
+        """返回最近window_seconds内的采样（紧凑格式）"""
+        cutoff = time.time() - window_seconds
+        return [
+            {
+                "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
+                "allocated": [round(allocated, 3) for allocated, _ in gpus],
+                "utilization": [utilization for _, utilization in gpus]
+            }
+            for timestamp, gpus in list(self._history) if timestamp >= cutoff
+        ]
+
+# 任务队列已满
+class QueueFullError(Exception):
+    pass
+
+class TaskInterrupted(Exception):
+    """任务在去噪步或分段之间被取消（cancelled）或被更高优先级任务抢占（preempted）
+
+    抢占时checkpoint保存已完成分段和当前窗口的去噪状态，重新排队后从该处继续。
+    """
+
+    def __init__(self, reason: str, checkpoint: Optional[Dict[str, Any]] = None):
+        super().__init__(f"任务已{'取消' if reason == 'cancelled' else '被抢占'}")
+        self.reason = reason
+        self.checkpoint = checkpoint
+
+# GPU任务调度器
+class GPUJobScheduler:
+    """优先级队列 + 每GPU并发上限的任务调度器"""
+
+    def __init__(self, gpu_count: int, max_concurrent_per_gpu: int = 1, max_queue_size: int = 100,
+                 batch_key: Optional[Callable[[Any], Any]] = None,
+                 batch_limit: Optional[Callable[[Any, int], int]] = None,
+                 gpu_capacity: Optional[Callable[[int], int]] = None,
+                 admit: Optional[Callable[[Any, int, List[Any]], bool]] = None,
+                 preempt: Optional[Callable[[str], bool]] = None,
+                 admit_poll_seconds: Optional[float] = None):
+        self.gpu_count = max(gpu_count, 1)  # CPU模式下视为1个执行槽位组
+        self.max_concurrent_per_gpu = max(max_concurrent_per_gpu, 1)
+        # gpu_capacity(gpu_id) 返回该GPU当前允许的并发任务数（不超过max_concurrent_per_gpu）
+        self.gpu_capacity = gpu_capacity
+        # admit(payload, gpu_id, alongside) 返回任务现在能否与同批的alongside一起在该GPU上开始（如显存是否放得下），
+        # 队首任务不能开始时等待其他任务结束，合批的后续任务不能加入时留在队列
+        self.admit = admit
+        self.admit_poll_seconds = admit_poll_seconds  # 没有任务结束时也每隔该秒数重新检查准入，None表示只在通知时检查
+        # 队首任务在任何GPU上都无法开始时，preempt(task_id) 抢占一个优先级更低的执行中任务，返回是否成功发出
+        self.preempt = preempt
+        self._priorities: Dict[str, int] = {}
+        self._preempting: Set[str] = set()
+        self.max_queue_size = max_queue_size
+        # 出队时把batch_key相同的排队任务合并为一批，批大小由batch_limit(payload, gpu_id)决定
+        self.batch_key = batch_key
+        self.batch_limit = batch_limit
+        # 堆元素: [-priority, seq, task_id, payload]，取消时task_id置为None（惰性删除）
+        self._heap: List[list] = []
+        self._entries: Dict[str, list] = {}
+        self._counter = itertools.count()
+        self._condition = asyncio.Condition()
+        self._workers: List[asyncio.Task] = []
+        self.running: Dict[str, int] = {}  # task_id -> gpu_id
+        self.borrowed: Dict[str, List[int]] = {}  # 跨GPU执行的任务额外占用的GPU
+
+    @property
+    def max_concurrent(self) -> int:
+        return self.gpu_count * self.max_concurrent_per_gpu
+
+    async def submit(self, task_id: str, payload: Any, priority: int = 0, enforce_limit: bool = True) -> int:
+        """提交任务，返回排队位置（从1开始）"""
+        async with self._condition:
+            if enforce_limit and len(self._entries) >= self.max_queue_size:
+                raise QueueFullError(f"任务队列已满 ({self.max_queue_size})")
+            entry = [-priority, next(self._counter), task_id, payload]
+            heapq.heappush(self._heap, entry)
+            self._entries[task_id] = entry
+            self._priorities[task_id] = priority
+            self._condition.notify()
+            self._maybe_preempt()
+        return self.queue_position(task_id)
+
+    def _maybe_preempt(self):
+        """队首任务在任何GPU上都无法开始时，抢占优先级最低、最晚开始的执行中任务；同一时间只进行一次抢占"""
+        head = self._peek()
+        if self.preempt is None or head is None or self._preempting:
+            return
+        if any(self._can_start(gpu_id) for gpu_id in range(self.gpu_count)):
+            return
+        started = list(self.running)
+        victims = sorted((task_id for task_id in started if self._priorities.get(task_id, 0) < -head[0]),
+                         key=lambda task_id: (self._priorities.get(task_id, 0), -started.index(task_id)))
+        for task_id in victims:
+            if self.preempt(task_id):
+                self._preempting.add(task_id)
+                logger.info(f"⏸️  抢占任务 {task_id} (优先级 {self._priorities.get(task_id, 0)})，"
+                            f"让出GPU给任务 {head[2]} (优先级 {-head[0]})")
+                return
+
+    def cancel(self, task_id: str) -> bool:
+        """从队列中移除尚未开始的任务"""
+        entry = self._entries.pop(task_id, None)
+        if entry is None:
+            return False
+        entry[2] = None
+        self._priorities.pop(task_id, None)
+        return True
+
+    def queued(self) -> List[Tuple[str, Any]]:
+        """按出队顺序返回排队中的 (task_id, payload)"""
+        return [(entry[2], entry[3]) for entry in sorted(self._entries.values(), key=lambda entry: entry[:2])]
+
+    def queue_position(self, task_id: str) -> Optional[int]:
+        """任务在队列中的真实排名，不在队列中返回None"""
+        entry = self._entries.get(task_id)
+        if entry is None:
+            return None
+        key = entry[:2]
+        return 1 + sum(1 for other in self._entries.values() if other[:2] < key)
+
+    def _peek(self) -> Optional[list]:
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def _can_start(self, gpu_id: int) -> bool:
+        if not self._entries or self._running_on(gpu_id) >= self.capacity(gpu_id):
+            return False
+        return self.admit is None or self.admit(self._peek()[3], gpu_id, [])
+
+    def _pop(self):
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if entry[2] is not None:
+                del self._entries[entry[2]]
+                return entry[2], entry[3]
+        return None
+
+    def _pop_batch(self, gpu_id: int) -> List[Tuple[str, Any]]:
+        """取出队首任务，并按出队顺序合并可以同批执行、且与已合并任务一起通过准入的排队任务"""
+        batch = [self._pop()]
+        if self.batch_key is None:
+            return batch
+        key = self.batch_key(batch[0][1])
+        limit = self.batch_limit(batch[0][1], gpu_id) if self.batch_limit else 1
+        if key is None or limit <= 1:
+            return batch
+        
+        compatible = sorted((entry for entry in self._entries.values() if self.batch_key(entry[3]) == key),
+                            key=lambda entry: entry[:2])
+        for entry in compatible[:limit - 1]:
+            if self.admit is not None and not self.admit(entry[3], gpu_id, [payload for _, payload in batch]):
+                break
+            del self._entries[entry[2]]
+            batch.append((entry[2], entry[3]))
+            entry[2] = None  # 堆中的元素惰性删除
+        return batch
+
+    def capacity(self, gpu_id: int) -> int:
+        """该GPU同时执行的任务数上限（连续批处理的活跃槽位数）"""
+        if self.gpu_capacity is None:
+            return self.max_concurrent_per_gpu
+        return max(1, min(self.gpu_capacity(gpu_id), self.max_concurrent_per_gpu))
+
+    def _running_on(self, gpu_id: int) -> int:
+        return (sum(1 for running_gpu in self.running.values() if running_gpu == gpu_id)
+                + sum(1 for gpu_ids in self.borrowed.values() if gpu_id in gpu_ids))
+
+    def occupy(self, task_id: str, payload: Any, gpu_ids: List[int]) -> List[int]:
+        """执行中的任务额外占用其他GPU的执行槽位（多GPU流水线），只占用现在有空位且通过准入的GPU，返回占用到的GPU"""
+        taken = [gpu_id for gpu_id in gpu_ids
+                 if self._running_on(gpu_id) < self.capacity(gpu_id)
+                 and (self.admit is None or self.admit(payload, gpu_id, []))]
+        if taken:
+            self.borrowed[task_id] = taken
+        return taken
+
+    def vacate(self, task_id: str):
+        """释放occupy占用的GPU，工作协程在任务结束时统一唤醒"""
+        self.borrowed.pop(task_id, None)
+
+    async def _worker(self, gpu_id: int, handler):
+        while True:
+            async with self._condition:
+                while not self._can_start(gpu_id):
+                    try:
+                        # 准入取决于实时空闲显存时，其他进程释放显存不会通知调度器，需定期重新检查
+                        await asyncio.wait_for(self._condition.wait(), self.admit_poll_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+                batch = self._pop_batch(gpu_id)
+            for task_id, _ in batch:
+                self.running[task_id] = gpu_id
+            try:
+                await handler(batch, gpu_id)
+            except Exception as e:
+                logger.error(f"❌ 调度任务异常 (任务ID: {', '.join(task_id for task_id, _ in batch)}): {e}")
+            finally:
+                for task_id, _ in batch:
+                    self.running.pop(task_id, None)
+                    self._preempting.discard(task_id)
+                    if task_id not in self._entries:  # 被抢占的任务已重新排队
+                        self._priorities.pop(task_id, None)
+                async with self._condition:
+                    self._condition.notify_all()
+                    self._maybe_preempt()
+
+    def start(self, handler):
+        """为每个GPU启动max_concurrent_per_gpu个工作协程，handler(batch, gpu_id) 中batch为 [(task_id, payload)]"""
+        for gpu_id in range(self.gpu_count):
+            for _ in range(self.max_concurrent_per_gpu):
+                self._workers.append(asyncio.create_task(self._worker(gpu_id, handler)))
+        logger.info(f"🗂️  任务调度器已启动: {self.gpu_count} GPU x {self.max_concurrent_per_gpu} 并发, 队列上限 {self.max_queue_size}")
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        per_gpu = {gpu_id: self._running_on(gpu_id) for gpu_id in range(self.gpu_count)}
+        return {
+            "queued": len(self._entries),
+            "running": len(self.running),
+            "max_concurrent": self.max_concurrent,
+            "max_concurrent_per_gpu": self.max_concurrent_per_gpu,
+            "capacity": {gpu_id: self.capacity(gpu_id) for gpu_id in range(self.gpu_count)},
+            "max_queue_size": self.max_queue_size,
+            "per_gpu": per_gpu
+        }
+
+# 生成阶段（进度上报和日志使用的阶段名称）
+GENERATION_STAGES = {
+    "model_init": "初始化模型和参数",
+    "denoise": "生成视频关键帧",
+    "vae_decode": "插值和细节优化",
+    "audio": "音频生成和同步",
+    "render": "最终渲染",
+    "encode": "后处理和输出"
+}
+
+# 分辨率 -> (高, 宽)，对齐到16的倍数以满足VAE和patch尺寸要求
+RESOLUTION_SIZES = {
+    "480p": (480, 832),
+    "540p": (544, 960),
+    "720p": (720, 1280),
+    "1080p": (1088, 1920),
+    "4k": (2160, 3840)
+}
+
+def release_device_memory(device: str):
+    """释放指定设备的缓存显存（仅作用于当前进程持有的设备）"""
+    gc.collect()
+    if device.startswith("cuda") and torch.cuda.is_available():
+        with torch.cuda.device(device):
+            torch.cuda.empty_cache()
+
+# 模型权重索引与预热
+WEIGHT_FILE_PATTERNS = ("*.safetensors", "*.pth", "*.bin")
+
+def configured_models() -> Dict[str, str]:
+    """可用模型 {名称: 路径}，第一个为默认模型
+
+    SKYREELS_MODELS格式为 "df=/app/models/A,df540=/app/models/B"，
+    未配置时只有SKYREELS_MODEL_PATH对应的df模型。
+    """
+    spec = os.getenv("SKYREELS_MODELS", "")
+    if not spec:
+        return {"df": os.getenv("SKYREELS_MODEL_PATH", "/app/models/SkyReels-V2-DF-14B-720P")}
+    models = {}
+    for item in spec.split(","):
+        name, _, path = item.strip().partition("=")
+        if name and path:
+            models[name.strip()] = path.strip()
+    return models
+
+def read_safetensors_header(path: Path) -> Dict[str, Any]:
+    """只读取safetensors文件头（8字节长度 + JSON），不加载张量数据"""
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        return json.loads(f.read(header_size))
+
+def index_model_weights(model_path: Path) -> Dict[str, Any]:
+    """扫描模型目录下的权重文件，统计safetensors张量数和总字节数"""
+    files = sorted({p for pattern in WEIGHT_FILE_PATTERNS for p in model_path.rglob(pattern)})
+    tensors = 0
+    for path in files:
+        if path.suffix == ".safetensors":
+            tensors += sum(1 for key in read_safetensors_header(path) if key != "__metadata__")
+    return {"files": files, "tensors": tensors, "bytes": sum(p.stat().st_size for p in files)}
+
+def prefetch_files(paths: List[Path], on_progress: Optional[Callable[[float], None]] = None,
+                   workers: int = 4, chunk_size: int = 16 * 1024 * 1024):
+    """多线程顺序读取权重文件预热页缓存，之后的mmap加载直接命中内存
+
+    只预热页缓存，张量仍由之后的加载器读取；每读完一个文件按已完成的字节数报告一次进度。
+    """
+    total = sum(p.stat().st_size for p in paths) or 1
+    done = [0]
+    lock = threading.Lock()
+    
+    def warm(path: Path):
+        buffer = bytearray(chunk_size)
+        with open(path, "rb", buffering=0) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while f.readinto(buffer):
+                pass
+        with lock:
+            done[0] += path.stat().st_size
+            progress = done[0] / total
+        if on_progress:
+            on_progress(progress)
+    
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="weight-prefetch") as executor:
+        list(executor.map(warm, paths))
+
+# 权重文件加载通知：官方加载器没有进度接口，包装它按文件调用的加载函数，每个文件加载完成后通知监听者
+_weight_load_listeners: List[Callable[[Path], None]] = []
+_weight_load_lock = threading.Lock()
+_weight_load_hooked = False
+
+def _install_weight_load_hook():
+    """包装safetensors.torch.load_file和torch.load（diffusers的DiT分片与T5/VAE检查点走这两个函数），只在返回后通知，不改变加载行为"""
+    global _weight_load_hooked
+    import safetensors.torch
+    
+    def notify(path: Any):
+        if isinstance(path, (str, os.PathLike)):
+            for listener in list(_weight_load_listeners):
+                listener(Path(path))
+    
+    def wrap(load):
+        def loaded(f, *args, **kwargs):
+            result = load(f, *args, **kwargs)
+            notify(f)
+            return result
+        return loaded
+    
+    with _weight_load_lock:
+        if not _weight_load_hooked:
+            safetensors.torch.load_file = wrap(safetensors.torch.load_file)
+            torch.load = wrap(torch.load)
+            _weight_load_hooked = True
+
+@contextlib.contextmanager
+def weight_load_progress(paths: List[Path], on_progress: Callable[[float], None]):
+    """with块内paths中的权重文件每加载完成一个，按已加载的字节数回调一次进度（0~1）"""
+    _install_weight_load_hook()
+    sizes = {path.resolve(): path.stat().st_size for path in paths}
+    total = sum(sizes.values()) or 1
+    loaded: Set[Path] = set()
+    lock = threading.Lock()
+    
+    def listener(path: Path):
+        path = path.resolve()
+        with lock:
+            if path not in sizes or path in loaded:
+                return
+            loaded.add(path)
+            progress = sum(sizes[p] for p in loaded) / total
+        on_progress(progress)
+    
+    _weight_load_listeners.append(listener)
+    try:
+        yield
+    finally:
+        _weight_load_listeners.remove(listener)
+
+# 提示词嵌入缓存
+class PromptEmbeddingCache:
+    """文本编码结果缓存：内存LRU按字节数限制，可选的磁盘层在工作进程间共享
+
+    键为 (编码器标识, 归一化后的文本)，正向和负向提示词分别缓存。
+    磁盘层为safetensors文件，写入时先写临时文件再原子替换，读取时mmap加载。
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.on_lookup: Optional[Callable[[str], None]] = None
+        self.stats = {"memory_hit": 0, "disk_hit": 0, "miss": 0}
+        self._entries: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(encoder_id: str, text: str) -> str:
+        normalized = " ".join(text.split())
+        return hashlib.sha256(f"{encoder_id}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def _record(self, result: str):
+        self.stats[result] += 1
+        if self.on_lookup:
+            self.on_lookup(result)
+
+    def _remember(self, key: str, tensor: torch.Tensor):
+        size = tensor.numel() * tensor.element_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = tensor
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.numel() * evicted.element_size()
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        with self._lock:
+            tensor = self._entries.get(key)
+            if tensor is not None:
+                self._entries.move_to_end(key)
+        if tensor is not None:
+            self._record("memory_hit")
+            return tensor
+        
+        if self.disk_dir:
+            path = self.disk_dir / f"{key}.safetensors"
+            if path.exists():
+                try:
+                    from safetensors.torch import load_file
+                    tensor = load_file(str(path))["embedding"]
+                except Exception as e:
+                    logger.warning(f"⚠️  读取嵌入缓存失败 {path.name}: {e}")
+                else:
+                    self._remember(key, tensor)
+                    self._record("disk_hit")
+                    return tensor
+        
+        self._record("miss")
+        return None
+
+    def put(self, key: str, tensor: torch.Tensor):
+        tensor = tensor.detach().to("cpu").contiguous()
+        self._remember(key, tensor)
+        if self.disk_dir:
+            path = self.disk_dir / f"{key}.safetensors"
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                from safetensors.torch import save_file
+                save_file({"embedding": tensor}, str(tmp_path))
+                os.replace(tmp_path, path)
+            except Exception as e:
+                tmp_path.unlink(missing_ok=True)
+                logger.warning(f"⚠️  写入嵌入缓存失败: {e}")
+
+    def wrap(self, encode: Callable, encoder_id: str, device: str) -> Callable:
+        """包装编码函数：单条字符串且返回张量时走缓存，其他调用原样透传"""
+        def cached_encode(text, *args, **kwargs):
+            if not isinstance(text, str) or args or kwargs:
+                return encode(text, *args, **kwargs)
+            key = self.make_key(encoder_id, text)
+            tensor = self.get(key)
+            if tensor is not None:
+                return tensor.to(device, non_blocking=True)
+            result = encode(text)
+            if isinstance(result, torch.Tensor):
+                self.put(key, result)
+            return result
+        
+        return cached_encode
+
+_embedding_cache: Optional[PromptEmbeddingCache] = None
+
+def get_embedding_cache() -> PromptEmbeddingCache:
+    """进程内共享的嵌入缓存"""
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = PromptEmbeddingCache(
+            int(float(os.getenv("SKYREELS_EMBED_CACHE_MB", "512")) * 1024**2),
+            os.getenv("SKYREELS_EMBED_CACHE_DIR", "/app/cache/embeddings") or None
+        )
+    return _embedding_cache
+
+# 视频文件读写
+def get_ffmpeg_exe() -> str:
+    """优先使用系统ffmpeg，否则使用imageio-ffmpeg自带的二进制"""
+    exe = shutil.which("ffmpeg")
+    if exe:
+        return exe
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def write_video_segment(path: Path, frames: np.ndarray, fps: int, start_seconds: float = 0.0):
+    """将 (T, H, W, 3) uint8 帧编码为MPEG-TS分段，便于无重编码拼接
+
+    逐帧写入ffmpeg管道，不额外复制整段帧数据。时间戳从start_seconds（分段在整个视频中的起始时间）开始，
+    直播播放列表中相邻分段的时间戳连续，无需EXT-X-DISCONTINUITY；concat拼接按分段时长重新计算时间戳，不受影响。
+    """
+    _, height, width, _ = frames.shape
+    command = [
+        get_ffmpeg_exe(), "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+        "-c:v", "libx264", "-preset", "medium", "-crf", "18", "-pix_fmt", "yuv420p",
+        # 不按B帧延迟平移时间戳，否则首段（偏移为0）比后续分段多出2帧延迟，分段交界处时间戳不连续
+        "-output_ts_offset", f"{start_seconds:.6f}", "-avoid_negative_ts", "disabled", "-f", "mpegts", str(path)
+    ]
+    # stderr写入临时文件，避免编码期间管道写满阻塞ffmpeg
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=stderr)
+        try:
+            for frame in frames:
+                process.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            pass  # ffmpeg提前退出，错误信息见stderr
+        finally:
+            process.stdin.close()
+        if process.wait() != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"分段编码失败: {stderr.read().decode(errors='ignore').strip()}")
+
+class SegmentEncoder:
+    """后台编码线程：解码后的分段放入队列即返回，GPU继续生成下一段，编码与去噪重叠
+
+    每个提交方（owner，即任务ID）有自己的队列和编码线程，同一任务的分段按提交顺序编码，
+    一个任务编码慢不会让其他任务的分段排在它后面。submit从不阻塞，背压按任务计算：
+    某个任务待编码的分段积压到上限时只暂停这个任务（连续批处理跳过它的去噪步，同批其他任务照常推进）。
+    """
+
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self._changed = threading.Condition()
+        self._queues: Dict[str, deque] = {}  # owner -> 等待编码的分段，队列为空时编码线程退出
+        self._pending: Dict[str, int] = {}  # owner -> 已提交未完成的分段数（含正在编码的一段）
+
+    def submit(self, path: Path, frames: np.ndarray, fps: int,
+               on_done: Optional[Callable[[float], None]] = None, start_seconds: float = 0.0,
+               owner: str = "") -> Future:
+        """提交一个分段，编码成功后在编码线程中调用on_done(编码耗时秒)，之后Future才完成
+
+        编码完成前frames不能被修改。max_pending为0时在调用线程同步编码。
+        """
+        future: Future = Future()
+        if self.max_pending <= 0:
+            self._encode(path, frames, fps, on_done, future, start_seconds)
+            return future
+        with self._changed:
+            self._pending[owner] = self._pending.get(owner, 0) + 1
+            pending = self._queues.get(owner)
+            if pending is None:
+                pending = self._queues[owner] = deque()
+                threading.Thread(target=self._run, args=(owner, pending), name="segment-encoder", daemon=True).start()
+            pending.append((path, frames, fps, on_done, future, start_seconds))
+        return future
+
+    def saturated(self, owner: str) -> bool:
+        """owner除正在编码的一段外还有max_pending段在排队时返回True，此时应暂停该任务的生成"""
+        with self._changed:
+            return self._pending.get(owner, 0) > self.max_pending
+
+    def wait_ready(self, owners: List[str], timeout: Optional[float] = None) -> bool:
+        """等待owners中任意一个不再饱和，超时返回False"""
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: any(self._pending.get(owner, 0) <= self.max_pending for owner in owners), timeout)
+
+    def _run(self, owner: str, pending: deque):
+        while True:
+            with self._changed:
+                if not pending:
+                    del self._queues[owner]
+                    return
+                item = pending.popleft()
+            try:
+                self._encode(*item)
+            finally:
+                with self._changed:
+                    self._pending[owner] -= 1
+                    if not self._pending[owner]:
+                        del self._pending[owner]
+                    self._changed.notify_all()
+
+    def _encode(self, path: Path, frames: np.ndarray, fps: int, on_done, future: Future, start_seconds: float = 0.0):
+        try:
+            start = time.perf_counter()
+            write_video_segment(path, frames, fps, start_seconds)
+            if on_done is not None:
+                on_done(time.perf_counter() - start)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(path)
+
+_segment_encoder: Optional[SegmentEncoder] = None
+
+def get_segment_encoder() -> SegmentEncoder:
+    """进程内共享的分段编码线程，首次使用时创建"""
+    global _segment_encoder
+    if _segment_encoder is None:
+        _segment_encoder = SegmentEncoder(int(os.getenv("SKYREELS_ENCODE_QUEUE", "2")))
+    return _segment_encoder
+
+def concat_command(list_path: Path, output_path: str, audio_path: Optional[Path] = None,
+                   silent_audio: bool = False) -> List[str]:
+    """concat拼接的ffmpeg命令：视频流直接复制；有音轨文件时混流，silent_audio时由anullsrc生成静音音轨，不落盘"""
+    command = [
+        get_ffmpeg_exe(), "-y", "-loglevel", "error",
+        "-f", "concat", "-safe", "0", "-i", str(list_path)
+    ]
+    if audio_path is not None:
+        command += ["-i", str(audio_path)]
+    elif silent_audio:
+        command += ["-f", "lavfi", "-i", "anullsrc=channel_layout=stereo:sample_rate=48000"]
+    if audio_path is not None or silent_audio:
+        command += ["-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", "aac", "-b:a", "192k", "-shortest"]
+    else:
+        command += ["-c", "copy"]
+    return command + ["-movflags", "+faststart", output_path]
+
+def concat_video_segments(segment_paths: List[Path], output_path: str, audio_path: Optional[Path] = None,
+                          silent_audio: bool = False):
+    """使用concat demuxer无重编码拼接所有分段，有音轨时同一次调用混流（视频流直接复制，只编码音频）"""
+    list_path = segment_paths[0].parent / "segments.txt"
+    list_path.write_text("".join(f"file '{p.resolve()}'\n" for p in segment_paths))
+    command = concat_command(list_path, output_path, audio_path, silent_audio)
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"分段拼接失败: {result.stderr.strip()}")
+
+def stream_dir_for(task_id: str) -> Path:
+    """任务的HLS直播分段目录"""
+    return Path(f"/app/outputs/streams/{task_id}")
+
+def write_hls_playlist(stream_dir: Path, segments: List[Tuple[str, float]], ended: bool):
+    """原子地重写EVENT类型HLS播放列表，segments为 (文件名, 时长秒)"""
+    target_duration = max((math.ceil(duration) for _, duration in segments), default=1)
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:3",
+        f"#EXT-X-TARGETDURATION:{target_duration}",
+        "#EXT-X-MEDIA-SEQUENCE:0",
+        "#EXT-X-PLAYLIST-TYPE:EVENT"
+    ]
+    for name, duration in segments:
+        lines.append(f"#EXTINF:{duration:.3f},")
+        lines.append(name)
+    if ended:
+        lines.append("#EXT-X-ENDLIST")
+    
+    tmp_path = stream_dir / "playlist.m3u8.tmp"
+    tmp_path.write_text("\n".join(lines) + "\n")
+    os.replace(tmp_path, stream_dir / "playlist.m3u8")
+
+# 断点续传
+def checkpoint_dir_for(task_id: str) -> Path:
+    """任务的checkpoint目录"""
+    return Path(os.getenv("SKYREELS_CHECKPOINT_DIR", "/app/outputs/temp")) / task_id
+
+def write_checkpoint(task_id: str, checkpoint: Dict[str, Any]):
+    """写入checkpoint：条件帧存为.npy，窗口去噪状态用torch.save，文件名带版本号；
+    最后原子替换checkpoint.json作为提交点，再删除旧版本文件，任意时刻中断都能读到完整的上一版本"""
+    directory = checkpoint_dir_for(task_id)
+    directory.mkdir(parents=True, exist_ok=True)
+    version = f"{checkpoint['segment_index']:05d}_{time.time_ns()}"
+    meta = {key: checkpoint[key] for key in ("segment_index", "num_segments", "segment_paths", "playlist")}
+    meta.update(written_at=time.time(), condition=None, segment_state=None)
+    if checkpoint["condition"] is not None:
+        meta["condition"] = f"condition_{version}.npy"
+        np.save(directory / meta["condition"], np.asarray(checkpoint["condition"]), allow_pickle=False)
+    if checkpoint["segment_state"] is not None:
+        meta["segment_state"] = f"state_{version}.pt"
+        torch.save(checkpoint["segment_state"], directory / meta["segment_state"])
+    
+    tmp_path = directory / "checkpoint.json.tmp"
+    tmp_path.write_text(json.dumps(meta))
+    os.replace(tmp_path, directory / "checkpoint.json")
+    for path in directory.iterdir():
+        if path.name not in ("checkpoint.json", meta["condition"], meta["segment_state"]):
+            path.unlink(missing_ok=True)
+
+def read_checkpoint(task_id: str) -> Optional[Dict[str, Any]]:
+    """读取任务最近一次checkpoint，不存在或引用的分段文件缺失时返回None"""
+    directory = checkpoint_dir_for(task_id)
+    try:
+        meta = json.loads((directory / "checkpoint.json").read_text())
+    except FileNotFoundError:
+        return None
+    try:
+        if not all(Path(path).exists() for path in meta["segment_paths"]):
+            raise FileNotFoundError("已完成的分段文件缺失")
+        condition = np.load(directory / meta["condition"], allow_pickle=False) if meta["condition"] else None
+        segment_state = None
+        if meta["segment_state"]:
+            segment_state = torch.load(directory / meta["segment_state"], map_location="cpu", weights_only=True)
+    except Exception as e:
+        logger.warning(f"⚠️  任务 {task_id} 的checkpoint不可用，将从头开始: {e}")
+        return None
+    return dict(meta, condition=condition, segment_state=segment_state)
+
+def remove_checkpoint(task_id: str):
+    shutil.rmtree(checkpoint_dir_for(task_id), ignore_errors=True)
+
+def video_output_path(job: Dict[str, Any]) -> str:
+    timestamp = int(datetime.now().timestamp())
+    filename = f"skyreels_unlimited_{job['task_id']}_{timestamp}_{job['resolution']}_{job['duration']}s.mp4"
+    return f"/app/outputs/videos/{filename}"
+
+def plan_segments(total_frames: int, segment_frames: int, overlap_frames: int) -> List[Dict[str, int]]:
+    """把总帧数切分为固定窗口，第2段起每段以前一段末尾overlap_frames帧为条件
+
+    窗口必须大于重叠帧数，否则后续分段没有新帧可生成。
+    """
+    if overlap_frames < 0 or segment_frames <= overlap_frames:
+        raise ValueError(f"分段窗口帧数({segment_frames})必须大于重叠帧数({overlap_frames})")
+    segments = []
+    produced = 0
+    while produced < total_frames:
+        condition_frames = overlap_frames if segments else 0
+        new_frames = min(segment_frames - condition_frames, total_frames - produced)
+        segments.append({
+            "index": len(segments),
+            "start_frame": produced,
+            "condition_frames": condition_frames,
+            "num_frames": condition_frames + new_frames
+        })
+        produced += new_frames
+    return segments
+
+# 视频生成管线基类
+class VideoPipeline:
+    """在工作进程内加载一次并常驻的视频生成管线，按分段窗口生成"""
+    name = "base"
+
+    def load(self, device: str, on_progress: Optional[Callable[[float], None]] = None):
+        """加载到指定设备，on_progress(0~1) 上报加载进度"""
+        self.device = device
+
+    def generate_segment(self, job: Dict[str, Any], segment: Dict[str, int], condition: Any,
+                         step_callback) -> Tuple[np.ndarray, Any]:
+        """生成一个窗口，返回 (uint8帧 (T,H,W,3), 供下一段使用的重叠状态)
+
+        condition为上一段返回的重叠状态（首段为None），输出的前
+        segment["condition_frames"]帧与上一段重叠，由引擎丢弃。
+        step_callback(step, total_steps) 在每个去噪步后调用。
+        """
+        raise NotImplementedError
+
+    supports_batch = False  # 是否支持一次前向处理多个任务
+    supports_step_batching = False  # 是否实现begin_segment/step_batch/finish_segment逐步接口
+
+    def begin_segment(self, job: Dict[str, Any], segment: Dict[str, int], condition: Any) -> Dict[str, Any]:
+        """准备一个窗口的去噪状态（初始latent、该任务自己的timestep序列和随机种子），不执行去噪步
+
+        返回的状态字典至少包含 step（已完成步数）和 total_steps。
+        """
+        raise NotImplementedError
+
+    def step_batch(self, states: List[Dict[str, Any]]):
+        """每个状态各推进一个去噪步，各状态可处于不同的timestep，支持的管线在一次批量前向中完成"""
+        raise NotImplementedError
+
+    def finish_segment(self, state: Dict[str, Any]) -> Tuple[np.ndarray, Any]:
+        """解码已完成全部去噪步的窗口，返回值与generate_segment相同"""
+        raise NotImplementedError
+
+    def handoff_condition(self, state: Dict[str, Any]) -> Any:
+        """由尚未去噪完成的状态预测末尾重叠帧，供多GPU流水线提前开始下一段"""
+        raise NotImplementedError
+
+    def checkpoint_segment(self, state: Dict[str, Any]) -> Any:
+        """导出窗口的去噪状态（latent、已完成步数等，需可pickle），返回None表示只能从窗口开头恢复"""
+        return None
+
+    def restore_segment(self, job: Dict[str, Any], segment: Dict[str, int], condition: Any, data: Any) -> Dict[str, Any]:
+        """由checkpoint_segment的结果恢复去噪状态"""
+        return self.begin_segment(job, segment, condition)
+
+    def generate_batch(self, jobs: List[Dict[str, Any]], segment: Dict[str, int], conditions: List[Any],
+                       step_callback) -> Tuple[List[np.ndarray], List[Any]]:
+        """批量生成同一窗口（各任务分辨率、帧数、步数相同），默认逐个调用generate_segment"""
+        frames_list, next_conditions = [], []
+        for index, (job, condition) in enumerate(zip(jobs, conditions)):
+            def job_step_callback(step: int, total_steps: int, index: int = index):
+                step_callback(index * total_steps + step, total_steps * len(jobs))
+            
+            frames, next_condition = self.generate_segment(job, segment, condition, job_step_callback)
+            frames_list.append(frames)
+            next_conditions.append(next_condition)
+        return frames_list, next_conditions
+
+# CPU模拟管线
+class SimulatedVideoPipeline(VideoPipeline):
+    """不依赖模型权重的模拟管线，用于CPU测试和无模型环境"""
+    name = "simulated"
+
+    def __init__(self):
+        self.step_seconds = float(os.getenv("SKYREELS_SIMULATED_STEP_SECONDS", "0.01"))
+        height, width = os.getenv("SKYREELS_SIMULATED_FRAME_SIZE", "144x256").split("x")
+        self.frame_size = (int(height), int(width))
+
+    supports_batch = True
+    supports_step_batching = True
+
+    def begin_segment(self, job, segment, condition):
+        return {"job": job, "segment": segment, "condition": condition,
+                "step": 0, "total_steps": job["num_inference_steps"]}
+
+    def step_batch(self, states):
+        time.sleep(self.step_seconds)  # 一次（模拟的）批量前向，各状态的步数互不相关
+        for state in states:
+            state["step"] += 1
+
+    def finish_segment(self, state):
+        job = state["job"]
+        frames = self._render(job, state["segment"], state["condition"])
+        return frames, frames[-job["overlap_frames"]:].copy()
+
+    def handoff_condition(self, state):
+        # 模拟画面与去噪进度无关，预测值即最终值
+        return self.finish_segment(state)[1]
+
+    def checkpoint_segment(self, state):
+        return {"step": state["step"]}
+
+    def restore_segment(self, job, segment, condition, data):
+        return dict(self.begin_segment(job, segment, condition), step=data["step"])
+
+    def generate_segment(self, job, segment, condition, step_callback):
+        frames_list, conditions = self.generate_batch([job], segment, [condition], step_callback)
+        return frames_list[0], conditions[0]
+
+    def generate_batch(self, jobs, segment, conditions, step_callback):
+        # 一个批次每步只做一次（模拟的）批量前向
+        steps = jobs[0]["num_inference_steps"]
+        for step in range(steps):
+            time.sleep(self.step_seconds)  # 模拟去噪耗时
+            step_callback(step + 1, steps)
+        frames_list = [self._render(job, segment, condition) for job, condition in zip(jobs, conditions)]
+        return frames_list, [frames[-job["overlap_frames"]:].copy() for job, frames in zip(jobs, frames_list)]
+
+    def _render(self, job, segment, condition):
+        # 按全局帧号生成渐变画面，重叠帧与上一段完全一致
+        height, width = self.frame_size
+        first_frame = segment["start_frame"] - segment["condition_frames"]
+        frame_ids = np.arange(first_frame, first_frame + segment["num_frames"], dtype=np.int64)
+        shade = ((frame_ids * 3 + (job.get("seed") or 0)) % 256).astype(np.uint8)
+        frames = np.empty((len(frame_ids), height, width, 3), dtype=np.uint8)
+        frames[...] = shade[:, None, None, None]
+        frames[..., 1] = np.linspace(0, 255, width, dtype=np.uint8)[None, None, :]
+        if condition is not None:
+            frames[:segment["condition_frames"]] = condition
+        return frames
+
+# 分块VAE解码
+def wan_decode_stream(vae: Any) -> Optional[Callable[[torch.Tensor], Any]]:
+    """Wan VAE的逐latent帧解码生成器：与WanVAE_.decode的计算相同，因果特征缓存在帧之间保留，每帧的输出逐个交出
+
+    vae为官方封装（.vae或.model为WanVAE_，.scale为[均值, 1/标准差]），内部接口不匹配时返回None。
+    """
+    model = getattr(vae, "vae", None) or getattr(vae, "model", None)
+    scale = getattr(vae, "scale", None)
+    if model is None or scale is None or not all(hasattr(model, name) for name in ("clear_cache", "conv2", "decoder")):
+        return None
+    
+    def stream(latents: torch.Tensor):
+        mean, inv_std = scale
+        if isinstance(mean, torch.Tensor):
+            channels = latents.shape[1]
+            z = latents / inv_std.view(1, channels, 1, 1, 1) + mean.view(1, channels, 1, 1, 1)
+        else:
+            z = latents / inv_std + mean
+        model.clear_cache()
+        try:
+            x = model.conv2(z)
+            for i in range(z.shape[2]):
+                model._conv_idx = [0]
+                out = model.decoder(x[:, :, i:i + 1], feat_cache=model._feat_map, feat_idx=model._conv_idx)
+                yield out.float().clamp_(-1, 1)
+        finally:
+            model.clear_cache()
+    
+    return stream
+
+class TiledVAEDecoder:
+    """分块VAE解码：空间上按重叠tile解码并线性融合接缝，时间上分块，峰值显存不随分辨率和窗口长度增长
+
+    latent为 (B, C, T, H, W)，decode输出 (B, 3, scale_t*(T-1)+1, H*scale_s, W*scale_s)（Wan VAE的因果时间压缩）。
+    tile大小按解码时的显存预算选择，需要分块时结果在CPU上拼接。
+    提供stream（如wan_decode_stream）时，时间分块沿用VAE的因果缓存逐帧解码，每个tile与完整解码逐帧一致；
+    否则每个时间块前多解码overlap_frames个latent帧作为近似的因果上下文，结果丢弃，块边界附近与完整解码略有差异。
+    """
+
+    def __init__(self, decode: Callable[[torch.Tensor], torch.Tensor], bytes_per_voxel: float,
+                 spatial_scale: int = 8, temporal_scale: int = 4, overlap: int = 8, overlap_frames: int = 4,
+                 min_tile: int = 32, stream: Optional[Callable[[torch.Tensor], Any]] = None):
+        self.decode = decode
+        self.stream = stream
+        self.bytes_per_voxel = bytes_per_voxel  # 每个输出像素帧的解码峰值显存
+        self.spatial_scale = spatial_scale
+        self.temporal_scale = temporal_scale
+        self.overlap = overlap  # latent像素
+        self.overlap_frames = max(overlap_frames, 1)
+        self.min_tile = max(min_tile, 2 * overlap + 1)
+
+    def cost(self, batch: int, frames: int, height: int, width: int, context: bool = False) -> float:
+        """解码 frames×height×width 个latent的峰值显存估算（字节）"""
+        frames += self.overlap_frames if context and self.stream is None else 0
+        return (batch * (self.temporal_scale * (frames - 1) + 1) * height * width
+                * self.spatial_scale ** 2 * self.bytes_per_voxel)
+
+    def plan_tiles(self, shape: Tuple[int, ...], budget_bytes: Optional[float]) -> Tuple[int, int, int]:
+        """选择放得下预算的 (时间块, tile高, tile宽)：先缩小空间tile到下限，再缩短时间块"""
+        batch, _, frames, height, width = shape
+        tile_t, tile_h, tile_w = frames, height, width
+        if budget_bytes is None:
+            return tile_t, tile_h, tile_w
+        while self.cost(batch, tile_t, tile_h, tile_w, context=tile_t < frames) > budget_bytes:
+            if max(tile_h, tile_w) > self.min_tile:
+                if tile_h >= tile_w:
+                    tile_h = max(self.min_tile, math.ceil(tile_h / 2))
+                else:
+                    tile_w = max(self.min_tile, math.ceil(tile_w / 2))
+            elif tile_t > 1:
+                tile_t = math.ceil(tile_t / 2)
+            else:
+                break  # 最小tile仍超出预算，按最小tile尽力解码
+        return tile_t, min(tile_h, height), min(tile_w, width)
+
+    def __call__(self, latents, budget_bytes: Optional[float] = None):
+        """解码单个latent张量或latent列表（与VAE.decode的输入一致），(C, T, H, W) 视为批大小1"""
+        if isinstance(latents, (list, tuple)):
+            return [self(latent, budget_bytes) for latent in latents]
+        if latents.dim() == 4:
+            return self(latents.unsqueeze(0), budget_bytes).squeeze(0)
+        tile_t, tile_h, tile_w = self.plan_tiles(tuple(latents.shape), budget_bytes)
+        frames = latents.shape[2]
+        if tile_t >= frames:
+            return self._decode_spatial(latents, tile_h, tile_w, self.decode)
+        if self.stream is not None:
+            # 每个tile逐latent帧解码，因果缓存跨帧保留，已解码的帧立即移到CPU
+            return self._decode_spatial(latents, tile_h, tile_w, self._decode_streamed)
+        chunks = []
+        for start in range(0, frames, tile_t):
+            end = min(frames, start + tile_t)
+            context = max(0, start - self.overlap_frames)
+            video = self._decode_spatial(latents[:, :, context:end], tile_h, tile_w, self.decode)
+            if start > 0:
+                video = video[:, :, -(end - start) * self.temporal_scale:]
+            # 分块时已解码部分放在CPU，显存中只保留当前块
+            chunks.append(video.cpu())
+        return torch.cat(chunks, dim=2)
+
+    def _decode_streamed(self, latents: torch.Tensor) -> torch.Tensor:
+        return torch.cat([chunk.cpu() for chunk in self.stream(latents)], dim=2)
+
+    def _starts(self, length: int, tile: int) -> List[int]:
+        if tile >= length:
+            return [0]
+        return list(range(0, length - tile, tile - self.overlap)) + [length - tile]
+
+    def _ramp(self, start: int, size: int, length: int) -> torch.Tensor:
+        """tile在一个轴上的融合权重：与相邻tile重叠的边缘线性过渡，图像边界处为1
+
+        最外侧overlap/4受tile边界填充影响，权重为0，接缝处只取两侧tile都可靠的像素。
+        """
+        ramp_length = self.overlap * self.spatial_scale
+        margin = self.overlap // 4 * self.spatial_scale
+        weight = torch.ones(size * self.spatial_scale)
+        ramp = torch.zeros(ramp_length)
+        ramp[margin:] = (torch.arange(ramp_length - margin) + 0.5) / (ramp_length - margin)
+        if start > 0:
+            weight[:ramp_length] = ramp
+        if start + size < length:
+            weight[-ramp_length:] = torch.minimum(weight[-ramp_length:], ramp.flip(0))
+        return weight
+
+    def _decode_spatial(self, latents: torch.Tensor, tile_h: int, tile_w: int, decode: Callable) -> torch.Tensor:
+        height, width = latents.shape[-2:]
+        if tile_h >= height and tile_w >= width:
+            return decode(latents)
+        # 逐tile解码后移到CPU累加，显存中只保留一个tile
+        scale = self.spatial_scale
+        output = weights = None
+        for y in self._starts(height, tile_h):
+            for x in self._starts(width, tile_w):
+                decoded = decode(latents[..., y:y + tile_h, x:x + tile_w])
+                dtype, tile = decoded.dtype, decoded.float().cpu()
+                del decoded
+                if output is None:
+                    output = torch.zeros(*tile.shape[:3], height * scale, width * scale)
+                    weights = torch.zeros(height * scale, width * scale)
+                mask = self._ramp(y, tile_h, height)[:, None] * self._ramp(x, tile_w, width)[None, :]
+                region = (..., slice(y * scale, (y + tile_h) * scale), slice(x * scale, (x + tile_w) * scale))
+                output[region] += tile * mask
+                weights[region[1:]] += mask
+                del tile
+        return (output / weights).to(dtype)
+
+# SkyReels-V2 Diffusion Forcing管线
+class SkyReelsV2Pipeline(VideoPipeline):
+    """官方SkyReels-V2 DiffusionForcingPipeline的组件（DiT、T5文本编码器、Wan VAE）按去噪步驱动
+
+    复现官方管线同步模式（ar_step=0）的去噪循环：前缀重叠帧编码为latent后保持不变，按addnoise_condition加少量噪声，
+    其余latent帧共用一个FlowUniPC调度器。每个任务有自己的latent、timestep序列和随机数生成器，
+    step_batch把latent形状相同的任务（CFG时含无条件分支）拼成一次DiT前向，连续批处理和静态合批共用这一实现。
+    """
+    name = "skyreels"
+    supports_batch = True
+    supports_step_batching = True
+    latent_channels = 16  # Wan VAE的z_dim
+    vae_stride = (4, 8, 8)
+    addnoise_condition = 20  # 前缀latent的噪声强度（timestep），与官方extend_video的默认值一致
+
+    def __init__(self, model_path: Optional[str] = None):
+        self.model_path = model_path or os.getenv("SKYREELS_MODEL_PATH", "/app/models/SkyReels-V2-DF-14B-720P")
+        self.offload = os.getenv("SKYREELS_OFFLOAD", "false").lower() == "true"
+        self.negative_prompt = os.getenv("SKYREELS_NEGATIVE_PROMPT", "")
+        self.prefetch = os.getenv("SKYREELS_PREFETCH_WEIGHTS", "true").lower() == "true"
+        self.prefetch_workers = int(os.getenv("SKYREELS_PREFETCH_WORKERS", "4"))
+        self.headroom = float(os.getenv("SKYREELS_MEMORY_HEADROOM", "0.9"))
+        self.shift = float(os.getenv("SKYREELS_SHIFT", "8.0"))
+        self.weight_dtype = getattr(torch, os.getenv("SKYREELS_WEIGHT_DTYPE", "bfloat16"))
+        self.vae_tiling = False
+        self.scheduler_class = None
+
+    def load(self, device: str, on_progress: Optional[Callable[[float], None]] = None):
+        super().load(device)
+        model_path = Path(self.model_path)
+        if not model_path.exists():
+            raise FileNotFoundError(f"模型路径不存在: {self.model_path}")
+        
+        # 只解析文件头建立索引；内存放得下时并行预热页缓存，官方加载器mmap读取时不再等磁盘。
+        # 张量仍由官方构造函数一次性加载到设备（没有按张量懒加载的接口），这里只是预热
+        report = on_progress or (lambda progress: None)
+        weights = index_model_weights(model_path)
+        logger.info(f"📦 模型 {model_path.name}: {len(weights['files'])}个权重文件, "
+                    f"{weights['tensors']}个张量, {weights['bytes'] / 1024**3:.1f}GB")
+        prefetched = 0.0
+        if self.prefetch and weights["bytes"] < psutil.virtual_memory().available * 0.8:
+            prefetched = 0.4
+            prefetch_files(weights["files"], lambda p: report(p * prefetched), self.prefetch_workers)
+        
+        from skyreels_v2_infer import DiffusionForcingPipeline
+        from skyreels_v2_infer.scheduler.fm_solvers_unipc import FlowUniPCMultistepScheduler
+        
+        # 构造期间官方加载器每加载完一个分片报告一次进度
+        with weight_load_progress(weights["files"], lambda p: report(prefetched + (0.95 - prefetched) * p)):
+            self.pipe = DiffusionForcingPipeline(
+                self.model_path,
+                dit_path=self.model_path,
+                device=torch.device(device),
+                weight_dtype=self.weight_dtype,
+                use_usp=False,
+                offload=self.offload
+            )
+        self.scheduler_class = FlowUniPCMultistepScheduler
+        # 逐步接口要求DiT常驻显存，CPU卸载只作用于文本编码器和VAE
+        self.pipe.transformer.to(device)
+        # 同一提示词在各分段和重复提交之间复用文本编码结果，跳过T5编码器
+        if os.getenv("SKYREELS_EMBED_CACHE", "true").lower() == "true" and hasattr(self.pipe, "text_encoder"):
+            encoder = self.pipe.text_encoder
+            encoder.encode = get_embedding_cache().wrap(encoder.encode, f"{model_path.resolve()}:{type(encoder).__name__}", device)
+        # 执行方案要求分块解码时，VAE解码按当前空闲显存分tile进行
+        if hasattr(self.pipe, "vae"):
+            vae = self.pipe.vae
+            full_decode = vae.decode
+            # SKYREELS_VAE_MEMORY_GB为720p、97帧窗口的解码峰值，换算为每个输出像素帧的显存
+            tiled_decode = TiledVAEDecoder(
+                full_decode, float(os.getenv("SKYREELS_VAE_MEMORY_GB", "6")) * 1024**3 / (720 * 1280 * 97),
+                stream=wan_decode_stream(vae)
+            )
+            vae.decode = lambda latents, *args, **kwargs: (
+                tiled_decode(latents, self._vae_budget()) if self.vae_tiling else full_decode(latents, *args, **kwargs)
+            )
+        report(1.0)
+
+    @contextlib.contextmanager
+    def _resident(self, module: Any, offload: bool):
+        """CPU卸载方案下只在使用期间把文本编码器或VAE移到GPU"""
+        module = getattr(module, "vae", module)
+        if not offload or not isinstance(module, torch.nn.Module):
+            yield
+            return
+        module.to(self.device)
+        try:
+            yield
+        finally:
+            module.to("cpu")
+            release_device_memory(self.device)
+
+    def _encode_prompt(self, prompt: str, offload: bool) -> torch.Tensor:
+        with self._resident(self.pipe.text_encoder, offload):
+            embeds = self.pipe.text_encoder.encode(prompt)
+        return embeds.to(self.device, self.weight_dtype)
+
+    def _decode(self, latents: torch.Tensor, vae_tiling: bool, offload: bool) -> np.ndarray:
+        """latent (C, F, h, w) 解码为uint8帧 (T, H, W, 3)"""
+        self.vae_tiling = vae_tiling
+        with self._resident(self.pipe.vae, offload):
+            video = self.pipe.vae.decode([latents])[0]
+        video = (video.float() / 2 + 0.5).clamp(0, 1).mul(255)
+        return video.permute(1, 2, 3, 0).to(torch.uint8).cpu().numpy()
+
+    def begin_segment(self, job, segment, condition):
+        height, width = RESOLUTION_SIZES.get(job["resolution"], RESOLUTION_SIZES["720p"])
+        # Wan VAE时间压缩为4，窗口帧数需为4k+1，多出的帧在末尾裁掉
+        num_frames = (segment["num_frames"] - 1 + 3) // 4 * 4 + 1
+        stride_t, stride_h, stride_w = self.vae_stride
+        plan = EXECUTION_PLANS.get(job.get("execution_plan") or "full_gpu", {})
+        offload = self.offload or plan.get("offload", False)
+        steps = job["num_inference_steps"]
+        
+        generator = torch.Generator(device=self.device)
+        if job.get("seed") is not None:
+            generator.manual_seed(job["seed"] + segment["index"])
+        else:
+            generator.seed()
+        guidance = job["guidance_scale"]
+        with torch.no_grad():
+            context = self._encode_prompt(job["prompt"], offload)
+            negative = self._encode_prompt(self.negative_prompt, offload) if guidance > 1.0 else None
+            latents = torch.randn(
+                (self.latent_channels, (num_frames - 1) // stride_t + 1, height // stride_h, width // stride_w),
+                generator=generator, device=self.device, dtype=torch.float32
+            )
+            prefix = 0
+            if condition is not None:
+                # 以上一段的重叠帧作为前缀视频编码为latent，去噪过程中保持不变
+                video = torch.from_numpy(np.ascontiguousarray(condition)).to(self.device).permute(3, 0, 1, 2)
+                video = video.float() / 127.5 - 1.0
+                with self._resident(self.pipe.vae, offload):
+                    prefix_latents = self.pipe.vae.encode([video])[0].float()
+                prefix = prefix_latents.shape[1]
+                latents[:, :prefix] = prefix_latents
+        
+        scheduler = self.scheduler_class(num_train_timesteps=1000, shift=1, use_dynamic_shifting=False)
+        scheduler.set_timesteps(steps, device=self.device, shift=self.shift)
+        return {"job": job, "segment": segment, "step": 0, "total_steps": steps, "latents": latents,
+                "prefix": prefix, "x0": None, "context": context, "negative": negative, "guidance": guidance,
+                "fps": [0 if job["fps"] == 16 else 1], "scheduler": scheduler, "generator": generator,
+                "offload": offload, "vae_tiling": plan.get("vae_tiling", False)}
+
+    def step_batch(self, states):
+        groups: Dict[Tuple, List[Dict[str, Any]]] = {}
+        for state in states:
+            groups.setdefault((tuple(state["latents"].shape), tuple(state["context"].shape)), []).append(state)
+        with torch.no_grad(), torch.autocast(self.device.split(":")[0], dtype=self.weight_dtype,
+                                             enabled=self.device.startswith("cuda")):
+            for group in groups.values():
+                self._step_group(group)
+
+    def _step_group(self, states: List[Dict[str, Any]]):
+        """一组latent形状相同的任务做一次DiT前向，各任务按自己的timestep推进一步"""
+        inputs, timesteps, contexts, fps = [], [], [], []
+        for state in states:
+            timestep = state["scheduler"].timesteps[state["step"]]
+            latents, prefix = state["latents"], state["prefix"]
+            frame_timesteps = torch.full((latents.shape[1],), float(timestep), device=self.device)
+            model_input = latents
+            if prefix:
+                # 前缀latent加少量噪声并标记为对应的timestep，与官方extend_video一致
+                noise_factor = 0.001 * self.addnoise_condition
+                noise = torch.randn(latents[:, :prefix].shape, generator=state["generator"],
+                                    device=self.device, dtype=latents.dtype)
+                model_input = latents.clone()
+                model_input[:, :prefix] = latents[:, :prefix] * (1.0 - noise_factor) + noise * noise_factor
+                frame_timesteps[:prefix] = self.addnoise_condition
+            for context in ([state["context"], state["negative"]] if state["negative"] is not None else [state["context"]]):
+                inputs.append(model_input)
+                timesteps.append(frame_timesteps)
+                contexts.append(context)
+                fps.extend(state["fps"])
+        
+        predictions = self.pipe.transformer(torch.stack(inputs), t=torch.stack(timesteps),
+                                            context=torch.cat(contexts), fps=fps).float()
+        index = 0
+        for state in states:
+            prediction = predictions[index]
+            if state["negative"] is not None:
+                prediction = predictions[index + 1] + state["guidance"] * (prediction - predictions[index + 1])
+                index += 2
+            else:
+                index += 1
+            latents, prefix = state["latents"], state["prefix"]
+            timestep = state["scheduler"].timesteps[state["step"]]
+            sample = latents[:, prefix:]
+            # 流匹配 x_t = (1-σ)x0 + σε，模型预测 v = ε - x0，供多GPU流水线提前交接
+            state["x0"] = sample - float(timestep) / 1000 * prediction[:, prefix:]
+            # 多步调度器保留上一步的sample，这里拼出新张量而不是原地写回
+            stepped = state["scheduler"].step(prediction[:, prefix:], timestep, sample,
+                                              return_dict=False, generator=state["generator"])[0]
+            state["latents"] = torch.cat([latents[:, :prefix], stepped.to(latents.dtype)], dim=1)
+            state["step"] += 1
+
+    def finish_segment(self, state):
+        job, segment = state["job"], state["segment"]
+        with torch.no_grad():
+            frames = self._decode(state["latents"], state["vae_tiling"], state["offload"])[:segment["num_frames"]]
+        state.update(latents=None, x0=None, scheduler=None)
+        return frames, frames[-job["overlap_frames"]:].copy()
+
+    def handoff_condition(self, state):
+        # 用当前步预测的干净latent解码，末尾重叠帧作为下一段的条件
+        latents = state["latents"].clone()
+        if state["x0"] is not None:
+            latents[:, state["prefix"]:] = state["x0"]
+        with torch.no_grad():
+            frames = self._decode(latents, state["vae_tiling"], state["offload"])[:state["segment"]["num_frames"]]
+        return frames[-state["job"]["overlap_frames"]:].copy()
+
+    def checkpoint_segment(self, state):
+        # 只保存张量和基本类型，checkpoint以weights_only方式读取
+        scheduler = {key: value.cpu() if isinstance(value, torch.Tensor) else value
+                     for key, value in vars(state["scheduler"]).items() if self._plain(value)}
+        scheduler = {key: [item.cpu() if isinstance(item, torch.Tensor) else item for item in value]
+                     if isinstance(value, list) else value for key, value in scheduler.items()}
+        return {"step": state["step"], "latents": state["latents"].cpu(), "scheduler": scheduler,
+                "generator": state["generator"].get_state()}
+
+    def restore_segment(self, job, segment, condition, data):
+        state = self.begin_segment(job, segment, condition)
+        state["latents"] = data["latents"].to(self.device)
+        state["step"] = data["step"]
+        state["generator"].set_state(data["generator"])
+        scheduler = state["scheduler"]
+        for key, value in data["scheduler"].items():
+            if isinstance(value, torch.Tensor):
+                value = value.to(getattr(getattr(scheduler, key, None), "device", self.device))
+            elif isinstance(value, list):
+                value = [item.to(self.device) if isinstance(item, torch.Tensor) else item for item in value]
+            setattr(scheduler, key, value)
+        return state
+
+    @staticmethod
+    def _plain(value: Any) -> bool:
+        if value is None or isinstance(value, (bool, int, float, str, torch.Tensor)):
+            return True
+        return isinstance(value, list) and all(
+            item is None or isinstance(item, (bool, int, float, torch.Tensor)) for item in value)
+
+    def generate_segment(self, job, segment, condition, step_callback):
+        frames_list, conditions = self.generate_batch([job], segment, [condition], step_callback)
+        return frames_list[0], conditions[0]
+
+    def generate_batch(self, jobs, segment, conditions, step_callback):
+        states = [self.begin_segment(job, segment, condition) for job, condition in zip(jobs, conditions)]
+        steps = states[0]["total_steps"]
+        for step in range(steps):
+            self.step_batch(states)
+            step_callback(step + 1, steps)
+        results = [self.finish_segment(state) for state in states]
+        return [frames for frames, _ in results], [condition for _, condition in results]
+
+    def _vae_budget(self) -> Optional[float]:
+        """分块解码的显存预算：解码开始时的空闲显存（去噪激活已释放）"""
+        if not self.device.startswith("cuda"):
+            return None
+        free, _ = torch.cuda.mem_get_info(self.device)
+        return free * self.headroom
+
+# 分段长视频生成引擎
+class SegmentedGenerationEngine:
+    """Diffusion Forcing分段生成：逐段生成、编码落盘，只保留重叠状态，峰值内存与总时长无关
+
+    每个分段完成后追加到HLS播放列表，客户端可在生成过程中边生成边预览。
+    """
+
+    def __init__(self, pipeline: VideoPipeline):
+        self.pipeline = pipeline
+        self.segment_frames = int(os.getenv("SKYREELS_SEGMENT_FRAMES", "97"))
+        self.overlap_frames = int(os.getenv("SKYREELS_OVERLAP_FRAMES", "17"))
+        self.keep_stream = os.getenv("SKYREELS_KEEP_STREAM", "true").lower() == "true"
+        self.checkpoints = os.getenv("SKYREELS_CHECKPOINTS", "true").lower() == "true"
+        self.checkpoint_interval = float(os.getenv("SKYREELS_CHECKPOINT_INTERVAL", "300"))
+
+    def prepare(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        """初始化一个任务的分段计划、直播目录和已完成分段记录"""
+        job = dict(job, overlap_frames=self.overlap_frames)
+        stream_dir = stream_dir_for(job["task_id"])
+        stream_dir.mkdir(parents=True, exist_ok=True)
+        # 显存规划可能为任务选择了更小的窗口
+        segment_frames = job.get("segment_frames") or self.segment_frames
+        context = {
+            "job": job,
+            "segments": plan_segments(job["duration"] * job["fps"], segment_frames, self.overlap_frames),
+            "stream_dir": stream_dir,
+            "segment_paths": [],
+            "playlist": [],
+            "segment_index": 0,  # 下一个要生成的分段
+            "condition": None,
+            "encodes": []  # 已提交、尚未确认完成的分段编码
+        }
+        # 被抢占的任务从checkpoint继续：已完成的分段保留，从下一个分段开始
+        resume = job.get("resume")
+        if resume and resume["num_segments"] != len(context["segments"]):
+            logger.warning(f"⚠️  任务 {job['task_id']} 的分段配置已变化，忽略checkpoint从头开始")
+            resume = job["resume"] = None
+        if resume:
+            context.update(segment_index=resume["segment_index"], condition=resume["condition"],
+                           segment_paths=[Path(path) for path in resume["segment_paths"]],
+                           playlist=[tuple(item) for item in resume["playlist"]])
+        # 音轨与视频去噪并行生成，拼接时等待
+        context["audio"] = get_audio_stage().submit(job, stream_dir / "audio.wav") if job.get("enable_audio") else None
+        return context
+
+    def _checkpoint(self, context: Dict[str, Any], segment_index: int, condition: Any,
+                    segment_state: Any = None) -> Dict[str, Any]:
+        return {
+            "segment_index": segment_index,
+            "num_segments": len(context["segments"]),
+            "condition": condition,
+            "segment_paths": [str(path) for path in context["segment_paths"]],
+            "playlist": list(context["playlist"]),
+            "segment_state": segment_state
+        }
+
+    def checkpoint(self, context: Dict[str, Any], segment_state: Any = None) -> Optional[Dict[str, Any]]:
+        """当前进度的checkpoint：下一个分段序号、重叠条件帧、已完成分段，以及当前窗口的去噪状态
+
+        先等待已提交的分段编码完成；有分段编码失败时返回None，只能从头开始。
+        """
+        if self.flush(context) is not None:
+            return None
+        return self._checkpoint(context, context["segment_index"], context["condition"], segment_state)
+
+    def encoding(self, context: Dict[str, Any]) -> bool:
+        """任务是否还有分段在后台编码"""
+        return any(not future.done() for future in context["encodes"])
+
+    def flush(self, context: Dict[str, Any]) -> Optional[BaseException]:
+        """等待任务已提交的分段编码全部结束，返回第一个编码错误"""
+        encodes, context["encodes"] = context["encodes"], []
+        wait_futures(encodes)
+        return next((future.exception() for future in encodes if future.exception()), None)
+
+    def write_segment(self, context: Dict[str, Any], segment: Dict[str, int], frames: np.ndarray,
+                      condition: Any, observe=None) -> int:
+        """丢弃与上一段重叠的条件帧后交给编码线程，返回新增帧数
+
+        编码完成后按顺序加入直播播放列表并保存分段边界checkpoint，GPU不等待编码。
+        """
+        for future in context["encodes"]:
+            if future.done() and future.exception():
+                raise future.exception()
+        context["encodes"] = [future for future in context["encodes"] if not future.done()]
+        
+        fps = context["job"]["fps"]
+        segment_path = context["stream_dir"] / f"segment_{segment['index']:05d}.ts"
+        new_frames = segment["num_frames"] - segment["condition_frames"]
+        segment_index = segment["index"] + 1
+        
+        def published(seconds: float):
+            if observe:
+                observe("stage", seconds, "encode")
+            context["segment_paths"].append(segment_path)
+            context["playlist"].append((segment_path.name, new_frames / fps))
+            write_hls_playlist(context["stream_dir"], context["playlist"], ended=False)
+            if segment_index < len(context["segments"]):
+                self._save(context, self._checkpoint(context, segment_index, condition))
+        
+        context["encodes"].append(
+            get_segment_encoder().submit(segment_path, frames[segment["condition_frames"]:], fps, published,
+                                         segment["start_frame"] / fps, owner=context["job"]["task_id"])
+        )
+        context["segment_index"] = segment_index
+        context["condition"] = condition
+        return new_frames
+
+    def save_checkpoint(self, context: Dict[str, Any], segment_state: Any = None):
+        """持久化checkpoint，重启后从这里继续；写入失败不影响生成"""
+        if self.checkpoints:
+            self._save(context, self.checkpoint(context, segment_state))
+
+    def _save(self, context: Dict[str, Any], checkpoint: Optional[Dict[str, Any]]):
+        if not self.checkpoints or checkpoint is None:
+            return
+        try:
+            write_checkpoint(context["job"]["task_id"], checkpoint)
+        except Exception as e:
+            logger.warning(f"⚠️  保存checkpoint失败 ({context['job']['task_id']}): {e}")
+
+    def finalize(self, context: Dict[str, Any], report, observe) -> str:
+        """拼接全部分段为最终视频，返回输出路径"""
+        job = context["job"]
+        report(0.95, "encode")
+        encode_error = self.flush(context)
+        if encode_error is not None:
+            raise encode_error
+        
+        # 音轨通常已在去噪期间生成完毕，这里只计入剩余的等待时间；失败时输出无音轨的视频
+        audio_path = None
+        silent_audio = False
+        if context.get("audio") is not None:
+            report(0.96, "audio")
+            audio_start = time.perf_counter()
+            try:
+                audio_path = context["audio"].result()
+                silent_audio = audio_path is None
+            except Exception as e:
+                logger.warning(f"⚠️  音频生成失败，输出无音轨视频 ({job['task_id']}): {e}")
+            observe("stage", time.perf_counter() - audio_start, "audio")
+            report(0.97, "encode")
+        
+        output_path = video_output_path(job)
+        concat_start = time.perf_counter()
+        concat_video_segments(context["segment_paths"], output_path, audio_path, silent_audio)
+        observe("stage", time.perf_counter() - concat_start, "encode")
+        if audio_path is not None:
+            Path(audio_path).unlink(missing_ok=True)
+        if self.keep_stream:
+            write_hls_playlist(context["stream_dir"], context["playlist"], ended=True)
+        else:
+            shutil.rmtree(context["stream_dir"], ignore_errors=True)
+        
+        remove_checkpoint(job["task_id"])
+        return output_path
+
+    def run(self, job: Dict[str, Any], report, observe=None) -> str:
+        """执行分段生成并返回输出文件路径
+
+        report(progress, stage) 上报进度，observe(name, value, stage) 上报耗时指标。
+        """
+        return self.run_batch([job], [report], observe)[0]
+
+    def run_batch(self, jobs: List[Dict[str, Any]], reports: List[Callable[[float, str], None]],
+                  observe=None) -> List[str]:
+        """批量执行分辨率、帧数、步数相同的任务，每个窗口一次批量生成，返回各任务输出路径"""
+        observe = observe or (lambda name, value, stage=None: None)
+        if len(jobs) > 1 and any(job.get("resume") for job in jobs):
+            # 从checkpoint恢复的任务起始分段不同，逐个执行
+            return [self.run_batch([job], [report], observe)[0] for job, report in zip(jobs, reports)]
+        contexts = [self.prepare(job) for job in jobs]
+        self.contexts = contexts  # 中断时由调用方生成checkpoint
+        jobs = [context["job"] for context in contexts]
+        
+        def report_all(progress: float, stage: str):
+            for report in reports:
+                report(progress, stage)
+        
+        report_all(0.0, "model_init")
+        observe("batch_size", len(jobs))
+        
+        try:
+            self._generate_segments(jobs, contexts, report_all, observe)
+        except BaseException:
+            # 失败或中断时等待已提交的编码结束，任务结束后不再有写入
+            for context in contexts:
+                self.flush(context)
+            raise
+        return [self.finalize(context, report, observe) for context, report in zip(contexts, reports)]
+
+    def _generate_segments(self, jobs: List[Dict[str, Any]], contexts: List[Dict[str, Any]], report_all, observe):
+        segments = contexts[0]["segments"]
+        conditions: List[Any] = [context["condition"] for context in contexts]
+        for segment in segments[contexts[0]["segment_index"]:]:
+            segment_start = time.perf_counter()
+            last_step = [segment_start]
+            
+            def step_callback(step: int, total_steps: int, index: int = segment["index"]):
+                now = time.perf_counter()
+                observe("denoise_step", now - last_step[0])
+                last_step[0] = now
+                report_all((index + step / total_steps * 0.9) / len(segments) * 0.95, "denoise")
+            
+            frames_list, conditions = self.pipeline.generate_batch(jobs, segment, conditions, step_callback)
+            # 最后一个去噪步之后到返回之间为VAE解码
+            decoded_at = time.perf_counter()
+            observe("stage", last_step[0] - segment_start, "denoise")
+            observe("stage", decoded_at - last_step[0], "vae_decode")
+            report_all((segment["index"] + 0.9) / len(segments) * 0.95, "encode")
+            
+            for context, frames, condition in zip(contexts, frames_list, conditions):
+                new_frames = self.write_segment(context, segment, frames, condition, observe)
+            # 同步生成时整批在这里等待编码积压降到上限以下
+            for context in contexts:
+                get_segment_encoder().wait_ready([context["job"]["task_id"]])
+            observe("frames", new_frames * len(jobs))
+            observe("segment_fps", new_frames * len(jobs) / (time.perf_counter() - segment_start))
+            del frames_list
+
+# 连续批处理会话
+class GenerationSession:
+    """连续批处理中的单个任务：逐窗口推进，去噪步由工作进程在所有活跃任务之间统一调度
+
+    任务可以在任意两步之间加入或离开活跃批次，每个任务保持自己的timestep和随机种子。
+    """
+
+    def __init__(self, engine: SegmentedGenerationEngine, model: str, job: Dict[str, Any], report, observe):
+        self.engine = engine
+        self.pipeline = engine.pipeline
+        self.model = model
+        self.task_id = job["task_id"]
+        self.report = report
+        self.observe = observe
+        self.context = engine.prepare(job)
+        self.result: Optional[str] = None
+        self.segment_start = time.perf_counter()
+        self.checkpointed_at = time.monotonic()
+        resume = self.context["job"].get("resume")
+        if resume and resume["segment_state"] is not None:
+            self.state = self.pipeline.restore_segment(self.context["job"], self.segment, self.context["condition"],
+                                                       resume["segment_state"])
+        else:
+            self._begin_segment()
+
+    @property
+    def segment(self) -> Dict[str, int]:
+        return self.context["segments"][self.context["segment_index"]]
+
+    def checkpoint(self) -> Dict[str, Any]:
+        """在两个去噪步之间导出checkpoint，重新开始时从当前窗口的当前步继续"""
+        return self.engine.checkpoint(self.context, self.pipeline.checkpoint_segment(self.state))
+
+    def result_message(self) -> Dict[str, Any]:
+        return {"type": "result", "task_id": self.task_id, "result_path": self.result}
+
+    def error_message(self, error: Exception) -> Dict[str, Any]:
+        self.close()
+        return {"type": "error", "task_id": self.task_id, "error": str(error)}
+
+    def close(self):
+        """离开活跃批次前等待已提交的分段编码结束"""
+        self.state = None
+        self.engine.flush(self.context)
+
+    def _begin_segment(self):
+        self.segment_start = time.perf_counter()
+        self.state = self.pipeline.begin_segment(self.context["job"], self.segment, self.context["condition"])
+
+    def after_step(self) -> bool:
+        """每个去噪步之后调用：窗口完成时解码落盘并开始下一个窗口，整个任务完成时返回True"""
+        segments = self.context["segments"]
+        index = self.context["segment_index"]
+        step, total_steps = self.state["step"], self.state["total_steps"]
+        self.report((index + step / total_steps * 0.9) / len(segments) * 0.95, "denoise")
+        if step < total_steps:
+            # 窗口较长时定期保存窗口内的去噪状态；checkpoint要求之前的分段已发布，
+            # 有分段仍在编码时推迟到之后的步，不在这里等待编码线程而拖慢同批的其他任务
+            if (time.monotonic() - self.checkpointed_at >= self.engine.checkpoint_interval
+                    and not self.engine.encoding(self.context)):
+                self.engine.save_checkpoint(self.context, self.pipeline.checkpoint_segment(self.state))
+                self.checkpointed_at = time.monotonic()
+            return False
+        
+        denoised_at = time.perf_counter()
+        frames, condition = self.pipeline.finish_segment(self.state)
+        decoded_at = time.perf_counter()
+        self.observe("stage", denoised_at - self.segment_start, "denoise")
+        self.observe("stage", decoded_at - denoised_at, "vae_decode")
+        self.report((index + 0.9) / len(segments) * 0.95, "encode")
+        new_frames = self.engine.write_segment(self.context, self.segment, frames, condition, self.observe)
+        self.observe("frames", new_frames)
+        self.observe("segment_fps", new_frames / (time.perf_counter() - self.segment_start))
+        del frames
+        
+        if self.context["segment_index"] < len(segments):
+            self.checkpointed_at = time.monotonic()
+            self._begin_segment()
+            return False
+        self.state = None
+        self.result = self.engine.finalize(self.context, self.report, self.observe)
+        return True
+
+def encode_pipeline_segment(task_id: str, segment: Dict[str, int], frames: np.ndarray, fps: int,
+                            send, observe) -> int:
+    """多GPU流水线的分段交给编码线程，编码完成后才通知协调方，返回新增帧数
+
+    分段文件由协调方按顺序加入播放列表和最终拼接。
+    """
+    segment_path = stream_dir_for(task_id) / f"segment_{segment['index']:05d}.ts"
+    new_frames = segment["num_frames"] - segment["condition_frames"]
+    
+    def published(seconds: float):
+        observe("stage", seconds, "encode")
+        send({"type": "segment_done", "task_id": task_id, "index": segment["index"], "path": str(segment_path),
+              "frames": new_frames})
+    
+    def failed(future: Future):
+        if future.exception() is not None:
+            send({"type": "segment_error", "task_id": task_id, "index": segment["index"],
+                  "error": str(future.exception())})
+    
+    get_segment_encoder().submit(segment_path, frames[segment["condition_frames"]:], fps, published,
+                                 segment["start_frame"] / fps, owner=task_id).add_done_callback(failed)
+    return new_frames
+
+class SegmentSession:
+    """多GPU流水线中的单个分段：到达交接步时把预测的重叠帧交给下一段，完成后交给编码线程
+
+    与GenerationSession接口相同，可以和普通任务一起参与连续批处理。
+    """
+
+    def __init__(self, pipeline: VideoPipeline, model: str, message: Dict[str, Any], send, observe):
+        self.pipeline = pipeline
+        self.model = model
+        self.task_id = message["task_id"]
+        self.job = message["job"]
+        self.segment = message["segment"]
+        self.is_last = message["is_last"]
+        self.handoff_step = message["handoff_step"]
+        self.send = send
+        self.observe = observe
+        self.handed_off = self.is_last  # 最后一段没有下一段可交接
+        self.segment_start = time.perf_counter()
+        self.state = pipeline.begin_segment(self.job, self.segment, message["condition"])
+
+    def _handoff(self, condition: Any):
+        self.send({"type": "handoff", "task_id": self.task_id, "index": self.segment["index"], "condition": condition})
+        self.handed_off = True
+
+    def after_step(self) -> bool:
+        step, total_steps = self.state["step"], self.state["total_steps"]
+        self.send({"type": "segment_progress", "task_id": self.task_id, "index": self.segment["index"],
+                   "step": step, "total_steps": total_steps})
+        if not self.handed_off and self.handoff_step <= step < total_steps:
+            self._handoff(self.pipeline.handoff_condition(self.state))
+        if step < total_steps:
+            return False
+        
+        denoised_at = time.perf_counter()
+        frames, condition = self.pipeline.finish_segment(self.state)
+        decoded_at = time.perf_counter()
+        if not self.handed_off:
+            self._handoff(condition)
+        self.observe("stage", denoised_at - self.segment_start, "denoise")
+        self.observe("stage", decoded_at - denoised_at, "vae_decode")
+        
+        new_frames = encode_pipeline_segment(self.task_id, self.segment, frames, self.job["fps"], self.send, self.observe)
+        self.observe("frames", new_frames)
+        self.observe("segment_fps", new_frames / (time.perf_counter() - self.segment_start))
+        self.state = None
+        return True
+
+    def result_message(self) -> Optional[Dict[str, Any]]:
+        return None  # segment_done由编码线程在分段编码完成后发送
+
+    def close(self):
+        self.state = None
+
+    def error_message(self, error: Exception) -> Dict[str, Any]:
+        return {"type": "segment_error", "task_id": self.task_id, "index": self.segment["index"], "error": str(error)}
+
+def load_pipeline(name: str, device: str, model_path: Optional[str] = None,
+                  on_progress: Optional[Callable[[float], None]] = None) -> VideoPipeline:
+    """按名称加载管线，auto模式下真实模型不可用时回退到模拟管线"""
+    if name in ("auto", "skyreels"):
+        try:
+            pipeline = SkyReelsV2Pipeline(model_path)
+            pipeline.load(device, on_progress)
+            return pipeline
+        except Exception as e:
+            if name == "skyreels":
+                raise
+            logger.warning(f"⚠️  SkyReels-V2管线不可用，回退到模拟管线: {e}")
+    
+    pipeline = SimulatedVideoPipeline()
+    pipeline.load(device, on_progress)
+    return pipeline
+
+# 音频生成插件
+class AudioPipeline:
+    """音频生成插件接口：任务开始时在CPU或次要设备上与视频去噪并行运行，最终拼接时混流进MP4
+
+    自定义插件继承此类实现generate，通过 SKYREELS_AUDIO_PIPELINE=模块路径:类名 加载。
+    """
+    name = "base"
+
+    def load(self, device: str):
+        self.device = device
+
+    def generate(self, job: Dict[str, Any], duration: float, output_path: Path) -> Optional[Path]:
+        """为任务生成duration秒的音轨写入output_path（ffmpeg可读的任意格式），返回实际输出路径
+
+        返回None表示静音，拼接时由ffmpeg生成静音音轨。
+        """
+        raise NotImplementedError
+
+class SilentAudioPipeline(AudioPipeline):
+    """静音音轨，未配置音频模型时使用，保证enable_audio的输出始终带音频流
+
+    不写音频文件（2小时的立体声PCM约1.4GB），拼接时由ffmpeg的anullsrc直接生成静音流。
+    """
+    name = "silent"
+
+    def generate(self, job, duration, output_path):
+        return None
+
+def load_audio_pipeline(name: str, device: str) -> AudioPipeline:
+    """按名称加载音频插件：silent或 模块路径:类名"""
+    if name == "silent":
+        pipeline = SilentAudioPipeline()
+    else:
+        module_name, _, class_name = name.partition(":")
+        pipeline = getattr(importlib.import_module(module_name), class_name)()
+    pipeline.load(device)
+    return pipeline
+
+class AudioStage:
+    """后台音频生成：任务开始时提交，与视频去噪并行，拼接时等待结果；插件在首个任务时加载"""
+
+    def __init__(self, pipeline_name: str, device: str):
+        self.pipeline_name = pipeline_name
+        self.device = device
+        self._pipeline: Optional[AudioPipeline] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio")
+
+    def submit(self, job: Dict[str, Any], output_path: Path) -> Future:
+        return self._executor.submit(self._generate, job, output_path)
+
+    def _generate(self, job: Dict[str, Any], output_path: Path) -> Path:
+        if self._pipeline is None:
+            self._pipeline = load_audio_pipeline(self.pipeline_name, self.device)
+            logger.info(f"🎵 音频插件已加载: {self._pipeline.name} ({self.device})")
+        return self._pipeline.generate(job, float(job["duration"]), output_path)
+
+_audio_stage: Optional[AudioStage] = None
+
+def get_audio_stage() -> AudioStage:
+    """进程内共享的音频生成线程，首次使用时创建"""
+    global _audio_stage
+    if _audio_stage is None:
+        _audio_stage = AudioStage(os.getenv("SKYREELS_AUDIO_PIPELINE", "silent"),
+                                  os.getenv("SKYREELS_AUDIO_DEVICE", "cpu"))
+    return _audio_stage
+
+class ModelRegistry:
+    """工作进程内的模型注册表：首次使用（或预加载）时才加载，按LRU保留max_warm个常驻模型"""
+
+    def __init__(self, pipeline_name: str, device: str, model_paths: Dict[str, str], max_warm: int = 1,
+                 on_event: Optional[Callable[..., None]] = None):
+        self.pipeline_name = pipeline_name
+        self.device = device
+        self.model_paths = model_paths
+        self.max_warm = max(1, max_warm)
+        self.on_event = on_event or (lambda model, state, progress, **info: None)
+        self._warm: "OrderedDict[str, VideoPipeline]" = OrderedDict()
+        self._loading: Dict[str, threading.Event] = {}
+        self._errors: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def preload(self, names: List[str]) -> threading.Thread:
+        """后台线程预加载，期间到达的任务在get()中等待加载完成"""
+        def run():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    logger.error(f"❌ 预加载模型失败 {name}: {e}")
+        
+        thread = threading.Thread(target=run, name="model-preload", daemon=True)
+        thread.start()
+        return thread
+
+    def get(self, name: str) -> VideoPipeline:
+        """返回已加载的管线，未加载时在当前线程加载（同一模型只加载一次）"""
+        with self._lock:
+            if name in self._warm:
+                self._warm.move_to_end(name)
+                return self._warm[name]
+            event = self._loading.get(name)
+            owner = event is None
+            if owner:
+                event = self._loading[name] = threading.Event()
+        
+        if not owner:
+            event.wait()
+            with self._lock:
+                if name in self._warm:
+                    self._warm.move_to_end(name)
+                    return self._warm[name]
+            raise RuntimeError(f"模型加载失败 {name}: {self._errors.get(name)}")
+        
+        try:
+            return self._load(name)
+        finally:
+            with self._lock:
+                self._loading.pop(name, None)
+            event.set()
+
+    def _evict(self, keep: int):
+        with self._lock:
+            evicted = []
+            while len(self._warm) > keep:
+                evicted.append(self._warm.popitem(last=False)[0])
+        for name in evicted:
+            logger.info(f"♻️  卸载模型 {name} ({self.device})")
+            self.on_event(name, "evicted", 0.0)
+        if evicted:
+            release_device_memory(self.device)
+
+    def _load(self, name: str) -> VideoPipeline:
+        model_path = self.model_paths.get(name)
+        if model_path is None:
+            raise ValueError(f"未知模型: {name}")
+        
+        # 先腾出位置再加载，避免新旧模型同时占用显存
+        self._evict(self.max_warm - 1)
+        last_reported = [0.0]
+        
+        def on_progress(progress: float):
+            if progress >= 1.0 or progress - last_reported[0] >= 0.01:
+                last_reported[0] = progress
+                self.on_event(name, "loading", progress)
+        
+        self.on_event(name, "loading", 0.0)
+        start = time.perf_counter()
+        try:
+            pipeline = load_pipeline(self.pipeline_name, self.device, model_path, on_progress)
+        except Exception as e:
+            self._errors[name] = str(e)
+            self.on_event(name, "failed", 0.0, error=str(e))
+            raise
+        
+        with self._lock:
+            self._warm[name] = pipeline
+        self._evict(self.max_warm)
+        seconds = time.perf_counter() - start
+        logger.info(f"🔥 模型 {name} 已加载到 {self.device} ({pipeline.name}, {seconds:.1f}秒)")
+        self.on_event(name, "warm", 1.0, pipeline=pipeline.name, supports_batch=pipeline.supports_batch,
+                      supports_step_batching=pipeline.supports_step_batching, seconds=seconds)
+        return pipeline
+
+def _gpu_worker_main(worker_id: int, device: str, pipeline_name: str, conn):
+    """GPU工作进程入口：立即就绪接收任务，模型在后台预加载并常驻，之后循环处理派发来的任务"""
+    if device.startswith("cuda"):
+        torch.cuda.set_device(device)
+    
+    # 进程模式下帧数组（交接和checkpoint的重叠帧）经共享内存传输，线程模式直接传引用
+    frame_ring = None
+    if not isinstance(conn, _QueueConnection):
+        frame_ring = SharedFrameRing.from_env()
+        conn = _SharedFrameConnection(conn, frame_ring)
+    
+    # 预加载线程与任务循环共用连接，发送需要加锁
+    send_lock = threading.Lock()
+    
+    def send(message: Dict[str, Any]):
+        with send_lock:
+            conn.send(message)
+    
+    def observe(name: str, value: float, stage: Optional[str] = None):
+        send({"type": "metric", "name": name, "value": value, "stage": stage})
+    
+    def on_model_event(model: str, state: str, progress: float, **info):
+        send(dict(info, type="model", model=model, state=state, progress=progress))
+        if state == "warm":
+            observe("stage", info["seconds"], "model_init")
+    
+    get_embedding_cache().on_lookup = lambda result: observe("embed_cache", 1, result)
+    model_paths = configured_models()
+    registry = ModelRegistry(pipeline_name, device, model_paths,
+                             int(os.getenv("SKYREELS_WARM_MODELS", "1")), on_model_event)
+    preload = os.getenv("SKYREELS_PRELOAD_MODELS", next(iter(model_paths)))
+    send({"type": "ready", "worker_id": worker_id})
+    registry.preload([name.strip() for name in preload.split(",") if name.strip()])
+    
+    continuous = os.getenv("SKYREELS_CONTINUOUS_BATCHING", "true").lower() == "true"
+    sessions: List[GenerationSession] = []
+    waiting: deque = deque()  # 模型与活跃任务不同的消息，等活跃任务全部结束后再开始
+    inbox: deque = deque()  # 同步生成期间读到的非控制消息
+    running_sync: Set[str] = set()  # 正在同步生成的任务
+    cancelled: Dict[str, str] = {}  # 同步生成中被取消的任务 -> 原因
+    
+    def make_report(task_id: str):
+        def report(progress: float, stage: str):
+            send({"type": "progress", "task_id": task_id, "progress": progress, "stage": stage})
+        return report
+    
+    def release_memory():
+        if device.startswith("cuda"):
+            observe("gpu_peak_bytes", torch.cuda.max_memory_allocated(device))
+            torch.cuda.reset_peak_memory_stats(device)
+        release_device_memory(device)
+    
+    def send_cancelled(task_id: str, reason: str, checkpoint: Optional[Dict[str, Any]] = None):
+        send({"type": "cancelled", "task_id": task_id, "reason": reason, "checkpoint": checkpoint})
+    
+    def cancel(message: Dict[str, Any]):
+        """取消或抢占任务：未开始的直接移除，活跃批次中的在两步之间离开并释放显存，同步生成中的在下一步中断"""
+        task_id, reason = message["task_id"], message["reason"]
+        for pending_messages in (waiting, inbox):
+            for pending in list(pending_messages):
+                if pending["type"] == "jobs":
+                    kept = [item for item in pending["jobs"] if item["task_id"] != task_id]
+                    if len(kept) == len(pending["jobs"]):
+                        continue
+                    item = next(item for item in pending["jobs"] if item["task_id"] == task_id)
+                    send_cancelled(task_id, reason, item["job"].get("resume"))
+                    if kept:
+                        pending["jobs"] = kept
+                    else:
+                        pending_messages.remove(pending)
+                elif pending["type"] == "segment" and pending["task_id"] == task_id:
+                    pending_messages.remove(pending)
+        
+        removed = [session for session in sessions if session.task_id == task_id]
+        for session in removed:
+            checkpoint = session.checkpoint() if reason == "preempted" and isinstance(session, GenerationSession) else None
+            sessions.remove(session)
+            session.close()
+            if isinstance(session, GenerationSession):
+                send_cancelled(task_id, reason, checkpoint)
+        if removed:
+            release_memory()
+        elif task_id in running_sync:
+            cancelled[task_id] = reason
+    
+    def poll_control():
+        """同步生成期间在去噪步之间读取消息：取消立即生效，其他消息留到当前任务结束后处理"""
+        while conn.poll():
+            message = conn.recv()
+            if message["type"] == "cancel":
+                cancel(message)
+            else:
+                inbox.append(message)
+    
+    def start_jobs(message: Dict[str, Any]):
+        """开始一条jobs消息：支持逐步接口的管线加入活跃批次，否则同步执行整批"""
+        # 同一条消息中的任务分辨率、帧数、步数和模型相同
+        task_ids = [item["task_id"] for item in message["jobs"]]
+        jobs = [item["job"] for item in message["jobs"]]
+        model = jobs[0].get("model") or next(iter(model_paths))
+        if sessions and (waiting or sessions[0].model != model):
+            waiting.append(message)
+            return
+        
+        reports = [make_report(task_id) for task_id in task_ids]
+        try:
+            for report in reports:
+                report(0.0, "model_init")
+            pipeline = registry.get(model)
+        except Exception as e:
+            for task_id in task_ids:
+                send({"type": "error", "task_id": task_id, "error": str(e)})
+            return
+        
+        engine = SegmentedGenerationEngine(pipeline)
+        if continuous and pipeline.supports_step_batching:
+            for task_id, job, report in zip(task_ids, jobs, reports):
+                try:
+                    sessions.append(GenerationSession(engine, model, job, report, observe))
+                except Exception as e:
+                    send({"type": "error", "task_id": task_id, "error": str(e)})
+            return
+        
+        def cancellable(report):
+            # 批内任务全部取消时才中断，部分取消的任务继续执行，结果由API进程丢弃
+            def checked_report(progress: float, stage: str):
+                report(progress, stage)
+                if stage == "denoise":
+                    poll_control()
+                    if all(task_id in cancelled for task_id in task_ids):
+                        raise TaskInterrupted(cancelled[task_ids[0]])
+            return checked_report
+        
+        running_sync.update(task_ids)
+        try:
+            result_paths = engine.run_batch(jobs, [cancellable(report) for report in reports], observe)
+            for task_id, result_path in zip(task_ids, result_paths):
+                send({"type": "result", "task_id": task_id, "result_path": result_path})
+        except TaskInterrupted as e:
+            # 同步管线只能从被中断窗口的开头恢复
+            checkpoint = engine.checkpoint(engine.contexts[0]) if e.reason == "preempted" and len(jobs) == 1 else None
+            for task_id in task_ids:
+                send_cancelled(task_id, cancelled[task_id], checkpoint)
+        except Exception as e:
+            for task_id in task_ids:
+                send({"type": "error", "task_id": task_id, "error": str(e)})
+        finally:
+            running_sync.difference_update(task_ids)
+            for task_id in task_ids:
+                cancelled.pop(task_id, None)
+            release_memory()
+    
+    def start_segment(message: Dict[str, Any]):
+        """开始多GPU流水线中的一个分段，不支持逐步接口的管线同步生成整段后再交接"""
+        model = message["job"].get("model") or next(iter(model_paths))
+        if sessions and (waiting or sessions[0].model != model):
+            waiting.append(message)
+            return
+        
+        task_id, segment = message["task_id"], message["segment"]
+        try:
+            pipeline = registry.get(model)
+            if pipeline.supports_step_batching:
+                sessions.append(SegmentSession(pipeline, model, message, send, observe))
+                return
+            
+            def step_callback(step: int, total_steps: int):
+                send({"type": "segment_progress", "task_id": task_id, "index": segment["index"],
+                      "step": step, "total_steps": total_steps})
+            
+            frames, condition = pipeline.generate_segment(message["job"], segment, message["condition"], step_callback)
+            if not message["is_last"]:
+                send({"type": "handoff", "task_id": task_id, "index": segment["index"], "condition": condition})
+            encode_pipeline_segment(task_id, segment, frames, message["job"]["fps"], send, observe)
+            get_segment_encoder().wait_ready([task_id])
+        except Exception as e:
+            send({"type": "segment_error", "task_id": task_id, "index": segment["index"], "error": str(e)})
+    
+    def step_sessions():
+        """活跃任务各推进一个去噪步（同一管线一次批量前向），结束的任务离开批次
+
+        分段编码积压达到上限的任务本轮跳过，只有它等待自己的编码，同批其他任务照常推进。
+        """
+        encoder = get_segment_encoder()
+        ready = [session for session in sessions if not encoder.saturated(session.task_id)]
+        if not ready:
+            # 全部任务都在等各自的编码：限时等待，之后回到主循环接收消息
+            encoder.wait_ready([session.task_id for session in sessions], timeout=0.05)
+            return
+        start = time.perf_counter()
+        try:
+            sessions[0].pipeline.step_batch([session.state for session in ready])
+        except Exception as e:
+            for session in ready:
+                send(session.error_message(e))
+                sessions.remove(session)
+            if not sessions:
+                release_memory()
+            return
+        observe("denoise_step", time.perf_counter() - start)
+        observe("batch_size", len(ready))
+        
+        for session in ready:
+            try:
+                if not session.after_step():
+                    continue
+                message = session.result_message()
+                if message is not None:
+                    send(message)
+            except Exception as e:
+                send(session.error_message(e))
+            sessions.remove(session)
+        if not sessions:
+            release_memory()
+    
+    while True:
+        # 有活跃任务时只取已到达的消息，不阻塞去噪循环；空闲时先处理等待中的消息
+        if inbox:
+            messages = [inbox.popleft()]
+        elif sessions:
+            messages = []
+            while conn.poll():
+                messages.append(conn.recv())
+        elif waiting:
+            messages = [waiting.popleft()]
+        else:
+            messages = [conn.recv()]
+        
+        for message in messages:
+            if message["type"] == "shutdown":
+                if frame_ring is not None:
+                    frame_ring.close()
+                return
+            if message["type"] == "cancel":
+                cancel(message)
+            elif message["type"] == "jobs":
+                start_jobs(message)
+            elif message["type"] == "segment":
+                start_segment(message)
+        if sessions:
+            step_sessions()
+
+# 进程间帧数据传输
+class SharedFrameRing:
+    """共享内存帧环形缓冲区：消息中较大的numpy数组写入槽位，只pickle槽位描述，接收方映射后复制并归还槽位
+
+    每个进程只向自己创建的环写入，可同时读取其他进程的环。写入从不等待：槽位全部在途或数组大于槽位时
+    立即退回pickle传输，不在事件循环上阻塞。共享内存在首次写入时创建。
+    槽位和映射按对端（owner）登记，对端进程退出后由release回收它未取走的槽位和它创建的共享内存。
+    """
+
+    MIN_BYTES = 1024 * 1024  # 小数组直接pickle更快
+
+    def __init__(self, slots: int, slot_bytes: int):
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self._attached: Dict[str, shared_memory.SharedMemory] = {}
+        self._owners: Dict[int, Any] = {}  # 在途槽位 -> 接收方
+        self._peers: Dict[Any, Set[str]] = {}  # 发送方 -> 映射过的共享内存名
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "SharedFrameRing":
+        return cls(int(os.getenv("SKYREELS_FRAME_RING_SLOTS", "4")),
+                   int(float(os.getenv("SKYREELS_FRAME_RING_SLOT_MB", "128")) * 1024**2))
+
+    def put(self, array: np.ndarray, owner: Any = None) -> Optional[Dict[str, Any]]:
+        """写入一个空闲槽位并返回描述，放不下或没有空闲槽位时立即返回None"""
+        if self.slots <= 0 or not self.MIN_BYTES <= array.nbytes <= self.slot_bytes or array.dtype.hasobject:
+            return None
+        with self._lock:
+            if self._shm is None:
+                # 每个槽位一个占用标记字节，数据区按64字节对齐
+                self._header = (self.slots + 63) // 64 * 64
+                self._shm = shared_memory.SharedMemory(create=True, size=self._header + self.slots * self.slot_bytes)
+                self._shm.buf[:self.slots] = bytes(self.slots)
+            slot = bytes(self._shm.buf[:self.slots]).find(0)
+            if slot < 0:
+                return None
+            self._shm.buf[slot] = 1
+            self._owners[slot] = owner
+        offset = self._header + slot * self.slot_bytes
+        np.ndarray(array.shape, array.dtype, buffer=self._shm.buf, offset=offset)[...] = array
+        return {"__shared_frames__": self._shm.name, "slot": slot, "offset": offset,
+                "shape": array.shape, "dtype": array.dtype.str}
+
+    def take(self, descriptor: Dict[str, Any], owner: Any = None) -> np.ndarray:
+        """复制出槽位中的数组并归还槽位"""
+        shm = self._attach(descriptor["__shared_frames__"], owner)
+        array = np.ndarray(descriptor["shape"], np.dtype(descriptor["dtype"]), buffer=shm.buf,
+                           offset=descriptor["offset"]).copy()
+        shm.buf[descriptor["slot"]] = 0
+        return array
+
+    def in_flight(self) -> int:
+        """已写入、尚未被接收方取走的槽位数"""
+        if self._shm is None:
+            return 0
+        return self.slots - bytes(self._shm.buf[:self.slots]).count(0)
+
+    def _attach(self, name: str, owner: Any = None) -> shared_memory.SharedMemory:
+        with self._lock:
+            if self._shm is not None and self._shm.name == name:
+                return self._shm
+            shm = self._attached.get(name)
+            if shm is None:
+                # 工作进程由API进程spawn，共用同一个资源跟踪器：映射方重复登记无影响，
+                # 由创建方unlink；创建方异常退出时由release或跟踪器在API进程退出时清理
+                shm = shared_memory.SharedMemory(name=name)
+                self._attached[name] = shm
+            self._peers.setdefault(owner, set()).add(name)
+            return shm
+
+    def release(self, owner: Any):
+        """对端进程已退出：归还发往它、尚未取走的槽位，解除并删除它创建的共享内存"""
+        with self._lock:
+            for slot, slot_owner in list(self._owners.items()):
+                if slot_owner == owner:
+                    del self._owners[slot]
+                    if self._shm is not None:
+                        self._shm.buf[slot] = 0
+            for name in self._peers.pop(owner, ()):
+                shm = self._attached.pop(name, None)
+                if shm is None:
+                    continue
+                shm.close()
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def pack(self, obj: Any, owner: Any = None) -> Any:
+        """把消息中的大数组替换为槽位描述"""
+        if isinstance(obj, np.ndarray):
+            return self.put(obj, owner) or obj
+        if isinstance(obj, dict):
+            return {key: self.pack(value, owner) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [self.pack(value, owner) for value in obj]
+        return obj
+
+    def unpack(self, obj: Any, owner: Any = None) -> Any:
+        if isinstance(obj, dict):
+            if "__shared_frames__" in obj:
+                return self.take(obj, owner)
+            return {key: self.unpack(value, owner) for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [self.unpack(value, owner) for value in obj]
+        return obj
+
+    def close(self):
+        with self._lock:
+            for shm in self._attached.values():
+                shm.close()
+            self._attached.clear()
+            self._peers.clear()
+            self._owners.clear()
+            if self._shm is not None:
+                self._shm.close()
+                self._shm.unlink()
+                self._shm = None
+
+class _SharedFrameConnection:
+    """包装multiprocessing连接：发送时大数组经共享内存环传输，接收时还原；owner标识连接的对端"""
+
+    def __init__(self, conn, ring: SharedFrameRing, owner: Any = None):
+        self._conn = conn
+        self._ring = ring
+        self._owner = owner
+
+    def send(self, obj):
+        self._conn.send(self._ring.pack(obj, self._owner))
+
+    def recv(self):
+        return self._ring.unpack(self._conn.recv(), self._owner)
+
+    def poll(self, timeout: float = 0.0) -> bool:
+        return self._conn.poll(timeout)
+
+    def close(self):
+        self._conn.close()
+
+# 线程模式使用的连接
+class _QueueConnection:
+    """与multiprocessing.Connection接口一致的线程内双向连接"""
+
+    def __init__(self, incoming: queue.Queue, outgoing: queue.Queue):
+        self._incoming = incoming
+        self._outgoing = outgoing
+        self._buffer: deque = deque()
+
+    @classmethod
+    def pair(cls):
+        a, b = queue.Queue(), queue.Queue()
+        return cls(a, b), cls(b, a)
+
+    def send(self, obj):
+        self._outgoing.put(obj)
+
+    def recv(self):
+        if self._buffer:
+            return self._buffer.popleft()
+        return self._incoming.get()
+
+    def poll(self, timeout: float = 0.0) -> bool:
+        if self._buffer:
+            return True
+        try:
+            self._buffer.append(self._incoming.get(timeout=timeout) if timeout else self._incoming.get_nowait())
+        except queue.Empty:
+            return False
+        return True
+
+    def close(self):
+        pass
+
+# GPU工作进程池
+class GPUWorkerPool:
+    """每个GPU一个常驻工作进程，API进程只负责派发任务和接收进度消息"""
+
+    def __init__(self, devices: List[str], pipeline_name: str = "auto", mode: str = "process"):
+        self.devices = devices
+        self.pipeline_name = pipeline_name
+        self.mode = mode
+        self.workers: List[Dict[str, Any]] = []
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._segment_jobs: Dict[str, asyncio.Queue] = {}  # 多GPU流水线任务的消息队列
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopping = False
+        self.multi_gpu_mode = os.getenv("SKYREELS_MULTI_GPU_MODE", "pipeline")
+        # 交接比例 <1 时下一段以预测的重叠帧为条件提前开始（多GPU并行，段间可能有轻微接缝）；
+        # 1.0 时等最终解码的重叠帧，与单GPU结果一致，此时流水线没有并行度，长视频在单GPU执行
+        self.handoff_fraction = float(os.getenv("SKYREELS_HANDOFF_FRACTION", "1.0"))
+        self.frame_ring: Optional[SharedFrameRing] = None  # 进程模式下发往工作进程的帧数组
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        ctx = multiprocessing.get_context("spawn")  # CUDA要求spawn
+        
+        for worker_id, device in enumerate(self.devices):
+            if self.mode == "process":
+                self.frame_ring = self.frame_ring or SharedFrameRing.from_env()
+                conn, child_conn = ctx.Pipe()
+                runner = ctx.Process(
+                    target=_gpu_worker_main,
+                    args=(worker_id, device, self.pipeline_name, child_conn),
+                    name=f"skyreels-worker-{worker_id}",
+                    daemon=True
+                )
+            else:
+                conn, child_conn = _QueueConnection.pair()
+                runner = threading.Thread(
+                    target=_gpu_worker_main,
+                    args=(worker_id, device, self.pipeline_name, child_conn),
+                    name=f"skyreels-worker-{worker_id}",
+                    daemon=True
+                )
+            runner.start()
+            if self.frame_ring is not None:
+                conn = _SharedFrameConnection(conn, self.frame_ring, owner=worker_id)
+            
+            worker = {"worker_id": worker_id, "device": device, "conn": conn, "runner": runner,
+                      "state": "starting", "pipeline": None, "supports_batch": False,
+                      "supports_step_batching": False, "models": {}, "tasks": set()}
+            self.workers.append(worker)
+            threading.Thread(target=self._reader, args=(worker,), daemon=True).start()
+        
+        logger.info(f"🧵 工作{'进程' if self.mode == 'process' else '线程'}池已启动: {', '.join(self.devices)} (管线: {self.pipeline_name})")
+
+    def _reader(self, worker: Dict[str, Any]):
+        """后台线程：读取工作进程消息并转交事件循环"""
+        while True:
+            try:
+                message = worker["conn"].recv()
+            except (EOFError, OSError):
+                message = {"type": "worker_error", "worker_id": worker["worker_id"], "error": "工作进程已退出"}
+                self._loop.call_soon_threadsafe(self._dispatch, worker, message)
+                return
+            self._loop.call_soon_threadsafe(self._dispatch, worker, message)
+
+    def _dispatch(self, worker: Dict[str, Any], message: Dict[str, Any]):
+        kind = message["type"]
+        if kind == "ready":
+            worker["state"] = "ready"
+            logger.info(f"✅ 工作进程 {worker['worker_id']} ({worker['device']}) 就绪")
+            return
+        if kind == "model":
+            if message["state"] == "evicted":
+                worker["models"].pop(message["model"], None)
+                return
+            worker["models"][message["model"]] = {
+                "state": message["state"],
+                "progress": round(message["progress"], 3),
+                "error": message.get("error")
+            }
+            if message.get("pipeline"):
+                worker["pipeline"] = message["pipeline"]
+                worker["supports_batch"] = message["supports_batch"]
+                worker["supports_step_batching"] = message["supports_step_batching"]
+            return
+        if kind == "worker_error":
+            worker["state"] = "dead"
+            if self._stopping:
+                return
+            if self.frame_ring is not None:
+                self.frame_ring.release(worker["worker_id"])
+            logger.error(f"❌ 工作进程 {worker['worker_id']} ({worker['device']}) 异常: {message['error']}")
+            for task_id in list(worker["tasks"]):
+                self._finish(worker, task_id, error=message["error"])
+            for events in self._segment_jobs.values():
+                events.put_nowait(dict(message, worker_id=worker["worker_id"]))
+            return
+        
+        if kind == "metric":
+            record_worker_metric(worker["device"], message)
+            return
+        if kind == "cancelled" and message["task_id"] not in self._segment_jobs:
+            self._finish(worker, message["task_id"], error=TaskInterrupted(message["reason"], message["checkpoint"]))
+            return
+        if kind in ("segment_progress", "handoff", "segment_done", "segment_error", "cancelled"):
+            events = self._segment_jobs.get(message["task_id"])
+            if events is not None:
+                events.put_nowait(message)
+            return
+        
+        pending = self._pending.get(message["task_id"])
+        if pending is None:
+            return
+        if kind == "progress":
+            pending["on_progress"](message)
+        elif kind == "result":
+            self._finish(worker, message["task_id"], result=message["result_path"])
+        elif kind == "error":
+            self._finish(worker, message["task_id"], error=message["error"])
+
+    def _finish(self, worker: Dict[str, Any], task_id: str, result: Optional[str] = None, error: Any = None):
+        worker["tasks"].discard(task_id)
+        pending = self._pending.pop(task_id, None)
+        if pending is None or pending["future"].done():
+            return
+        if error is not None:
+            pending["future"].set_exception(error if isinstance(error, BaseException) else RuntimeError(error))
+        else:
+            pending["future"].set_result(result)
+
+    async def run_batch(self, gpu_id: int, items: List[Tuple[str, Dict[str, Any], Callable]]) -> List[Any]:
+        """把一批 (task_id, job, on_progress) 派发到指定GPU的工作进程
+
+        返回与items对应的结果列表，失败的任务对应位置为异常对象。
+        """
+        worker = self.workers[gpu_id % len(self.workers)]
+        if worker["state"] == "dead":
+            raise RuntimeError(f"工作进程 {worker['worker_id']} 不可用")
+        
+        futures = []
+        for task_id, job, on_progress in items:
+            future = self._loop.create_future()
+            self._pending[task_id] = {"future": future, "on_progress": on_progress}
+            worker["tasks"].add(task_id)
+            futures.append(future)
+        worker["conn"].send({"type": "jobs", "jobs": [{"task_id": task_id, "job": job} for task_id, job, _ in items]})
+        return await asyncio.gather(*futures, return_exceptions=True)
+
+    def cancel(self, task_id: str, reason: str = "cancelled") -> bool:
+        """通知执行该任务的工作进程取消（cancelled）或抢占（preempted）任务，返回是否已发出"""
+        events = self._segment_jobs.get(task_id)
+        if events is not None:
+            if reason == "preempted":
+                return False  # 多GPU流水线任务不支持抢占
+            events.put_nowait({"type": "cancelled", "task_id": task_id, "reason": reason})
+            targets = [w for w in self.workers if w["state"] != "dead"]
+        else:
+            targets = [w for w in self.workers if task_id in w["tasks"] and w["state"] != "dead"]
+        for worker in targets:
+            worker["conn"].send({"type": "cancel", "task_id": task_id, "reason": reason})
+        return bool(targets)
+
+    def can_pipeline(self) -> bool:
+        """多个工作进程都支持逐步接口、且允许提前交接时，长视频可以按分段流水线分布到多个GPU"""
+        live = [w for w in self.workers if w["state"] != "dead"]
+        return (self.multi_gpu_mode == "pipeline" and self.handoff_fraction < 1.0 and len(live) > 1
+                and all(w["supports_step_batching"] for w in live))
+
+    async def run_pipelined(self, gpu_id: int, task_id: str, job: Dict[str, Any], on_progress,
+                            gpu_ids: Optional[List[int]] = None) -> str:
+        """多GPU分段流水线：分段从gpu_id开始轮流派发到gpu_ids（默认全部工作进程）
+
+        前一段去噪到交接步（handoff_fraction）时把预测的重叠帧交给下一段，
+        两段在不同GPU上并行完成剩余步数；同时在途的分段数约为 1 / handoff_fraction。
+        下一段的条件是交接步的x0预测而不是前一段最终输出的帧，交接越早并行度越高、段间接缝越明显。
+        """
+        engine = SegmentedGenerationEngine(None)
+        context = engine.prepare(job)
+        segments = context["segments"]
+        if len(segments) == 1:
+            return (await self.run_batch(gpu_id, [(task_id, job, on_progress)]))[0]
+        
+        job = context["job"]
+        steps = job["num_inference_steps"]
+        handoff_step = max(1, min(steps, math.ceil(steps * self.handoff_fraction)))
+        gpu_ids = gpu_ids or [gpu_id] + [other for other in range(len(self.workers)) if other != gpu_id]
+        workers = [w for w in (self.workers[other % len(self.workers)] for other in gpu_ids) if w["state"] != "dead"]
+        events: asyncio.Queue = asyncio.Queue()
+        self._segment_jobs[task_id] = events
+        placement: Dict[int, int] = {}  # 分段序号 -> worker_id
+        handoffs: Dict[int, Any] = {}  # 分段序号 -> 交给下一段的重叠帧
+        progress = [0.0] * len(segments)
+        done: Dict[int, Dict[str, Any]] = {}
+        
+        def dispatch(index: int, condition: Any):
+            worker = workers[index % len(workers)]
+            placement[index] = worker["worker_id"]
+            worker["conn"].send({"type": "segment", "task_id": task_id, "job": job, "segment": segments[index],
+                                 "condition": condition, "is_last": index == len(segments) - 1,
+                                 "handoff_step": handoff_step})
+        
+        try:
+            on_progress({"progress": 0.0, "stage": "model_init"})
+            dispatch(0, None)
+            while len(done) < len(segments):
+                message = await events.get()
+                kind = message["type"]
+                if kind == "segment_progress":
+                    progress[message["index"]] = message["step"] / message["total_steps"] * 0.9
+                    on_progress({"progress": sum(progress) / len(segments) * 0.95, "stage": "denoise"})
+                elif kind == "handoff":
+                    handoffs[message["index"]] = message["condition"]
+                    dispatch(message["index"] + 1, message["condition"])
+                elif kind == "segment_done":
+                    done[message["index"]] = message
+                    progress[message["index"]] = 1.0
+                    # 按顺序把已完成的连续分段加入直播播放列表
+                    while len(context["segment_paths"]) in done:
+                        finished = done[len(context["segment_paths"])]
+                        context["segment_paths"].append(Path(finished["path"]))
+                        context["playlist"].append((Path(finished["path"]).name, finished["frames"] / job["fps"]))
+                    write_hls_playlist(context["stream_dir"], context["playlist"], ended=False)
+                    completed = len(context["segment_paths"])
+                    if 0 < completed < len(segments) and completed > context["segment_index"]:
+                        context.update(segment_index=completed, condition=handoffs[completed - 1])
+                        await asyncio.to_thread(engine.save_checkpoint, context)
+                elif kind == "segment_error":
+                    raise RuntimeError(f"分段 {message['index']} 生成失败: {message['error']}")
+                elif kind == "cancelled":
+                    raise TaskInterrupted(message["reason"])
+                elif kind == "worker_error" and message["worker_id"] in (
+                        placement[index] for index in placement if index not in done):
+                    raise RuntimeError(f"工作进程 {message['worker_id']} 异常: {message['error']}")
+            
+            def report(progress: float, stage: str):
+                self._loop.call_soon_threadsafe(on_progress, {"progress": progress, "stage": stage})
+            
+            return await asyncio.to_thread(engine.finalize, context, report, lambda name, value, stage=None: None)
+        finally:
+            self._segment_jobs.pop(task_id, None)
+            if len(done) < len(segments):
+                # 失败或取消时停止其他GPU上仍在执行的分段
+                for worker in workers:
+                    if worker["state"] != "dead":
+                        worker["conn"].send({"type": "cancel", "task_id": task_id, "reason": "cancelled"})
+
+    def supports_batch(self, gpu_id: int) -> bool:
+        return bool(self.workers) and self.workers[gpu_id % len(self.workers)]["supports_batch"]
+
+    def supports_step_batching(self, gpu_id: int) -> bool:
+        return bool(self.workers) and self.workers[gpu_id % len(self.workers)]["supports_step_batching"]
+
+    def model_warm(self, gpu_id: int, model: str) -> bool:
+        """模型是否已常驻在该GPU的工作进程中（其权重已计入已用显存）"""
+        return bool(self.workers) and \
+            self.workers[gpu_id % len(self.workers)]["models"].get(model, {}).get("state") == "warm"
+
+    async def stop(self):
+        self._stopping = True
+        for worker in self.workers:
+            if worker["state"] != "dead":
+                try:
+                    worker["conn"].send({"type": "shutdown"})
+                except (OSError, ValueError):
+                    pass
+        for worker in self.workers:
+            runner = worker["runner"]
+            await asyncio.to_thread(runner.join, 10)
+            if self.mode == "process" and runner.is_alive():
+                runner.terminate()
+        self.workers.clear()
+        if self.frame_ring is not None:
+            self.frame_ring.close()
+            self.frame_ring = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "pipeline": self.pipeline_name,
+            "workers": [
+                {"worker_id": w["worker_id"], "device": w["device"], "state": w["state"],
+                 "pipeline": w["pipeline"], "models": w["models"], "active_tasks": len(w["tasks"])}
+                for w in self.workers
+            ]
+        }
+
+def detect_worker_devices() -> List[str]:
+    """每个可见GPU一个工作进程，无GPU时使用CPU
+
+    SKYREELS_WORKER_DEVICES可显式指定设备列表，例如 "cpu,cpu,cpu" 用于在CPU上模拟多GPU。
+    """
+    devices = os.getenv("SKYREELS_WORKER_DEVICES", "")
+    if devices:
+        return [device.strip() for device in devices.split(",") if device.strip()]
+    if torch.cuda.is_available() and torch.cuda.device_count() > 0:
+        return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    return ["cpu"]
+
+# Prometheus指标
+STAGE_DURATION_SECONDS = Histogram(
+    "skyreels_stage_duration_seconds",
+    "各生成阶段耗时",
+    ["stage"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+DENOISE_STEP_SECONDS = Histogram(
+    "skyreels_denoise_step_seconds",
+    "单个去噪步耗时",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+)
+FRAMES_GENERATED = Counter("skyreels_frames_generated_total", "已生成的视频帧数")
+GENERATION_FPS = Gauge("skyreels_generation_fps", "最近一个分段的生成速度（帧/秒）", ["device"])
+BYTES_SERVED = Counter("skyreels_bytes_served_total", "下载和直播接口发送的字节数", ["endpoint"])
+QUEUE_DEPTH = Gauge("skyreels_queue_depth", "调度队列中等待的任务数")
+RUNNING_TASKS = Gauge("skyreels_running_tasks", "正在执行的任务数")
+TASKS_BY_STATUS = Gauge("skyreels_tasks", "各状态任务数", ["status"])
+BATCH_SIZE = Histogram("skyreels_batch_size", "每次批量执行的任务数（静态合批按批次、连续批处理按去噪步）", buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+RESULT_CACHE_LOOKUPS = Counter("skyreels_result_cache_total", "结果缓存查询次数", ["result"])
+EMBED_CACHE_LOOKUPS = Counter("skyreels_prompt_embedding_cache_total", "提示词嵌入缓存查询次数", ["result"])
+GPU_MEMORY_HIGH_WATER = Gauge("skyreels_gpu_memory_high_water_bytes", "GPU显存占用峰值", ["gpu"])
+ETA_ERROR_RATIO = Histogram("skyreels_eta_error_ratio", "任务实际执行时间与开始时预估时间之比",
+                            buckets=(0.25, 0.5, 0.75, 0.9, 1.0, 1.1, 1.25, 1.5, 2.0, 4.0))
+ADMISSION_DECISIONS = Counter("skyreels_admission_total", "显存准入决策次数", ["decision", "plan"])
+
+def record_worker_metric(device: str, message: Dict[str, Any]):
+    """处理工作进程上报的指标消息"""
+    name, value = message["name"], message["value"]
+    if name == "stage":
+        STAGE_DURATION_SECONDS.labels(stage=message["stage"]).observe(value)
+    elif name == "denoise_step":
+        DENOISE_STEP_SECONDS.observe(value)
+    elif name == "frames":
+        FRAMES_GENERATED.inc(value)
+    elif name == "segment_fps":
+        GENERATION_FPS.labels(device=device).set(value)
+    elif name == "batch_size":
+        BATCH_SIZE.observe(value)
+    elif name == "embed_cache":
+        EMBED_CACHE_LOOKUPS.labels(result=message["stage"]).inc(value)
+    elif name == "gpu_peak_bytes":
+        update_gpu_high_water(device.split(":")[-1], value)
+
+_gpu_high_water: Dict[str, float] = {}
+
+def update_gpu_high_water(gpu: str, value: float):
+    """只在超过历史峰值时更新显存高水位"""
+    if value > _gpu_high_water.get(gpu, 0):
+        _gpu_high_water[gpu] = value
+        GPU_MEMORY_HIGH_WATER.labels(gpu=gpu).set(value)
+
+# 合批
+def generation_batch_key(request: "UnlimitedVideoRequest") -> Tuple:
+    """模型、执行方案、分辨率、总帧数、帧率、步数和引导比例都相同的任务可以同批生成"""
+    return (request.model or next(iter(configured_models())), request.execution_plan, request.resolution,
+            request.duration * request.fps, request.fps, request.num_inference_steps, request.guidance_scale)
+
+# 显存规划与准入控制
+# 执行方案按优先顺序排列：offload为CPU卸载（文本编码器和VAE不常驻显存），window_divisor为分段窗口缩小倍数，
+# vae_tiling为分块VAE解码（tile大小在解码时按空闲显存选择，解码峰值不超过去噪峰值）
+EXECUTION_PLANS = {
+    "full_gpu": {"offload": False, "window_divisor": 1, "vae_tiling": False},
+    "full_gpu_tiled_vae": {"offload": False, "window_divisor": 1, "vae_tiling": True},
+    "cpu_offload": {"offload": True, "window_divisor": 1, "vae_tiling": False},
+    "cpu_offload_tiled_vae": {"offload": True, "window_divisor": 1, "vae_tiling": True},
+    "cpu_offload_small_window": {"offload": True, "window_divisor": 2, "vae_tiling": True}
+}
+DTYPE_BYTES = {"bfloat16": 2, "float16": 2, "float32": 4}
+
+class MemoryPlanner:
+    """估算请求的峰值显存和内存，选择放得下的执行方案，并按已占用显存决定任务何时开始
+
+    显存估算以720p、97帧窗口、bfloat16为基准：权重 + max(去噪激活, VAE解码)，激活按像素数、窗口帧数和批大小缩放。
+    分块VAE解码的方案中解码按tile进行，不再超过去噪激活。
+    """
+
+    def __init__(self):
+        self.segment_frames = int(os.getenv("SKYREELS_SEGMENT_FRAMES", "97"))
+        self.overlap_frames = int(os.getenv("SKYREELS_OVERLAP_FRAMES", "17"))
+        self.max_batch = int(os.getenv("SKYREELS_MAX_BATCH", "4"))
+        self.dtype_scale = DTYPE_BYTES.get(os.getenv("SKYREELS_WEIGHT_DTYPE", "bfloat16"), 2) / 2
+        self.model_memory = float(os.getenv("SKYREELS_MODEL_MEMORY_GB", "32")) * self.dtype_scale
+        self.sample_memory = float(os.getenv("SKYREELS_SAMPLE_MEMORY_GB", "10")) * self.dtype_scale
+        self.vae_memory = float(os.getenv("SKYREELS_VAE_MEMORY_GB", "6")) * self.dtype_scale
+        self.offload_resident = float(os.getenv("SKYREELS_OFFLOAD_RESIDENT_FRACTION", "0.7"))
+        self.headroom = float(os.getenv("SKYREELS_MEMORY_HEADROOM", "0.9"))  # 只规划可用显存的该比例
+        if self.overlap_frames < 0 or self.segment_frames <= self.overlap_frames:
+            raise ValueError(f"SKYREELS_SEGMENT_FRAMES({self.segment_frames})必须大于"
+                             f"SKYREELS_OVERLAP_FRAMES({self.overlap_frames})")
+        self.reservations: Dict[str, Dict[str, Any]] = {}  # task_id -> {gpu_id, weights, activation}
+
+    def window_frames(self, plan_name: str) -> int:
+        return (self.segment_frames - 1) // EXECUTION_PLANS[plan_name]["window_divisor"] + 1
+
+    def estimate(self, request: "UnlimitedVideoRequest", plan_name: str, batch: int = 1) -> Dict[str, float]:
+        """返回方案的峰值显存、其中的常驻权重和激活部分，以及主机内存需求（GB）"""
+        plan = EXECUTION_PLANS[plan_name]
+        height, width = RESOLUTION_SIZES.get(request.resolution, RESOLUTION_SIZES["720p"])
+        window = self.window_frames(plan_name)
+        scale = height * width * window / (720 * 1280 * 97)
+        weights = self.model_memory * (self.offload_resident if plan["offload"] else 1.0)
+        vae_memory = min(self.vae_memory, self.sample_memory) if plan["vae_tiling"] else self.vae_memory
+        activation = max(self.sample_memory, vae_memory) * scale * batch
+        # 主机内存：卸载的权重 + 解码后的float32帧缓冲
+        host = (self.model_memory - weights) + window * height * width * 3 * 4 * batch / 1024**3
+        return {"vram_gb": round(weights + activation, 2), "weights_gb": round(weights, 2),
+                "activation_gb": round(activation, 2), "host_gb": round(host, 2)}
+
+    def gpu_memory(self) -> List[Dict[str, float]]:
+        """各GPU的总显存和当前空闲显存（GB），CPU模式返回空列表"""
+        gpus = gpu_telemetry.latest().get("gpus") or []
+        if gpus:
+            return [{"total": gpu["total"], "free": gpu["free"]} for gpu in gpus]
+        gpu_count = gpu_detector.gpu_info["gpu_count"]
+        return [{"total": gpu_detector.gpu_info["memory"] / gpu_count,
+                 "free": gpu_detector.gpu_info["memory"] / gpu_count} for _ in range(gpu_count)]
+
+    def plan(self, request: "UnlimitedVideoRequest") -> Dict[str, Any]:
+        """选择执行方案
+
+        优先选当前空闲显存放得下的方案（模型已常驻的GPU不再计入权重）；都放不下但空闲GPU放得下时延后执行；
+        空闲GPU也放不下时拒绝。返回 {plan, estimate, fits_now, reason}，plan为None表示拒绝。
+        """
+        model = request.model or next(iter(configured_models()))
+        candidates = [request.execution_plan] if request.execution_plan else list(EXECUTION_PLANS)
+        # 缩小窗口的方案必须仍比重叠帧数大，否则分段无法推进
+        candidates = [name for name in candidates if self.window_frames(name) > self.overlap_frames]
+        if not candidates:
+            return {"plan": None, "estimate": self.estimate(request, request.execution_plan), "fits_now": False,
+                    "reason": f"执行方案{request.execution_plan}的窗口({self.window_frames(request.execution_plan)}帧)"
+                              f"不大于重叠帧数({self.overlap_frames}帧)"}
+        host_free = psutil.virtual_memory().available / 1024**3
+        gpus = self.gpu_memory()
+        deferred = None
+        for plan_name in candidates:
+            estimate = self.estimate(request, plan_name)
+            if estimate["host_gb"] > host_free:
+                continue
+            if not gpus:
+                return {"plan": plan_name, "estimate": estimate, "fits_now": True, "reason": None}
+            for gpu_id, gpu in enumerate(gpus):
+                if estimate["vram_gb"] > gpu["total"] * self.headroom:
+                    continue
+                need = estimate["vram_gb"] - (estimate["weights_gb"] if worker_pool.model_warm(gpu_id, model) else 0)
+                if need <= gpu["free"] * self.headroom:
+                    return {"plan": plan_name, "estimate": estimate, "fits_now": True, "reason": None}
+            if deferred is None and any(estimate["vram_gb"] <= gpu["total"] * self.headroom for gpu in gpus):
+                deferred = {"plan": plan_name, "estimate": estimate, "fits_now": False,
+                            "reason": f"当前空闲显存不足 (需要{estimate['vram_gb']}GB, "
+                                      f"空闲{max(gpu['free'] for gpu in gpus):.1f}GB)，任务将在显存释放后开始"}
+        if deferred is not None:
+            return deferred
+        estimate = self.estimate(request, candidates[-1])
+        largest = max((gpu["total"] for gpu in gpus), default=0)
+        return {"plan": None, "estimate": estimate, "fits_now": False,
+                "reason": f"{request.resolution}请求在所有执行方案下都超出硬件能力 "
+                          f"(最少需要显存{estimate['vram_gb']}GB/单卡{largest:.1f}GB, "
+                          f"内存{estimate['host_gb']}GB/可用{host_free:.1f}GB)"}
+
+    def max_batch_size(self, request: "UnlimitedVideoRequest", gpu_id: int) -> int:
+        """一个窗口最多合批的任务数：空闲GPU除去常驻权重后能放下的样本数"""
+        gpus = self.gpu_memory()
+        if not gpus:
+            return self.max_batch
+        plan_name = request.execution_plan or "full_gpu"
+        estimate = self.estimate(request, plan_name)
+        budget = gpus[gpu_id % len(gpus)]["total"] * self.headroom - estimate["weights_gb"]
+        return max(1, min(self.max_batch, int(budget // estimate["activation_gb"])))
+
+    def can_start(self, request: "UnlimitedVideoRequest", gpu_id: int,
+                  alongside: List["UnlimitedVideoRequest"] = ()) -> bool:
+        """本任务和同批一起开始的alongside现在能否在该GPU上开始
+
+        取两者中更紧的一个：总显存扣除已开始任务的预留后剩余的部分，以及遥测采到的实时空闲显存
+        （包含其他进程的占用；已开始任务的激活已计入已用显存，模型已常驻时不再计入权重）。
+        """
+        gpus = self.gpu_memory()
+        if not gpus:
+            return True
+        gpu = gpus[gpu_id % len(gpus)]
+        reserved = [r for r in self.reservations.values() if r["gpu_id"] == gpu_id]
+        starting = [{"weights": e["weights_gb"], "activation": e["activation_gb"]}
+                    for e in (self.estimate(other, other.execution_plan or "full_gpu") for other in (request, *alongside))]
+        weights = max(r["weights"] for r in reserved + starting)
+        activation = sum(r["activation"] for r in reserved + starting)
+        if weights + activation > gpu["total"] * self.headroom:
+            return False
+        model = request.model or next(iter(configured_models()))
+        resident = bool(reserved) or worker_pool.model_warm(gpu_id, model)
+        need_now = sum(r["activation"] for r in starting) + (0 if resident else max(r["weights"] for r in starting))
+        return need_now <= gpu["free"] * self.headroom
+
+    def reserve(self, task_id: str, request: "UnlimitedVideoRequest", gpu_id: int):
+        estimate = self.estimate(request, request.execution_plan or "full_gpu")
+        self.reservations[task_id] = {"gpu_id": gpu_id, "weights": estimate["weights_gb"],
+                                      "activation": estimate["activation_gb"]}
+
+    def release(self, task_id: str):
+        """释放任务在所有GPU上的预留（多GPU流水线在其他GPU上的预留键为 task_id@gpu_id）"""
+        for key in [key for key in self.reservations if key == task_id or key.startswith(f"{task_id}@")]:
+            del self.reservations[key]
+
+# 完成时间估算
+class ETAEstimator:
+    """根据已完成任务的分阶段耗时在线拟合生成速度，按 (分辨率, 步数, GPU型号) 分组
+
+    每组保存指数滑动平均：setup为模型初始化秒数，denoise为每输出帧每步秒数（含分段解码和编码），
+    finalize为每输出帧的拼接和音频秒数。预估 = setup + 帧数 × (步数 × denoise + finalize)。
+    """
+
+    def __init__(self, path: Optional[str] = None, alpha: float = 0.3):
+        self.path = Path(path) if path else None
+        self.alpha = alpha
+        self.stats: Dict[str, Dict[str, float]] = {}
+        if self.path is not None and self.path.exists():
+            try:
+                self.stats = json.loads(self.path.read_text())
+            except Exception as e:
+                logger.warning(f"⚠️  读取ETA统计失败: {e}")
+
+    @staticmethod
+    def _key(resolution: str, steps: int, gpu_name: str) -> str:
+        return f"{resolution}|{steps}|{gpu_name}"
+
+    def record(self, resolution: str, steps: int, gpu_name: str, frames: int, stages: Dict[str, float]):
+        """记录一个完成任务的各阶段耗时（秒）"""
+        sample = {
+            "setup": stages.get("model_init", 0.0),
+            "denoise": stages.get("denoise", 0.0) / max(frames * steps, 1),
+            "finalize": (stages.get("encode", 0.0) + stages.get("audio", 0.0)) / max(frames, 1)
+        }
+        entry = self.stats.setdefault(self._key(resolution, steps, gpu_name), {"n": 0})
+        for name, value in sample.items():
+            entry[name] = value if entry["n"] == 0 else entry[name] + self.alpha * (value - entry[name])
+        entry["n"] += 1
+        if self.path is not None:
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self.path.with_suffix(".tmp")
+                tmp_path.write_text(json.dumps(self.stats, indent=1))
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                logger.warning(f"⚠️  保存ETA统计失败: {e}")
+
+    def predict(self, resolution: str, steps: int, frames: int, gpu_name: str) -> Tuple[Optional[float], str]:
+        """返回 (预估秒数, 依据)；没有任何历史时返回 (None, "default")
+
+        依次使用：完全匹配、同分辨率同GPU其他步数、同GPU其他分辨率（按像素数缩放）、其他GPU。
+        """
+        height, width = RESOLUTION_SIZES.get(resolution, RESOLUTION_SIZES["720p"])
+        levels: Dict[str, List[Tuple[Dict[str, float], float]]] = {}
+        for key, entry in self.stats.items():
+            entry_resolution, entry_steps, entry_gpu = key.split("|", 2)
+            entry_height, entry_width = RESOLUTION_SIZES.get(entry_resolution, RESOLUTION_SIZES["720p"])
+            scale = height * width / (entry_height * entry_width)
+            if entry_gpu != gpu_name:
+                level = "other_gpu"
+            elif entry_resolution != resolution:
+                level = "resolution"
+            else:
+                level = "exact" if int(entry_steps) == steps else "steps"
+            levels.setdefault(level, []).append((entry, scale))
+        for level in ("exact", "steps", "resolution", "other_gpu"):
+            if level in levels:
+                weight = sum(entry["n"] for entry, _ in levels[level])
+                fit = {name: sum(entry[name] * (1 if name == "setup" else scale) * entry["n"]
+                                 for entry, scale in levels[level]) / weight
+                       for name in ("setup", "denoise", "finalize")}
+                return fit["setup"] + frames * (steps * fit["denoise"] + fit["finalize"]), level
+        return None, "default"
+
+def worker_gpu_name(gpu_id: int) -> str:
+    """调度槽位对应工作进程的设备型号，用于区分不同GPU的生成速度"""
+    if not worker_pool.workers:
+        return "cpu"
+    device = worker_pool.workers[gpu_id % len(worker_pool.workers)]["device"]
+    if not device.startswith("cuda"):
+        return "cpu"
+    gpus = gpu_telemetry.latest().get("gpus") or []
+    index = int(device.partition(":")[2] or 0)
+    return gpus[index]["name"] if index < len(gpus) else "cuda"
+
+def predict_generation_seconds(request: "UnlimitedVideoRequest", gpu_id: int = 0) -> Tuple[float, str]:
+    """预估单个任务的执行秒数，没有历史数据时退回按分辨率和GPU能力的经验系数"""
+    seconds, basis = eta_estimator.predict(request.resolution, request.num_inference_steps,
+                                           request.duration * request.fps, worker_gpu_name(gpu_id))
+    if seconds is None:
+        seconds = gpu_detector._estimate_time(request.resolution, request.duration) * 60
+    return seconds, basis
+
+def refresh_queue_etas():
+    """按出队顺序模拟各GPU执行槽位的空闲时刻，更新排队任务的预计完成时间（考虑前面的执行中和排队任务）
+
+    每个GPU有capacity(gpu_id)个槽位（连续批处理时为同时活跃的任务数），排队任务依次占用最早空闲的槽位。
+    """
+    now = datetime.now()
+    slots = [[0.0] * job_scheduler.capacity(gpu_id) for gpu_id in range(job_scheduler.gpu_count)]
+    
+    def occupy(gpu_id: int, seconds: float) -> float:
+        gpu_slots = slots[gpu_id]
+        index = min(range(len(gpu_slots)), key=gpu_slots.__getitem__)
+        gpu_slots[index] = max(gpu_slots[index], 0.0) + seconds
+        return gpu_slots[index]
+    
+    for task_id, gpu_id in job_scheduler.running.items():
+        task = task_store.get(task_id)
+        if task is not None and task.estimated_completion is not None:
+            remaining = max((task.estimated_completion - now).total_seconds(), 0.0)
+            # 多GPU流水线任务同时占用借用的GPU
+            for running_gpu in [gpu_id] + job_scheduler.borrowed.get(task_id, []):
+                occupy(running_gpu, remaining)
+    for task_id, request in job_scheduler.queued():
+        gpu_id = min(range(len(slots)), key=lambda gpu_id: min(slots[gpu_id]))
+        seconds, _ = predict_generation_seconds(request, gpu_id)
+        finished = occupy(gpu_id, seconds)
+        task = task_store.get(task_id)
+        if task is not None and task.status == "queued":
+            task_store.update(task_id, estimated_completion=now + timedelta(seconds=finished))
+
+def continuous_batching(gpu_id: int) -> bool:
+    """该GPU的工作进程是否按去噪步做连续批处理"""
+    return (worker_pool.supports_step_batching(gpu_id)
+            and os.getenv("SKYREELS_CONTINUOUS_BATCHING", "true").lower() == "true")
+
+def generation_batch_limit(request: "UnlimitedVideoRequest", gpu_id: int) -> int:
+    # 连续批处理时任务逐个加入活跃批次，不需要静态合批
+    if not worker_pool.supports_batch(gpu_id) or continuous_batching(gpu_id):
+        return 1
+    return memory_planner.max_batch_size(request, gpu_id)
+
+def generation_gpu_capacity(gpu_id: int) -> int:
+    """支持连续批处理的工作进程可同时执行多个任务，否则按固定并发"""
+    if continuous_batching(gpu_id):
+        return MAX_ACTIVE_JOBS
+    return int(os.getenv("SKYREELS_MAX_CONCURRENT_PER_GPU", "1"))
+
+MAX_ACTIVE_JOBS = int(os.getenv("SKYREELS_MAX_ACTIVE_JOBS", "8"))
+
 gpu_detector = UnlimitedGPUDetector()
 memory_optimizer = MemoryOptimizer()
+memory_planner = MemoryPlanner()
+eta_estimator = ETAEstimator(os.getenv("SKYREELS_ETA_STATS", "/app/outputs/eta_stats.json") or None)
+# 调度器的GPU与工作进程一一对应（SKYREELS_WORKER_DEVICES可能与检测到的GPU数不同）
+worker_devices = detect_worker_devices()
+job_scheduler = GPUJobScheduler(
+    gpu_count=len(worker_devices),
+    max_concurrent_per_gpu=max(int(os.getenv("SKYREELS_MAX_CONCURRENT_PER_GPU", "1")), MAX_ACTIVE_JOBS),
+    max_queue_size=int(os.getenv("SKYREELS_MAX_QUEUE_SIZE", "100")),
+    batch_key=generation_batch_key,
+    batch_limit=generation_batch_limit,
+    gpu_capacity=generation_gpu_capacity,
+    admit=memory_planner.can_start,
+    preempt=lambda task_id: worker_pool.cancel(task_id, reason="preempted"),
+    admit_poll_seconds=float(os.getenv("SKYREELS_TELEMETRY_INTERVAL", "2.0"))
+)
+gpu_telemetry = GPUTelemetrySampler(
+    create_telemetry_backend(os.getenv("SKYREELS_TELEMETRY_BACKEND", "auto")),
+    interval=float(os.getenv("SKYREELS_TELEMETRY_INTERVAL", "2.0")),
+    history_size=int(os.getenv("SKYREELS_TELEMETRY_HISTORY", "300"))
+)
+worker_pool = GPUWorkerPool(
+    devices=worker_devices,
+    pipeline_name=os.getenv("SKYREELS_PIPELINE", "auto"),
+    mode=os.getenv("SKYREELS_EXECUTION_MODE", "process")
+)
 
 # 无限制视频生成请求模型
 class UnlimitedVideoRequest(BaseModel):
@@ -253,11 +3299,18 @@ class UnlimitedVideoRequest(BaseModel):
     enable_audio: bool = Field(default=True, description="启用音频生成")
     enable_upscaling: bool = Field(default=False, description="启用AI超分辨率")
     batch_size: int = Field(default=1, description="批处理大小", ge=1, le=4)
+    priority: int = Field(default=0, description="任务优先级，数值越大越先执行", ge=-10, le=10)
+    model: Optional[str] = Field(default=None, description="模型名称（见 /models/info），默认使用第一个配置的模型")
+    execution_plan: Optional[str] = Field(default=None, description="执行方案: full_gpu, full_gpu_tiled_vae, cpu_offload, cpu_offload_tiled_vae, cpu_offload_small_window，默认按显存自动选择")
+
+class BatchVideoRequest(BaseModel):
+    requests: List[UnlimitedVideoRequest] = Field(..., description="生成请求列表", min_length=1, max_length=32)
 
 class TaskStatus(BaseModel):
     task_id: str
     status: str  # "queued", "processing", "completed", "failed", "cancelled"
     progress: float = 0.0
+    stage: Optional[str] = None
     created_at: datetime
     updated_at: datetime
     estimated_completion: Optional[datetime] = None
@@ -266,10 +3319,471 @@ class TaskStatus(BaseModel):
     warnings: List[str] = []
     gpu_stats: Optional[Dict] = None
     generation_params: Optional[Dict] = None
+    queue_position: Optional[int] = None
+
+TASK_STATUSES = ("queued", "processing", "completed", "failed", "cancelled")
+ACTIVE_STATUSES = ("queued", "processing")
+# 只改变这些字段的更新是进度心跳，持久化存储可以节流写入
+PROGRESS_FIELDS = frozenset({"progress", "stage", "estimated_completion", "gpu_stats", "updated_at"})
+
+# 任务统计
+class TaskStatistics:
+    """随状态变化增量维护的任务计数，读取为O(1)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = {status: 0 for status in TASK_STATUSES}
+
+    def reset(self, counts: Dict[str, int]):
+        with self._lock:
+            self.counts = {status: 0 for status in TASK_STATUSES}
+            self.counts.update(counts)
+
+    def added(self, status: str):
+        with self._lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+    def removed(self, status: str):
+        with self._lock:
+            self.counts[status] = max(self.counts.get(status, 0) - 1, 0)
+
+    def transition(self, old_status: str, new_status: str):
+        if old_status == new_status:
+            return
+        with self._lock:
+            self.counts[old_status] = max(self.counts.get(old_status, 0) - 1, 0)
+            self.counts[new_status] = self.counts.get(new_status, 0) + 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = dict(self.counts)
+        total = sum(counts.values())
+        return dict(counts, total=total, success_rate=counts.get("completed", 0) / max(total, 1) * 100)
+
+RESULT_CACHE_STATUSES = ("queued", "processing", "completed")
+
+# 任务存储
+class TaskStore:
+    """任务存储接口，默认实现为进程内字典（重启后丢失）"""
+
+    def __init__(self):
+        self._tasks: Dict[str, TaskStatus] = {}
+        self.stats = TaskStatistics()
+        self.listeners: List[Callable[[TaskStatus], None]] = []  # 任务变更回调
+
+    def load(self):
+        """启动时调用"""
+
+    def close(self):
+        """关闭时调用"""
+
+    def __contains__(self, task_id: str) -> bool:
+        return self.get(task_id) is not None
+
+    def __len__(self) -> int:
+        return self.stats.total
+
+    def get(self, task_id: str) -> Optional[TaskStatus]:
+        return self._tasks.get(task_id)
+
+    def add(self, task: TaskStatus):
+        self._tasks[task.task_id] = task
+        self.stats.added(task.status)
+
+    def update(self, task_id: str, **changes) -> Optional[TaskStatus]:
+        """更新任务字段并持久化，自动刷新updated_at"""
+        task = self.get(task_id)
+        if task is None:
+            return None
+        changes.setdefault("updated_at", datetime.now())
+        if "status" in changes:
+            self.stats.transition(task.status, changes["status"])
+        for field, value in changes.items():
+            setattr(task, field, value)
+        self._save(task, progress_only=changes.keys() <= PROGRESS_FIELDS)
+        for listener in self.listeners:
+            listener(task)
+        return task
+
+    def _save(self, task: TaskStatus, progress_only: bool = False):
+        pass
+
+    def delete(self, task_id: str):
+        task = self._tasks.pop(task_id, None)
+        if task is not None:
+            self.stats.removed(task.status)
+
+    def list_tasks(self, limit: int = 50, status: Optional[str] = None,
+                   cursor: Optional[str] = None) -> Tuple[List[TaskStatus], Optional[str]]:
+        """按创建时间倒序分页，返回 (任务列表, 下一页游标)"""
+        tasks = [t for t in self._tasks.values() if status is None or t.status == status]
+        tasks.sort(key=lambda t: (t.created_at.timestamp(), t.task_id), reverse=True)
+        if cursor:
+            after = self._decode_cursor(cursor)
+            tasks = [t for t in tasks if (t.created_at.timestamp(), t.task_id) < after]
+        page = tasks[:limit]
+        next_cursor = self._encode_cursor(page[-1]) if len(tasks) > limit else None
+        return page, next_cursor
+
+    def find_by_status(self, statuses: Tuple[str, ...]) -> List[TaskStatus]:
+        """按创建时间正序返回指定状态的任务"""
+        tasks = [t for t in self._tasks.values() if t.status in statuses]
+        return sorted(tasks, key=lambda t: t.created_at)
+
+    def find_by_cache_key(self, cache_key: str) -> Optional[TaskStatus]:
+        """返回结果缓存键相同的最新一个排队中、执行中或已完成的任务"""
+        tasks = [t for t in self._tasks.values()
+                 if t.generation_params.get("cache_key") == cache_key and t.status in RESULT_CACHE_STATUSES]
+        return max(tasks, key=lambda t: t.created_at, default=None)
+
+    def prune(self, keep: int) -> List[TaskStatus]:
+        """删除最旧的已结束任务，只保留最近keep个，返回被删除的任务"""
+        finished = sorted((t for t in self._tasks.values() if t.status not in ACTIVE_STATUSES),
+                          key=lambda t: t.created_at)
+        removed = finished[:max(len(self) - keep, 0)]
+        for task in removed:
+            self.delete(task.task_id)
+        return removed
+
+    @staticmethod
+    def _encode_cursor(task: TaskStatus) -> str:
+        raw = f"{task.created_at.timestamp()!r}|{task.task_id}"
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor: str) -> Tuple[float, str]:
+        try:
+            created_at, task_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+            return float(created_at), task_id
+        except Exception:
+            raise ValueError("无效的分页游标")
+
+# SQLite任务存储
+class SQLiteTaskStore(TaskStore):
+    """SQLite(WAL)持久化任务存储：活跃任务常驻内存，历史任务按需加载
+
+    进度心跳（只改变PROGRESS_FIELDS的更新）每个任务最多每progress_save_seconds写一次库，
+    内存中的任务和订阅者仍每次更新；状态变化立即写入，未写入的进度在关闭时补写。
+    """
+
+    def __init__(self, db_path: str, cache_size: int = 1000, progress_save_seconds: float = 5.0):
+        super().__init__()
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self.progress_save_seconds = progress_save_seconds
+        self._saved_at: Dict[str, float] = {}  # 活跃任务最近一次写库的时间
+        self._unsaved: Set[str] = set()  # 有未写库进度的活跃任务
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+        self._cache: "OrderedDict[str, TaskStatus]" = OrderedDict()  # 已结束任务的LRU缓存
+
+    def load(self):
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                data TEXT NOT NULL
+            )
+        """)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(tasks)")}
+        if "cache_key" not in columns:
+            self._conn.execute("ALTER TABLE tasks ADD COLUMN cache_key TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_created ON tasks (created_at, task_id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_cache_key ON tasks (cache_key, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_status_created ON tasks (status, created_at, task_id)")
+        
+        # 只加载活跃任务，历史任务在访问时再读取
+        placeholders = ",".join("?" * len(ACTIVE_STATUSES))
+        rows = self._conn.execute(f"SELECT data FROM tasks WHERE status IN ({placeholders})", ACTIVE_STATUSES)
+        for (data,) in rows:
+            task = TaskStatus.model_validate_json(data)
+            self._tasks[task.task_id] = task
+        
+        # 启动时统计一次，之后随状态变化增量更新
+        self.stats.reset(dict(self._conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()))
+        logger.info(f"🗄️  任务存储已加载: {self.db_path} (活跃任务 {len(self._tasks)} 个)")
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                for task_id in list(self._unsaved):
+                    task = self._tasks.get(task_id)
+                    if task is not None:
+                        self._save(task)
+            self._conn.close()
+            self._conn = None
+
+    def get(self, task_id: str) -> Optional[TaskStatus]:
+        task = self._tasks.get(task_id)
+        if task is not None:
+            return task
+        with self._lock:
+            task = self._cache.get(task_id)
+            if task is not None:
+                self._cache.move_to_end(task_id)
+                return task
+            row = self._conn.execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                return None
+            task = TaskStatus.model_validate_json(row[0])
+            self._remember(task)
+            return task
+
+    def _remember(self, task: TaskStatus):
+        """活跃任务常驻内存，已结束任务进入LRU缓存"""
+        if task.status in ACTIVE_STATUSES:
+            self._cache.pop(task.task_id, None)
+            self._tasks[task.task_id] = task
+            return
+        self._tasks.pop(task.task_id, None)
+        self._cache[task.task_id] = task
+        self._cache.move_to_end(task.task_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def add(self, task: TaskStatus):
+        self._save(task)
+        self.stats.added(task.status)
+
+    def _save(self, task: TaskStatus, progress_only: bool = False):
+        now = time.monotonic()
+        with self._lock:
+            if (progress_only and task.task_id in self._tasks
+                    and now - self._saved_at.get(task.task_id, 0.0) < self.progress_save_seconds):
+                self._unsaved.add(task.task_id)
+                return
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, status, created_at, updated_at, cache_key, data) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (task.task_id, task.status, task.created_at.timestamp(), task.updated_at.timestamp(),
+                 task.generation_params.get("cache_key"), task.model_dump_json())
+            )
+            self._unsaved.discard(task.task_id)
+            if task.status in ACTIVE_STATUSES:
+                self._saved_at[task.task_id] = now
+            else:
+                self._saved_at.pop(task.task_id, None)
+            self._remember(task)
+
+    def delete(self, task_id: str):
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            self._conn.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+            self._tasks.pop(task_id, None)
+            self._cache.pop(task_id, None)
+            self._saved_at.pop(task_id, None)
+            self._unsaved.discard(task_id)
+        if row is not None:
+            self.stats.removed(row[0])
+
+    def list_tasks(self, limit: int = 50, status: Optional[str] = None,
+                   cursor: Optional[str] = None) -> Tuple[List[TaskStatus], Optional[str]]:
+        clauses, params = [], []
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if cursor:
+            clauses.append("(created_at, task_id) < (?, ?)")
+            params.extend(self._decode_cursor(cursor))
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT task_id, data FROM tasks {where} ORDER BY created_at DESC, task_id DESC LIMIT ?",
+                (*params, limit + 1)
+            ).fetchall()
+        
+        # 活跃任务优先返回内存中的对象
+        tasks = [self._tasks.get(task_id) or TaskStatus.model_validate_json(data) for task_id, data in rows[:limit]]
+        next_cursor = self._encode_cursor(tasks[-1]) if len(rows) > limit else None
+        return tasks, next_cursor
+
+    def find_by_status(self, statuses: Tuple[str, ...]) -> List[TaskStatus]:
+        placeholders = ",".join("?" * len(statuses))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT task_id, data FROM tasks WHERE status IN ({placeholders}) ORDER BY created_at",
+                statuses
+            ).fetchall()
+        return [self._tasks.get(task_id) or TaskStatus.model_validate_json(data) for task_id, data in rows]
+
+    def find_by_cache_key(self, cache_key: str) -> Optional[TaskStatus]:
+        placeholders = ",".join("?" * len(RESULT_CACHE_STATUSES))
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT task_id FROM tasks WHERE cache_key = ? AND status IN ({placeholders}) "
+                "ORDER BY created_at DESC LIMIT 1",
+                (cache_key, *RESULT_CACHE_STATUSES)
+            ).fetchone()
+        return self.get(row[0]) if row else None
+
+    def prune(self, keep: int) -> List[TaskStatus]:
+        placeholders = ",".join("?" * len(ACTIVE_STATUSES))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT data FROM tasks WHERE status NOT IN ({placeholders}) ORDER BY created_at LIMIT ?",
+                (*ACTIVE_STATUSES, max(len(self) - keep, 0))
+            ).fetchall()
+            removed = [TaskStatus.model_validate_json(data) for (data,) in rows]
+            for task in removed:
+                self.delete(task.task_id)
+        return removed
+
+def create_task_store() -> TaskStore:
+    backend = os.getenv("SKYREELS_TASK_STORE", "sqlite")
+    if backend == "memory":
+        return TaskStore()
+    return SQLiteTaskStore(os.getenv("SKYREELS_TASK_DB", "/app/outputs/tasks.db"),
+                           progress_save_seconds=float(os.getenv("SKYREELS_TASK_PROGRESS_SAVE_SECONDS", "5")))
+
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+# 结果缓存
+RESULT_CACHE_FIELDS = ("prompt", "resolution", "duration", "fps", "guidance_scale",
+                       "num_inference_steps", "seed", "model", "enable_audio", "segment_frames")
+VIDEO_FILE_PATTERN = re.compile(r"^skyreels_unlimited_([0-9a-f-]{36})_")
+
+def result_cache_key(generation_params: Dict[str, Any]) -> Optional[str]:
+    """固定seed时输出由生成参数完全决定，返回参数的规范化哈希；未设置seed时不缓存"""
+    if generation_params.get("seed") is None:
+        return None
+    canonical = json.dumps({field: generation_params.get(field) for field in RESULT_CACHE_FIELDS},
+                           sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def enforce_video_cache_limit(max_bytes: int) -> List[str]:
+    """视频目录超过上限时按最近使用时间（mtime）淘汰最旧的视频，返回被淘汰任务ID"""
+    videos = []
+    for path in Path("/app/outputs/videos").glob("*.mp4"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        videos.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in videos)
+    if total <= max_bytes:
+        return []
+    
+    evicted = []
+    for _, size, path in sorted(videos):
+        if total <= max_bytes:
+            break
+        match = VIDEO_FILE_PATTERN.match(path.name)
+        if match and match.group(1) in current_tasks:
+            continue
+        path.unlink(missing_ok=True)
+        total -= size
+        if match:
+            evicted.append(match.group(1))
+    logger.info(f"🧹 视频缓存超出上限，已淘汰 {len(evicted)} 个视频，剩余 {total / 1024**3:.1f}GB")
+    return evicted
+
+# 进度推送中心
+class ProgressHub:
+    """任务进度推送：每个tick合并一次状态变化，只推送变化字段，
+    每个任务每tick只序列化一次再分发给全部订阅者"""
+
+    def __init__(self, tick_seconds: float = 1.0, queue_size: int = 100, keepalive_seconds: float = 15.0):
+        self.tick_seconds = tick_seconds
+        self.queue_size = queue_size
+        self.keepalive_seconds = keepalive_seconds  # SSE连接无消息时发送注释行保活的间隔
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._latest: Dict[str, Dict[str, Any]] = {}
+        self._published: Dict[str, Dict[str, Any]] = {}
+        self._dirty: Set[str] = set()
+        self._runner: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def snapshot(task: TaskStatus) -> Dict[str, Any]:
+        return {
+            "status": task.status,
+            "progress": round(task.progress, 3),
+            "stage": task.stage,
+            "estimated_completion": task.estimated_completion.isoformat() if task.estimated_completion else None,
+            "error": task.error
+        }
+
+    def new_queue(self) -> asyncio.Queue:
+        return asyncio.Queue(maxsize=self.queue_size)
+
+    def subscribe(self, task: TaskStatus, subscriber: asyncio.Queue):
+        """订阅任务并立即推送一次完整状态"""
+        subscribers = self._subscribers.setdefault(task.task_id, set())
+        if not subscribers:
+            self._published[task.task_id] = self.snapshot(task)
+        subscribers.add(subscriber)
+        message = dict(self.snapshot(task), task_id=task.task_id)
+        self._put(subscriber, (json.dumps(message, ensure_ascii=False), task.status in TERMINAL_STATUSES))
+
+    def unsubscribe(self, task_id: str, subscriber: asyncio.Queue):
+        subscribers = self._subscribers.get(task_id)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._subscribers[task_id]
+            self._published.pop(task_id, None)
+            self._latest.pop(task_id, None)
+            self._dirty.discard(task_id)
+
+    def notify(self, task: TaskStatus):
+        """任务存储变更回调，无人订阅时为空操作"""
+        if task.task_id in self._subscribers:
+            self._latest[task.task_id] = self.snapshot(task)
+            self._dirty.add(task.task_id)
+
+    def flush(self):
+        for task_id in self._dirty:
+            latest = self._latest.pop(task_id)
+            published = self._published.setdefault(task_id, {})
+            delta = {key: value for key, value in latest.items() if published.get(key) != value}
+            if not delta:
+                continue
+            published.update(delta)
+            payload = (json.dumps(dict(delta, task_id=task_id), ensure_ascii=False),
+                       latest["status"] in TERMINAL_STATUSES)
+            for subscriber in self._subscribers.get(task_id, ()):
+                self._put(subscriber, payload)
+        self._dirty.clear()
+
+    @staticmethod
+    def _put(subscriber: asyncio.Queue, payload):
+        # 慢消费者丢弃最旧的消息，不阻塞其他订阅者
+        if subscriber.full():
+            subscriber.get_nowait()
+        subscriber.put_nowait(payload)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick_seconds)
+            self.flush()
+
+    def start(self):
+        self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            await asyncio.gather(self._runner, return_exceptions=True)
 
 # 全局状态管理
-task_queue: Dict[str, TaskStatus] = {}
+task_store = create_task_store()
+progress_hub = ProgressHub(tick_seconds=float(os.getenv("SKYREELS_EVENT_TICK_SECONDS", "1.0")),
+                           keepalive_seconds=float(os.getenv("SKYREELS_EVENT_KEEPALIVE_SECONDS", "15")))
+task_store.listeners.append(progress_hub.notify)
 current_tasks: List[str] = []  # 支持并发任务
+resume_checkpoints: Dict[str, Dict[str, Any]] = {}  # 被抢占或因重启中断的任务的checkpoint，重新开始时继续
+RESULT_CACHE_MAX_BYTES = int(float(os.getenv("SKYREELS_RESULT_CACHE_GB", "500")) * 1024**3)  # 0为不限制
 
 # FastAPI应用初始化
 app = FastAPI(
@@ -304,17 +3818,54 @@ async def startup_event():
     memory_optimizer.optimize_model_loading()
     
     # 创建输出目录
-    for dir_name in ["videos", "temp", "audio", "logs"]:
+    for dir_name in ["videos", "temp", "audio", "logs", "streams"]:
         dir_path = Path(f"/app/outputs/{dir_name}")
         dir_path.mkdir(parents=True, exist_ok=True)
     
+    # 加载任务存储，启动GPU遥测
+    task_store.load()
+    gpu_telemetry.start()
+    
+    # 启动GPU工作进程池和任务调度器
+    worker_pool.start()
+    job_scheduler.start(process_unlimited_video_generation)
+    progress_hub.start()
+    
+    # 重新排队重启前未完成的任务
+    await requeue_unfinished_tasks()
+    
     logger.info("✅ SkyReels V2 Unlimited API 服务器启动完成")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """应用关闭时停止调度器和工作进程"""
+    await progress_hub.stop()
+    await job_scheduler.stop()
+    await worker_pool.stop()
+    gpu_telemetry.stop()
+    task_store.close()
+
+async def requeue_unfinished_tasks():
+    """重启后恢复排队中和中断的任务"""
+    unfinished = task_store.find_by_status(ACTIVE_STATUSES)
+    for task in unfinished:
+        request = UnlimitedVideoRequest(**task.generation_params)
+        # 有checkpoint的任务只需重新生成中断时正在进行的分段
+        checkpoint = await asyncio.to_thread(read_checkpoint, task.task_id)
+        if checkpoint is not None:
+            resume_checkpoints[task.task_id] = checkpoint
+            logger.info(f"♻️  任务 {task.task_id} 将从checkpoint继续 (第 {checkpoint['segment_index'] + 1}/{checkpoint['num_segments']} 段)")
+        task_store.update(task.task_id, status="queued", progress=0.0, stage=None)
+        await job_scheduler.submit(task.task_id, request, priority=request.priority, enforce_limit=False)
+    if unfinished:
+        logger.info(f"♻️  已重新排队 {len(unfinished)} 个未完成任务")
+
 @app.get("/health")
 async def health_check():
     """健康检查端点"""
-    memory_info = memory_optimizer.get_gpu_memory_info()
+    memory_info = gpu_telemetry.latest()
     system_memory = psutil.virtual_memory()
+    stats = task_store.stats.snapshot()
     
     return {
         "status": "healthy",
@@ -331,13 +3882,15 @@ async def health_check():
             }
         },
         "tasks": {
-            "total": len(task_queue),
+            "total": stats["total"],
             "active": len(current_tasks),
-            "queued": len([t for t in task_queue.values() if t.status == "queued"]),
-            "processing": len([t for t in task_queue.values() if t.status == "processing"]),
-            "completed": len([t for t in task_queue.values() if t.status == "completed"]),
-            "failed": len([t for t in task_queue.values() if t.status == "failed"])
+            "queued": stats["queued"],
+            "processing": stats["processing"],
+            "completed": stats["completed"],
+            "failed": stats["failed"]
         },
+        "scheduler": job_scheduler.stats(),
+        "workers": worker_pool.stats(),
         "capabilities": {
             "max_resolution": gpu_detector.max_resolution,
             "max_duration": gpu_detector.max_duration,
@@ -347,6 +3900,19 @@ async def health_check():
         }
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus指标"""
+    scheduler_stats = job_scheduler.stats()
+    QUEUE_DEPTH.set(scheduler_stats["queued"])
+    RUNNING_TASKS.set(scheduler_stats["running"])
+    stats = task_store.stats.snapshot()
+    for status in TASK_STATUSES:
+        TASKS_BY_STATUS.labels(status=status).set(stats[status])
+    for gpu in gpu_telemetry.latest()["gpus"]:
+        update_gpu_high_water(str(gpu["gpu_id"]), gpu["allocated"] * 1024**3)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/models/info")
 async def get_model_info():
     """获取模型信息"""
@@ -365,21 +3931,67 @@ async def get_model_info():
             "实时进度监控",
             "批量处理支持"
         ],
-        "recommended_settings": gpu_detector._get_recommended_settings("1080p", 720)
+        "recommended_settings": gpu_detector._get_recommended_settings("1080p", 720),
+        "models": configured_models(),
+        "execution_plans": list(EXECUTION_PLANS)
     }
 
 @app.post("/generate")
-async def generate_video(request: UnlimitedVideoRequest, background_tasks: BackgroundTasks):
+async def generate_video(request: UnlimitedVideoRequest):
     """启动无限制视频生成任务"""
+    return await create_generation_task(request)
+
+@app.post("/generate/batch")
+async def generate_video_batch(batch: BatchVideoRequest):
+    """批量提交生成任务，参数兼容的任务由调度器合并为一次批量生成"""
+    free_slots = job_scheduler.max_queue_size - job_scheduler.stats()["queued"]
+    if len(batch.requests) > free_slots:
+        raise HTTPException(status_code=429, detail=f"任务队列剩余容量不足: 需要 {len(batch.requests)}，剩余 {free_slots}")
+    
+    # 先校验并规划全部任务，任何一个被拒绝时整批都不入队
+    prepared = [prepare_generation_task(request) for request in batch.requests]
+    tasks = []
+    try:
+        for item in prepared:
+            tasks.append(await enqueue_generation_task(item))
+    except HTTPException:
+        for task in tasks:
+            if not task["cached"]:
+                job_scheduler.cancel(task["task_id"])
+                task_store.delete(task["task_id"])
+        raise
+    return {"total": len(tasks), "tasks": tasks}
+
+async def create_generation_task(request: UnlimitedVideoRequest) -> Dict[str, Any]:
+    """创建任务并提交到调度器，返回接口响应"""
+    return await enqueue_generation_task(prepare_generation_task(request))
+
+def prepare_generation_task(request: UnlimitedVideoRequest) -> Dict[str, Any]:
+    """校验请求并选择执行方案，构造排队状态的任务（尚未写入任务存储），请求不合法或放不下时抛出HTTPException"""
     # 验证请求参数（仅获取建议，不阻止）
     validation = gpu_detector.validate_request(request.resolution, request.duration)
+    models = configured_models()
+    if request.model is not None and request.model not in models:
+        raise HTTPException(status_code=400, detail=f"未知模型: {request.model}，可用模型: {', '.join(models)}")
+    if request.execution_plan is not None and request.execution_plan not in EXECUTION_PLANS:
+        raise HTTPException(status_code=400, detail=f"未知执行方案: {request.execution_plan}，可用方案: {', '.join(EXECUTION_PLANS)}")
+    
+    # 按峰值显存和内存估算选择执行方案，任何方案都放不下时拒绝，而不是在渲染中途OOM
+    plan = memory_planner.plan(request)
+    if plan["plan"] is None:
+        ADMISSION_DECISIONS.labels(decision="rejected", plan="none").inc()
+        raise HTTPException(status_code=422, detail=plan["reason"])
+    request.execution_plan = plan["plan"]
+    ADMISSION_DECISIONS.labels(decision="admitted" if plan["fits_now"] else "deferred", plan=plan["plan"]).inc()
+    if not plan["fits_now"]:
+        validation["warnings"].append(plan["reason"])
     
     # 生成任务ID
     task_id = str(uuid.uuid4())
     
-    # 估算完成时间
-    estimated_duration = validation["estimated_time"]
-    estimated_completion = datetime.now() + timedelta(minutes=estimated_duration)
+    # 按历史生成速度估算执行时间，提交后再加上前面任务的排队等待
+    predicted_seconds, eta_basis = predict_generation_seconds(request)
+    estimated_completion = datetime.now() + timedelta(seconds=predicted_seconds)
     
     # 创建任务状态
     task_status = TaskStatus(
@@ -400,22 +4012,73 @@ async def generate_video(request: UnlimitedVideoRequest, background_tasks: Backg
             "seed": request.seed,
             "enable_audio": request.enable_audio,
             "enable_upscaling": request.enable_upscaling,
-            "batch_size": request.batch_size
+            "batch_size": request.batch_size,
+            "priority": request.priority,
+            "model": request.model or next(iter(models)),
+            "execution_plan": request.execution_plan,
+            "segment_frames": memory_planner.window_frames(request.execution_plan),
+            "memory_estimate": plan["estimate"],
+            "predicted_seconds": round(predicted_seconds, 1)
         }
     )
+    return {"request": request, "task": task_status, "plan": plan, "validation": validation,
+            "predicted_seconds": predicted_seconds, "eta_basis": eta_basis}
+
+async def enqueue_generation_task(prepared: Dict[str, Any]) -> Dict[str, Any]:
+    """把prepare_generation_task构造的任务写入任务存储并提交到调度器（或复用相同请求的任务），返回接口响应"""
+    request, task_status, plan = prepared["request"], prepared["task"], prepared["plan"]
+    validation, predicted_seconds = prepared["validation"], prepared["predicted_seconds"]
+    task_id = task_status.task_id
+    
+    # 固定seed的相同请求复用已有任务：执行中的合并到同一次执行，已完成的直接返回结果
+    cache_key = result_cache_key(task_status.generation_params)
+    if cache_key:
+        existing = task_store.find_by_cache_key(cache_key)
+        if existing is not None and existing.status == "completed":
+            if existing.result_path and Path(existing.result_path).exists():
+                os.utime(existing.result_path)  # 刷新最近使用时间
+            else:
+                existing = None
+        if existing is not None:
+            RESULT_CACHE_LOOKUPS.labels(result="hit" if existing.status == "completed" else "inflight").inc()
+            logger.info(f"♻️  复用任务 {existing.task_id} ({existing.status})")
+            return {
+                "task_id": existing.task_id,
+                "status": existing.status,
+                "message": "相同请求已生成，直接返回结果" if existing.status == "completed" else "相同请求正在生成，已合并到该任务",
+                "cached": True,
+                "estimated_completion": existing.estimated_completion.isoformat() if existing.estimated_completion else None,
+                "queue_position": job_scheduler.queue_position(existing.task_id),
+                "stream_url": f"/tasks/{existing.task_id}/stream/playlist.m3u8"
+            }
+        RESULT_CACHE_LOOKUPS.labels(result="miss").inc()
+        task_status.generation_params["cache_key"] = cache_key
     
-    task_queue[task_id] = task_status
+    task_store.add(task_status)
     
-    # 添加后台任务
-    background_tasks.add_task(process_unlimited_video_generation, task_id, request)
+    # 提交到调度器，队列满时拒绝
+    try:
+        queue_position = await job_scheduler.submit(task_id, request, priority=request.priority)
+    except QueueFullError as e:
+        task_store.delete(task_id)
+        raise HTTPException(status_code=429, detail=str(e))
+    refresh_queue_etas()
+    estimated_completion = task_store.get(task_id).estimated_completion
+    queue_wait = (estimated_completion - task_status.created_at).total_seconds() - predicted_seconds
     
     response = {
         "task_id": task_id,
         "status": "queued",
         "message": f"无限制视频生成任务已排队 - {request.resolution} {request.duration//60}分钟{request.duration%60}秒",
         "estimated_completion": estimated_completion.isoformat(),
-        "estimated_duration_minutes": estimated_duration,
-        "queue_position": len([t for t in task_queue.values() if t.status == "queued"])
+        "estimated_duration_minutes": round(predicted_seconds / 60, 1),
+        "estimated_wait_minutes": round(max(queue_wait, 0.0) / 60, 1),
+        "eta_basis": prepared["eta_basis"],
+        "queue_position": queue_position,
+        "stream_url": f"/tasks/{task_id}/stream/playlist.m3u8",
+        "cached": False,
+        "execution_plan": request.execution_plan,
+        "memory_estimate": plan["estimate"]
     }
     
     # 添加警告信息
@@ -427,172 +4090,396 @@ async def generate_video(request: UnlimitedVideoRequest, background_tasks: Backg
     
     return response
 
-async def process_unlimited_video_generation(task_id: str, request: UnlimitedVideoRequest):
-    """处理无限制视频生成的后台任务"""
-    try:
-        # 更新任务状态
-        task_queue[task_id].status = "processing"
-        task_queue[task_id].updated_at = datetime.now()
+async def process_unlimited_video_generation(batch: List[Tuple[str, UnlimitedVideoRequest]], gpu_id: int = 0):
+    """处理一批无限制视频生成任务（由调度器工作协程调用，批内任务参数兼容）"""
+    items = []
+    timings: Dict[str, Dict[str, Any]] = {}
+    for task_id, request in batch:
+        task = task_store.get(task_id)
+        if task is None or task.status != "queued":
+            continue
+        task_store.update(task_id, status="processing")
         current_tasks.append(task_id)
+        memory_planner.reserve(task_id, request, gpu_id)
         
-        logger.info(f"🎬 开始无限制视频生成 (任务ID: {task_id})")
+        logger.info(f"🎬 开始无限制视频生成 (任务ID: {task_id}, GPU: {gpu_id})")
         logger.info(f"📋 参数: {request.resolution}, {request.duration}s, 质量: {request.quality}")
         logger.info(f"🎯 提示词: {request.prompt[:100]}...")
         
-        # 清理内存
-        memory_optimizer.clear_cache()
-        
-        # 模拟无限制视频生成过程
-        total_steps = 100
-        for step in range(total_steps + 1):
-            await asyncio.sleep(0.5)  # 模拟处理时间
-            
-            progress = step / total_steps
-            task_queue[task_id].progress = progress
-            task_queue[task_id].updated_at = datetime.now()
-            task_queue[task_id].gpu_stats = memory_optimizer.get_gpu_memory_info()
-            
-            # 模拟不同阶段
-            if step < 20:
-                stage = "初始化模型和参数"
-            elif step < 40:
-                stage = "生成视频关键帧"
-            elif step < 70:
-                stage = "插值和细节优化"
-            elif step < 90:
-                stage = "音频生成和同步" if request.enable_audio else "最终渲染"
-            else:
-                stage = "后处理和输出"
-            
-            if step % 10 == 0:
-                logger.info(f"📈 任务 {task_id} 进度: {step}% - {stage}")
-        
-        # 生成输出文件路径
-        timestamp = int(datetime.now().timestamp())
-        filename = f"skyreels_unlimited_{task_id}_{timestamp}_{request.resolution}_{request.duration}s.mp4"
-        output_path = f"/app/outputs/videos/{filename}"
+        predicted_seconds, _ = predict_generation_seconds(request, gpu_id)
+        timing = {"started": time.monotonic(), "stage": None, "stage_started": time.monotonic(), "stages": {},
+                  "denoise": None, "predicted_seconds": predicted_seconds}
+        timings[task_id] = timing
         
-        # 模拟文件生成
-        Path(output_path).touch()  # 创建占位文件
+        def on_progress(message: Dict[str, Any], task_id: str = task_id, timing: Dict[str, Any] = timing):
+            task = task_store.get(task_id)
+            if task is None:
+                return
+            now = time.monotonic()
+            if message["stage"] != timing["stage"]:
+                if timing["stage"] is not None:
+                    timing["stages"][timing["stage"]] = timing["stages"].get(timing["stage"], 0.0) + now - timing["stage_started"]
+                timing["stage"], timing["stage_started"] = message["stage"], now
+            remaining = timing["predicted_seconds"] - (now - timing["started"])
+            if message["stage"] == "denoise":
+                # 用实际去噪进度速率外推剩余时间，收尾阶段按预估的比例补上
+                if timing["denoise"] is None:
+                    timing["denoise"] = (now, message["progress"])
+                started_at, started_progress = timing["denoise"]
+                if message["progress"] - started_progress >= 0.01:
+                    rate = (message["progress"] - started_progress) / (now - started_at)
+                    remaining = (0.95 - message["progress"]) / rate + timing["predicted_seconds"] * 0.05
+            stage = GENERATION_STAGES.get(message["stage"], message["stage"])
+            if stage != task.stage:
+                logger.info(f"📈 任务 {task_id} 进度: {int(message['progress'] * 100)}% - {stage}")
+            task_store.update(
+                task_id,
+                progress=message["progress"],
+                stage=stage,
+                estimated_completion=datetime.now() + timedelta(seconds=max(remaining, 0.0)),
+                gpu_stats=gpu_telemetry.latest()
+            )
         
-        # 如果启用音频，创建音频文件
-        if request.enable_audio:
-            audio_path = f"/app/outputs/audio/audio_{task_id}.wav"
-            Path(audio_path).touch()
-        
-        # 完成任务
-        task_queue[task_id].status = "completed"
-        task_queue[task_id].result_path = output_path
-        task_queue[task_id].progress = 1.0
-        task_queue[task_id].updated_at = datetime.now()
+        job = dict(task.generation_params, task_id=task_id)
+        if task_id in resume_checkpoints:
+            job["resume"] = resume_checkpoints.pop(task_id)
+        items.append((task_id, job, on_progress))
+    if not items:
+        return
+    if len(items) > 1:
+        logger.info(f"📦 合批执行 {len(items)} 个任务 (GPU: {gpu_id})")
+    
+    try:
+        # 派发到GPU工作进程执行，事件循环只接收进度消息
+        try:
+            borrowed = []
+            if len(items) == 1 and worker_pool.can_pipeline() and not items[0][1].get("resume"):
+                # 流水线的分段也在其他GPU上执行：占用那些GPU的执行槽位并预留显存，放不下的GPU不参与
+                task_id = items[0][0]
+                request = next(request for batch_task_id, request in batch if batch_task_id == task_id)
+                borrowed = job_scheduler.occupy(
+                    task_id, request, [other for other in range(job_scheduler.gpu_count) if other != gpu_id])
+                for other in borrowed:
+                    memory_planner.reserve(f"{task_id}@{other}", request, other)
+            if borrowed:
+                results = await asyncio.gather(
+                    worker_pool.run_pipelined(gpu_id, *items[0], gpu_ids=[gpu_id] + borrowed), return_exceptions=True)
+            else:
+                results = await worker_pool.run_batch(gpu_id, items)
+        except Exception as e:
+            results = [e] * len(items)
         
-        logger.info(f"✅ 无限制视频生成完成 (任务ID: {task_id})")
-        logger.info(f"📁 输出文件: {output_path}")
+        for (task_id, _, _), result in zip(items, results):
+            request = next(request for batch_task_id, request in batch if batch_task_id == task_id)
+            # 先重新读取任务：工作进程报告抢占与协程恢复之间到达的取消请求优先，不能被重新排队覆盖
+            task = task_store.get(task_id)
+            if task is None or task.status == "cancelled":
+                # 已取消的任务丢弃结果、直播分段和checkpoint，不覆盖取消状态
+                logger.info(f"⏹️  任务 {task_id} 已取消")
+                if isinstance(result, str):
+                    Path(result).unlink(missing_ok=True)
+                shutil.rmtree(stream_dir_for(task_id), ignore_errors=True)
+                remove_checkpoint(task_id)
+                continue
+            if isinstance(result, TaskInterrupted) and result.reason == "preempted":
+                # 被更高优先级任务抢占：保存checkpoint后按原优先级重新排队
+                if result.checkpoint is not None:
+                    resume_checkpoints[task_id] = result.checkpoint
+                task_store.update(task_id, status="queued", stage=None)
+                await job_scheduler.submit(task_id, request, priority=request.priority, enforce_limit=False)
+                resumed_from = result.checkpoint["segment_index"] if result.checkpoint else 0
+                logger.info(f"⏸️  任务 {task_id} 已被抢占，重新排队 (将从第 {resumed_from + 1} 段继续)")
+                continue
+            if isinstance(result, BaseException):
+                logger.error(f"❌ 无限制视频生成失败 (任务ID: {task_id}): {str(result)}")
+                remove_checkpoint(task_id)
+                task_store.update(task_id, status="failed", error=str(result))
+                continue
+            
+            # 记录分阶段耗时用于之后的完成时间估算
+            timing = timings[task_id]
+            if timing["stage"] is not None:
+                timing["stages"][timing["stage"]] = timing["stages"].get(timing["stage"], 0.0) + time.monotonic() - timing["stage_started"]
+            eta_estimator.record(request.resolution, request.num_inference_steps, worker_gpu_name(gpu_id),
+                                 request.duration * request.fps, timing["stages"])
+            ETA_ERROR_RATIO.observe((time.monotonic() - timing["started"]) / max(timing["predicted_seconds"], 1e-6))
+            
+            # 完成任务
+            task_store.update(task_id, status="completed", result_path=result, progress=1.0,
+                              estimated_completion=datetime.now())
+            logger.info(f"✅ 无限制视频生成完成 (任务ID: {task_id})")
+            logger.info(f"📁 输出文件: {result}")
         
-    except Exception as e:
-        logger.error(f"❌ 无限制视频生成失败 (任务ID: {task_id}): {str(e)}")
-        task_queue[task_id].status = "failed"
-        task_queue[task_id].error = str(e)
-        task_queue[task_id].updated_at = datetime.now()
+        if RESULT_CACHE_MAX_BYTES > 0:
+            for evicted_id in await asyncio.to_thread(enforce_video_cache_limit, RESULT_CACHE_MAX_BYTES):
+                evicted = task_store.get(evicted_id)
+                if evicted is not None:
+                    task_store.update(evicted_id, result_path=None, warnings=evicted.warnings + ["视频文件已被缓存容量淘汰"])
     finally:
         # 从当前任务列表移除
-        if task_id in current_tasks:
-            current_tasks.remove(task_id)
-        # 清理内存
-        memory_optimizer.clear_cache()
+        for task_id, _, _ in items:
+            memory_planner.release(task_id)
+            job_scheduler.vacate(task_id)
+            if task_id in current_tasks:
+                current_tasks.remove(task_id)
+        refresh_queue_etas()
 
 @app.get("/tasks/{task_id}/status")
 async def get_task_status(task_id: str):
     """获取任务状态"""
-    if task_id not in task_queue:
+    task = task_store.get(task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail="任务未找到")
     
-    return task_queue[task_id]
+    task.queue_position = job_scheduler.queue_position(task_id)
+    return task
 
-@app.get("/tasks")
-async def get_all_tasks(limit: int = 50, status: Optional[str] = None):
-    """获取任务列表"""
-    tasks = list(task_queue.values())
+@app.get("/tasks/{task_id}/events")
+async def task_events(task_id: str):
+    """SSE进度推送：状态、进度、阶段和预计完成时间变化时推送增量，任务结束后关闭"""
+    task = task_store.get(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="任务未找到")
+    
+    subscriber = progress_hub.new_queue()
+    progress_hub.subscribe(task, subscriber)
     
-    # 状态过滤
-    if status:
-        tasks = [t for t in tasks if t.status == status]
+    async def event_stream():
+        try:
+            while True:
+                try:
+                    data, finished = await asyncio.wait_for(subscriber.get(), timeout=progress_hub.keepalive_seconds)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: progress\ndata: {data}\n\n"
+                if finished:
+                    break
+        finally:
+            progress_hub.unsubscribe(task_id, subscriber)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.websocket("/ws/tasks")
+async def task_events_ws(websocket: WebSocket):
+    """多任务WebSocket进度推送，客户端发送 {"subscribe": [...], "unsubscribe": [...]}，任务结束的消息之后自动取消订阅"""
+    await websocket.accept()
+    subscriber = progress_hub.new_queue()
+    subscribed: Set[str] = set()
     
-    # 按创建时间排序
-    tasks.sort(key=lambda x: x.created_at, reverse=True)
+    async def pump():
+        while True:
+            data, finished = await subscriber.get()
+            await websocket.send_text(data)
+            if finished:
+                # 任务结束后不会再有变化，自动取消订阅
+                task_id = json.loads(data)["task_id"]
+                progress_hub.unsubscribe(task_id, subscriber)
+                subscribed.discard(task_id)
     
-    # 限制数量
-    tasks = tasks[:limit]
+    pump_task = asyncio.create_task(pump())
+    try:
+        while True:
+            message = await websocket.receive_json()
+            for task_id in message.get("subscribe", []):
+                task = task_store.get(task_id)
+                if task is None:
+                    await websocket.send_json({"task_id": task_id, "error": "任务未找到"})
+                    continue
+                progress_hub.subscribe(task, subscriber)
+                subscribed.add(task_id)
+            for task_id in message.get("unsubscribe", []):
+                progress_hub.unsubscribe(task_id, subscriber)
+                subscribed.discard(task_id)
+    except (WebSocketDisconnect, ValueError):
+        pass
+    finally:
+        pump_task.cancel()
+        for task_id in subscribed:
+            progress_hub.unsubscribe(task_id, subscriber)
+
+@app.get("/tasks")
+async def get_all_tasks(limit: int = 50, status: Optional[str] = None, cursor: Optional[str] = None):
+    """获取任务列表（按创建时间倒序，使用cursor翻页）"""
+    try:
+        tasks, next_cursor = task_store.list_tasks(limit=limit, status=status, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    stats = task_store.stats.snapshot()
     
     return {
         "tasks": tasks,
-        "total": len(task_queue),
+        "total": stats["total"],
         "filtered": len(tasks),
-        "statistics": {
-            "queued": len([t for t in task_queue.values() if t.status == "queued"]),
-            "processing": len([t for t in task_queue.values() if t.status == "processing"]),
-            "completed": len([t for t in task_queue.values() if t.status == "completed"]),
-            "failed": len([t for t in task_queue.values() if t.status == "failed"]),
-            "cancelled": len([t for t in task_queue.values() if t.status == "cancelled"])
-        }
+        "next_cursor": next_cursor,
+        "statistics": {status: stats[status] for status in TASK_STATUSES}
     }
 
-@app.get("/tasks/{task_id}/download")
-async def download_video(task_id: str):
-    """下载生成的视频"""
-    if task_id not in task_queue:
+@app.api_route("/tasks/{task_id}/download", methods=["GET", "HEAD"])
+async def download_video(task_id: str, request: Request):
+    """下载生成的视频（支持Range断点续传）"""
+    task = task_store.get(task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail="任务未找到")
     
-    task = task_queue[task_id]
     if task.status != "completed":
         raise HTTPException(status_code=400, detail=f"视频生成未完成，当前状态: {task.status}")
     
     if not task.result_path or not Path(task.result_path).exists():
         raise HTTPException(status_code=404, detail="视频文件未找到")
     
-    return FileResponse(
-        path=task.result_path,
-        filename=Path(task.result_path).name,
-        media_type="video/mp4"
+    result_path = Path(task.result_path)
+    return range_file_response(
+        result_path,
+        request,
+        "video/mp4",
+        headers={"Content-Disposition": f'attachment; filename="{result_path.name}"'}
+    )
+
+# HTTP Range文件响应
+STREAM_SEGMENT_PATTERN = re.compile(r"^segment_\d{5}\.ts$")
+
+class MeteredFileResponse(FileResponse):
+    """Starlette文件响应（Range、多段Range、If-Range、服务器支持时pathsend），按实际发送的字节计入BYTES_SERVED"""
+
+    chunk_size = 1024 * 1024  # 没有pathsend时每次读取的块大小，减少线程切换次数
+
+    def __init__(self, *args, endpoint: str = "download", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.endpoint = endpoint
+
+    async def __call__(self, scope, receive, send):
+        served = BYTES_SERVED.labels(endpoint=self.endpoint)
+        
+        async def metered_send(message):
+            if message["type"] == "http.response.body":
+                served.inc(len(message.get("body", b"")))
+            elif message["type"] == "http.response.pathsend":
+                served.inc(self.stat_result.st_size)
+            await send(message)
+        
+        await super().__call__(scope, receive, metered_send)
+
+def range_file_response(path: Path, request: Request, media_type: str,
+                        headers: Optional[Dict[str, str]] = None, endpoint: str = "download") -> Response:
+    """支持Range、If-Range和ETag条件请求的文件响应，用于断点续传"""
+    stat = path.stat()
+    # ETag基于文件身份（inode、大小、修改时间），文件被替换后自动失效；FileResponse据此判断If-Range
+    etag = f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    
+    # FileResponse不处理If-None-Match
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag,
+                                                  "Last-Modified": formatdate(stat.st_mtime, usegmt=True)})
+    
+    # 前置nginx时只返回内部URI，文件由nginx用sendfile发送（Range、If-Range也由nginx处理）
+    accel_uri = accel_redirect_uri(path, request)
+    if accel_uri is not None:
+        return Response(headers=dict(headers or {}, ETag=etag, **{"X-Accel-Redirect": accel_uri}),
+                        media_type=media_type)
+    
+    return MeteredFileResponse(path, headers=dict(headers or {}, ETag=etag), media_type=media_type,
+                               stat_result=stat, endpoint=endpoint)
+
+def accel_redirect_uri(path: Path, request: Request) -> Optional[str]:
+    """nginx声明 X-Sendfile-Type: X-Accel-Redirect 时，按 X-Accel-Mapping（本地目录=内部URI前缀，逗号分隔）映射文件路径
+
+    uvicorn没有零拷贝发送，直连时文件由FileResponse分块读取发送；经nginx时改为X-Accel-Redirect，
+    由nginx从同一卷sendfile。这部分字节不计入BYTES_SERVED，以nginx访问日志为准。
+    """
+    if request.headers.get("x-sendfile-type", "").lower() != "x-accel-redirect":
+        return None
+    resolved = path.resolve()
+    for mapping in request.headers.get("x-accel-mapping", "").split(","):
+        local, _, internal = mapping.partition("=")
+        if not local.strip() or not internal.strip():
+            continue
+        local_dir = Path(local.strip()).resolve()
+        if resolved.is_relative_to(local_dir):
+            return internal.strip().rstrip("/") + "/" + quote(resolved.relative_to(local_dir).as_posix())
+    return None
+
+@app.get("/tasks/{task_id}/stream/playlist.m3u8")
+async def get_stream_playlist(task_id: str):
+    """获取生成中视频的HLS直播播放列表（随分段完成持续增长）"""
+    if task_store.get(task_id) is None:
+        raise HTTPException(status_code=404, detail="任务未找到")
+    
+    playlist_path = stream_dir_for(task_id) / "playlist.m3u8"
+    if not playlist_path.exists():
+        raise HTTPException(status_code=404, detail="尚无已完成的视频分段")
+    
+    return Response(
+        content=playlist_path.read_text(),
+        media_type="application/vnd.apple.mpegurl",
+        headers={"Cache-Control": "no-cache"}
     )
 
+@app.get("/tasks/{task_id}/stream/{segment_name}")
+async def get_stream_segment(task_id: str, segment_name: str, request: Request):
+    """下载单个HLS分段，支持Range"""
+    if task_store.get(task_id) is None:
+        raise HTTPException(status_code=404, detail="任务未找到")
+    if not STREAM_SEGMENT_PATTERN.match(segment_name):
+        raise HTTPException(status_code=404, detail="分段未找到")
+    
+    segment_path = stream_dir_for(task_id) / segment_name
+    if not segment_path.exists():
+        raise HTTPException(status_code=404, detail="分段未找到")
+    
+    # 分段写完后不再变化，可长期缓存
+    return range_file_response(segment_path, request, "video/mp2t",
+                               headers={"Cache-Control": "max-age=86400"}, endpoint="stream")
+
+def remove_task_files(task: TaskStatus):
+    """删除任务的结果文件和直播分段"""
+    if task.result_path and Path(task.result_path).exists():
+        Path(task.result_path).unlink()
+    shutil.rmtree(stream_dir_for(task.task_id), ignore_errors=True)
+    remove_checkpoint(task.task_id)
+
 @app.delete("/tasks/{task_id}")
 async def delete_task(task_id: str):
     """删除任务和相关文件"""
-    if task_id not in task_queue:
+    task = task_store.get(task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail="任务未找到")
     
-    task = task_queue[task_id]
-    
-    # 如果任务正在处理，标记为取消
+    # 如果任务正在处理，标记为取消并通知工作进程在下一个去噪步之间停止、释放显存；
+    # 工作进程停止前仍可能写入分段，直播目录和checkpoint由调度协程收到结果后删除
     if task.status == "processing":
-        task.status = "cancelled"
-        task.updated_at = datetime.now()
-        return {"message": f"任务 {task_id} 已标记为取消"}
+        task_store.update(task_id, status="cancelled")
+        worker_pool.cancel(task_id)
+        return {"message": f"任务 {task_id} 已取消"}
+    
+    # 排队中的任务直接从调度队列移除
+    if task.status == "queued":
+        job_scheduler.cancel(task_id)
+        resume_checkpoints.pop(task_id, None)
     
     # 删除结果文件
-    if task.result_path and Path(task.result_path).exists():
-        Path(task.result_path).unlink()
+    remove_task_files(task)
     
     # 删除任务记录
-    del task_queue[task_id]
+    task_store.delete(task_id)
     
     return {"message": f"任务 {task_id} 已删除"}
 
 @app.post("/system/cleanup")
 async def cleanup_system():
     """清理系统缓存和临时文件"""
-    memory_optimizer.clear_cache()
-    
-    # 清理旧的任务记录 (保留最近200个)
-    if len(task_queue) > 200:
-        # 按时间排序，删除最旧的任务
-        sorted_tasks = sorted(task_queue.items(), key=lambda x: x[1].created_at)
-        for task_id, task in sorted_tasks[:-200]:
-            # 删除相关文件
-            if task.result_path and Path(task.result_path).exists():
-                Path(task.result_path).unlink()
-            del task_queue[task_id]
+    await asyncio.to_thread(memory_optimizer.clear_cache)
+    await asyncio.to_thread(gpu_telemetry.sample_once)
+    
+    # 清理旧的任务记录 (保留最近200个，跳过活跃任务)
+    for task in task_store.prune(keep=200):
+        # 删除相关文件
+        remove_task_files(task)
     
     # 清理临时文件
     temp_dir = Path("/app/outputs/temp")
@@ -603,20 +4490,22 @@ async def cleanup_system():
     
     return {
         "message": "系统清理完成",
-        "memory_after_cleanup": memory_optimizer.get_gpu_memory_info(),
-        "remaining_tasks": len(task_queue)
+        "memory_after_cleanup": gpu_telemetry.latest(),
+        "remaining_tasks": len(task_store)
     }
 
 @app.get("/system/stats")
-async def get_system_stats():
+async def get_system_stats(history_seconds: float = 300):
     """获取系统统计信息"""
-    memory_info = memory_optimizer.get_gpu_memory_info()
+    memory_info = gpu_telemetry.latest()
     system_memory = psutil.virtual_memory()
     disk_usage = psutil.disk_usage("/app")
+    stats = task_store.stats.snapshot()
     
     return {
         "timestamp": datetime.now().isoformat(),
         "gpu": memory_info,
+        "gpu_history": gpu_telemetry.history(history_seconds),
         "system_memory": {
             "total": system_memory.total / 1024**3,
             "available": system_memory.available / 1024**3,
@@ -630,9 +4519,9 @@ async def get_system_stats():
             "percentage": (disk_usage.used / disk_usage.total) * 100
         },
         "tasks": {
-            "total": len(task_queue),
+            "total": stats["total"],
             "active": len(current_tasks),
-            "success_rate": len([t for t in task_queue.values() if t.status == "completed"]) / max(len(task_queue), 1) * 100
+            "success_rate": stats["success_rate"]
         }
     }
 
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+SkyReels V2 Unlimited 视频下载基准
+在子进程中用uvicorn启动API服务器，下载一个已完成任务的视频，测量吞吐和服务器进程CPU时间。
+运行: python bench_download.py [--size-mb 512] [--rounds 3] [--range-mb 8]
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import psutil
+import requests
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def prepare(workdir: Path, size_mb: int) -> Path:
+    """写入测试视频和一个指向它的已完成任务"""
+    video = workdir / "bench.mp4"
+    with open(video, "wb") as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(size_mb):
+            f.write(block)
+
+    os.environ.update(SKYREELS_TASK_STORE="memory", SKYREELS_TELEMETRY_BACKEND="fake")
+    import api_server_unlimited as server
+    store = server.SQLiteTaskStore(str(workdir / "tasks.db"))
+    store.load()
+    now = datetime.now()
+    store.add(server.TaskStatus(task_id="bench", status="completed", created_at=now, updated_at=now,
+                                result_path=str(video), generation_params={}))
+    store.close()
+    return video
+
+
+def measure(url: str, server_process: psutil.Process, size: int, rounds: int, range_bytes: int = 0):
+    """返回 (MB/s, 每GB服务器CPU秒)"""
+    transferred = 0
+    cpu_before = sum(server_process.cpu_times()[:2])
+    started = time.perf_counter()
+    with requests.Session() as session:
+        for _ in range(rounds):
+            if not range_bytes:
+                with session.get(url, stream=True) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(1024 * 1024):
+                        transferred += len(chunk)
+                continue
+            for offset in range(0, size, range_bytes):
+                end = min(offset + range_bytes, size) - 1
+                response = session.get(url, headers={"Range": f"bytes={offset}-{end}"})
+                assert response.status_code == 206
+                transferred += len(response.content)
+    elapsed = time.perf_counter() - started
+    cpu = sum(server_process.cpu_times()[:2]) - cpu_before
+    gigabytes = transferred / 1024**3
+    return transferred / 1024**2 / elapsed, cpu / gigabytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="视频下载基准")
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--range-mb", type=int, default=8, help="Range请求每次的大小")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        video = prepare(workdir, args.size_mb)
+        port = free_port()
+        env = dict(os.environ, SKYREELS_TASK_STORE="sqlite", SKYREELS_TASK_DB=str(workdir / "tasks.db"),
+                   SKYREELS_PIPELINE="simulated", SKYREELS_EXECUTION_MODE="inline", SKYREELS_ETA_STATS="",
+                   SKYREELS_PRELOAD_MODELS="", SKYREELS_RESULT_CACHE_GB="0")
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api_server_unlimited:app", "--port", str(port), "--log-level", "warning"],
+            cwd=ROOT, env=env
+        )
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            for _ in range(600):
+                try:
+                    if requests.get(f"{base_url}/health", timeout=1).ok:
+                        break
+                except requests.ConnectionError:
+                    time.sleep(0.1)
+            server_process = psutil.Process(process.pid)
+            url = f"{base_url}/tasks/bench/download"
+            size = video.stat().st_size
+            print(f"📦 文件 {args.size_mb}MB × {args.rounds} 轮")
+
+            rate, cpu = measure(url, server_process, size, args.rounds)
+            print(f"⬇️  完整下载:       {rate:8.1f} MB/s, 服务器CPU {cpu:.2f} s/GB")
+            rate, cpu = measure(url, server_process, size, args.rounds, args.range_mb * 1024**2)
+            print(f"✂️  Range {args.range_mb}MB分块: {rate:8.1f} MB/s, 服务器CPU {cpu:.2f} s/GB")
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
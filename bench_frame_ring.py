@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+SkyReels V2 Unlimited 进程间帧传输基准
+比较工作进程经Pipe发送帧数组时pickle传输与共享内存环(SharedFrameRing)的吞吐。
+运行: python bench_frame_ring.py [--frames 17] [--size 1088x1920] [--messages 30] [--slots 4]
+"""
+
+import argparse
+import multiprocessing
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+
+def producer(conn, shape, messages, slots, slot_bytes):
+    """模拟工作进程：连续发送交接帧消息"""
+    import api_server_unlimited as server
+    ring = None
+    if slots > 0:
+        ring = server.SharedFrameRing(slots, slot_bytes)
+        conn = server._SharedFrameConnection(conn, ring)
+    frames = np.full(shape, 7, np.uint8)
+    conn.recv()
+    for index in range(messages):
+        conn.send({"type": "handoff", "index": index, "condition": frames})
+    conn.send({"type": "done"})
+    conn.recv()
+    if ring is not None:
+        ring.close()
+
+
+def run(shape, messages, slots, slot_bytes) -> float:
+    """返回接收方观察到的吞吐（GB/s）"""
+    import api_server_unlimited as server
+    ctx = multiprocessing.get_context("spawn")
+    conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=producer, args=(child_conn, shape, messages, slots, slot_bytes))
+    process.start()
+    ring = server.SharedFrameRing(0, 0) if slots > 0 else None
+    if ring is not None:
+        conn = server._SharedFrameConnection(conn, ring, owner=0)
+    conn.send("go")
+    started = time.perf_counter()
+    received = 0
+    while True:
+        message = conn.recv()
+        if message["type"] == "done":
+            break
+        assert message["condition"].shape == shape and message["condition"][0, 0, 0, 0] == 7
+        received += 1
+    elapsed = time.perf_counter() - started
+    conn.send("bye")
+    process.join()
+    return received * int(np.prod(shape)) / 1024**3 / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="进程间帧传输基准")
+    parser.add_argument("--frames", type=int, default=17, help="每条消息的帧数（默认为重叠帧数）")
+    parser.add_argument("--size", default="1088x1920", help="帧尺寸 高x宽")
+    parser.add_argument("--messages", type=int, default=30)
+    parser.add_argument("--slots", type=int, default=4)
+    args = parser.parse_args()
+
+    height, width = (int(value) for value in args.size.split("x"))
+    shape = (args.frames, height, width, 3)
+    slot_bytes = int(np.prod(shape))
+    print(f"📦 每条消息 {slot_bytes / 1024**2:.1f}MB × {args.messages} 条")
+
+    pickle_rate = run(shape, args.messages, 0, slot_bytes)
+    print(f"🥒 pickle管道:     {pickle_rate:.2f} GB/s")
+    ring_rate = run(shape, args.messages, args.slots, slot_bytes)
+    print(f"🧠 共享内存环({args.slots}槽): {ring_rate:.2f} GB/s ({ring_rate / pickle_rate:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
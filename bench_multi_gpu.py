@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+SkyReels V2 Unlimited 多GPU流水线扩展性基准
+同一个长视频任务分别在1、2、4、8个设备上执行，报告总耗时和相对单设备的加速比。
+默认在CPU上用模拟管线（每步sleep，线程间可并行）验证调度本身的扩展性。模拟管线的批量前向耗时与批大小无关，
+CPU上的结果反映的是分段派发和交接链的上限（约 1 / 交接比例 个分段同时在途），不是GPU算力的扩展。
+在8卡机器上运行真实模型:
+  python bench_multi_gpu.py --devices cuda:0,cuda:1,cuda:2,cuda:3,cuda:4,cuda:5,cuda:6,cuda:7 \\
+      --pipeline skyreels --mode process --duration 60
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="多GPU流水线扩展性基准")
+    parser.add_argument("--devices", default="cpu,cpu,cpu,cpu,cpu,cpu,cpu,cpu", help="逗号分隔的设备列表")
+    parser.add_argument("--scales", default="1,2,4,8", help="依次使用前N个设备")
+    parser.add_argument("--pipeline", default="simulated", help="simulated 或 skyreels")
+    parser.add_argument("--mode", default="inline", help="inline（线程）或 process（每设备一个进程）")
+    parser.add_argument("--duration", type=int, default=40, help="视频时长（秒）")
+    parser.add_argument("--resolution", default="480p")
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--handoff", type=float, default=0.8, help="交接比例，需小于1才会走流水线")
+    parser.add_argument("--step-seconds", default="0.05", help="模拟管线每个去噪步的耗时")
+    return parser.parse_args()
+
+
+async def run_once(server, devices, args, workdir: Path) -> float:
+    pool = server.GPUWorkerPool(devices, args.pipeline, args.mode)
+    pool.handoff_fraction = args.handoff
+    pool.start()
+    try:
+        while not all(w["supports_step_batching"] or w["state"] == "dead" for w in pool.workers):
+            await asyncio.sleep(0.1)
+        job = {"task_id": f"bench-{len(devices)}", "prompt": "A long flight over mountains and rivers",
+               "resolution": args.resolution, "duration": args.duration, "fps": 24,
+               "num_inference_steps": args.steps, "guidance_scale": 6.0, "seed": 42, "enable_audio": False}
+        started = time.perf_counter()
+        if pool.can_pipeline():
+            await pool.run_pipelined(0, job["task_id"], job, lambda message: None)
+        else:
+            await pool.run_batch(0, [(job["task_id"], job, lambda message: None)])
+        return time.perf_counter() - started
+    finally:
+        await pool.stop()
+
+
+def main():
+    args = parse_args()
+    os.environ.setdefault("SKYREELS_SIMULATED_STEP_SECONDS", args.step_seconds)
+    os.environ.setdefault("SKYREELS_TASK_STORE", "memory")
+    os.environ.setdefault("SKYREELS_ETA_STATS", "")
+    import api_server_unlimited as server
+
+    devices = [device.strip() for device in args.devices.split(",") if device.strip()]
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        # 输出写到临时目录；最终拼接只复制分段，基准只关心去噪阶段的扩展性
+        server.stream_dir_for = lambda task_id: workdir / "streams" / task_id
+        server.video_output_path = lambda job: str(workdir / f"{job['task_id']}.mp4")
+        server.concat_video_segments = lambda paths, output, *audio: Path(output).write_bytes(b"")
+        os.environ.setdefault("SKYREELS_CHECKPOINT_DIR", str(workdir / "checkpoints"))
+
+        print(f"🎬 {args.duration}s {args.resolution}, {args.steps}步, 管线 {args.pipeline}, 交接比例 {args.handoff}")
+        baseline = None
+        for scale in (int(value) for value in args.scales.split(",")):
+            if scale > len(devices):
+                break
+            seconds = asyncio.run(run_once(server, devices[:scale], args, workdir))
+            baseline = baseline or seconds
+            print(f"🖥️  {scale} 个设备: {seconds:7.2f}s, 加速比 {baseline / seconds:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
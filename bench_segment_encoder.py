@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+SkyReels V2 Unlimited 分段编码基准
+GPU去噪和VAE解码用sleep模拟（不占CPU），每段解码结果交给SegmentEncoder在CPU上编码，
+比较同步编码（队列深度0）与后台编码（深度1、2）时整个任务的总耗时。
+运行: python bench_segment_encoder.py [--segments 6] [--frames 81] [--size 480x848] [--gpu-seconds 0]
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from concurrent.futures import wait
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+
+def run(server, depth: int, segments: int, shape, gpu_seconds: float, fps: int, workdir: Path) -> float:
+    """返回任务总耗时（秒）：最后一段编码完成为止"""
+    encoder = server.SegmentEncoder(depth)
+    rng = np.random.default_rng(0)
+    started = time.perf_counter()
+    futures = []
+    for index in range(segments):
+        time.sleep(gpu_seconds)
+        frames = rng.integers(0, 255, shape, dtype=np.uint8)
+        futures.append(encoder.submit(workdir / f"depth{depth}_{index:04d}.ts", frames, fps, owner="bench"))
+        # 与同步生成路径相同：积压到上限时任务在这里等待自己的编码
+        encoder.wait_ready(["bench"])
+    wait(futures)
+    for future in futures:
+        future.result()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分段编码基准")
+    parser.add_argument("--segments", type=int, default=6)
+    parser.add_argument("--frames", type=int, default=81, help="每段帧数")
+    parser.add_argument("--size", default="480x848", help="帧尺寸 高x宽")
+    parser.add_argument("--fps", type=int, default=24)
+    parser.add_argument("--gpu-seconds", type=float, default=0, help="每段的模拟GPU耗时，0表示与单段编码耗时相同")
+    parser.add_argument("--depths", default="0,1,2", help="逗号分隔的队列深度")
+    args = parser.parse_args()
+
+    import api_server_unlimited as server
+
+    height, width = (int(value) for value in args.size.split("x"))
+    shape = (args.frames, height, width, 3)
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        frames = np.random.default_rng(1).integers(0, 255, shape, dtype=np.uint8)
+        started = time.perf_counter()
+        server.write_video_segment(workdir / "warmup.ts", frames, args.fps)
+        encode_seconds = time.perf_counter() - started
+        gpu_seconds = args.gpu_seconds or encode_seconds
+        print(f"🎞️  {args.segments} 段 × {args.frames} 帧 {args.size}: 单段编码 {encode_seconds:.2f}s, "
+              f"模拟GPU {gpu_seconds:.2f}s/段")
+        # 完全重叠时的下限：最慢的一侧跑满所有分段，另一侧只多出一段
+        ideal = args.segments * max(gpu_seconds, encode_seconds) + min(gpu_seconds, encode_seconds)
+        for depth in (int(value) for value in args.depths.split(",")):
+            seconds = run(server, depth, args.segments, shape, gpu_seconds, args.fps, workdir)
+            print(f"📼 队列深度 {depth}: {seconds:6.2f}s (完全重叠下限 {ideal:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
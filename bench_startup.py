@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+SkyReels V2 Unlimited 启动基准
+生成合成的safetensors权重分片，在子进程中用uvicorn启动API服务器（SKYREELS_PIPELINE=auto指向合成模型），
+从进程启动开始计时：/health可用、第一个/generate被接受、/health中模型进入warm状态。
+合成分片没有官方管线可加载，索引和页缓存预热之后auto模式回退到模拟管线，测到的是加载前的准备开销。
+运行: python bench_startup.py [--shards 8] [--shard-mb 256] [--no-prefetch]
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import requests
+import torch
+from safetensors.torch import save_file
+
+ROOT = Path(__file__).resolve().parent
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_shards(model_dir: Path, shards: int, shard_mb: int, tensors_per_shard: int = 64):
+    """写入与官方检查点同样命名的分片，每个分片若干bf16张量"""
+    model_dir.mkdir(parents=True)
+    numel = shard_mb * 1024**2 // 2 // tensors_per_shard
+    for index in range(shards):
+        tensors = {f"blocks.{index}.weight_{i}": torch.zeros(numel, dtype=torch.bfloat16)
+                   for i in range(tensors_per_shard)}
+        save_file(tensors, str(model_dir / f"diffusion_pytorch_model-{index + 1:05d}-of-{shards:05d}.safetensors"))
+    (model_dir / "config.json").write_text("{}")
+
+
+def model_state(health: dict) -> str:
+    states = [model.get("state") for worker in health.get("workers", {}).get("workers", [])
+              for model in worker.get("models", {}).values()]
+    return states[0] if states else "pending"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="服务启动基准")
+    parser.add_argument("--shards", type=int, default=8)
+    parser.add_argument("--shard-mb", type=int, default=256)
+    parser.add_argument("--no-prefetch", action="store_true", help="关闭权重页缓存预热")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        model_dir = workdir / "SkyReels-V2-DF-synthetic"
+        write_shards(model_dir, args.shards, args.shard_mb)
+        print(f"📦 合成模型 {args.shards} 个分片 × {args.shard_mb}MB, 预热页缓存: {not args.no_prefetch}")
+
+        port = free_port()
+        env = dict(os.environ, SKYREELS_PIPELINE="auto", SKYREELS_MODEL_PATH=str(model_dir),
+                   SKYREELS_EXECUTION_MODE="inline", SKYREELS_WORKER_DEVICES="cpu",
+                   SKYREELS_TASK_STORE="memory", SKYREELS_TELEMETRY_BACKEND="fake", SKYREELS_ETA_STATS="",
+                   SKYREELS_PREFETCH_WEIGHTS="false" if args.no_prefetch else "true")
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api_server_unlimited:app", "--port", str(port), "--log-level", "warning"],
+            cwd=ROOT, env=env
+        )
+        base_url = f"http://127.0.0.1:{port}"
+        timings = {}
+        task_id = None
+        try:
+            while "warm" not in timings and time.perf_counter() - started < 600:
+                try:
+                    health = requests.get(f"{base_url}/health", timeout=5).json()
+                except requests.ConnectionError:
+                    time.sleep(0.05)
+                    continue
+                timings.setdefault("health", time.perf_counter() - started)
+                if task_id is None:
+                    response = requests.post(f"{base_url}/generate", timeout=30, json={
+                        "prompt": "startup benchmark", "resolution": "480p", "duration": 1, "fps": 24,
+                        "num_inference_steps": 10, "enable_audio": False
+                    })
+                    if response.status_code == 200:
+                        timings["generate"] = time.perf_counter() - started
+                        task_id = response.json()["task_id"]
+                        # 只测接受任务的时间，不实际生成
+                        requests.delete(f"{base_url}/tasks/{task_id}", timeout=30)
+                if model_state(health) == "warm":
+                    timings["warm"] = time.perf_counter() - started
+                else:
+                    time.sleep(0.05)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+        print(f"🩺 /health可用:        {timings.get('health', float('nan')):6.2f}s")
+        print(f"🎥 首个/generate被接受: {timings.get('generate', float('nan')):6.2f}s")
+        print(f"🔥 模型warm:           {timings.get('warm', float('nan')):6.2f}s")
+
+
+if __name__ == "__main__":
+    main()
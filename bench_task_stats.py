@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+SkyReels V2 Unlimited 任务统计基准
+比较按状态全量扫描计数（/health、/tasks、/system/stats原来的做法）与TaskStatistics增量计数的读取耗时，
+以及增量计数给每次状态变更增加的开销。
+运行: python bench_task_stats.py [--counts 1000,10000,100000] [--reads 200]
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+
+def recount(tasks) -> dict:
+    """全量扫描计数"""
+    counts = {status: sum(1 for task in tasks.values() if task.status == status)
+              for status in ("queued", "processing", "completed", "failed", "cancelled")}
+    total = len(tasks)
+    return dict(counts, total=total, success_rate=counts["completed"] / max(total, 1) * 100)
+
+
+def per_call(func, repeat: int) -> float:
+    """单次调用耗时（微秒）"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="任务统计基准")
+    parser.add_argument("--counts", default="1000,10000,100000", help="逗号分隔的任务数")
+    parser.add_argument("--reads", type=int, default=200, help="每种读取方式的调用次数")
+    args = parser.parse_args()
+
+    os.environ.update(SKYREELS_TASK_STORE="memory", SKYREELS_TELEMETRY_BACKEND="fake", SKYREELS_ETA_STATS="")
+    import api_server_unlimited as server
+
+    statuses = ("completed", "completed", "completed", "failed", "cancelled", "queued", "processing")
+    for count in (int(value) for value in args.counts.split(",")):
+        store = server.TaskStore()
+        now = datetime.now()
+        for index in range(count):
+            store.add(server.TaskStatus(task_id=f"task-{index}", status=statuses[index % len(statuses)],
+                                        created_at=now, updated_at=now, generation_params={}))
+        assert recount(store._tasks) == store.stats.snapshot()
+
+        scan = per_call(lambda: recount(store._tasks), max(args.reads * 1000 // count, 3))
+        snapshot = per_call(store.stats.snapshot, args.reads * 100)
+        # 状态变更：带增量计数的update与只改字段（stage）的update之差即为计数开销
+        flip = iter(("processing", "queued") * 50000)
+        with_stats = per_call(lambda: store.update("task-5", status=next(flip)), 20000)
+        without_stats = per_call(lambda: store.update("task-5", stage="bench"), 20000)
+        print(f"📊 {count:>7} 个任务: 全量扫描 {scan:10.1f}µs, 增量计数 {snapshot:5.2f}µs "
+              f"({scan / snapshot:,.0f}x); 每次状态变更 +{max(with_stats - without_stats, 0):.2f}µs")
+
+
+if __name__ == "__main__":
+    main()
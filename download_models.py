@@ -6,10 +6,23 @@ SkyReels V2 模型下载脚本
 
 import os
 import sys
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from huggingface_hub import snapshot_download, hf_hub_download
+from huggingface_hub import HfApi, hf_hub_download
+import requests
 import json
 
+# 下载配置
+HF_ENDPOINT = os.getenv("HF_ENDPOINT", "https://huggingface.co").rstrip("/")
+HF_TOKEN = os.getenv("HF_TOKEN")
+DOWNLOAD_WORKERS = int(os.getenv("SKYREELS_DOWNLOAD_WORKERS", "4"))
+DOWNLOAD_RETRIES = int(os.getenv("SKYREELS_DOWNLOAD_RETRIES", "5"))
+CHUNK_SIZE = 8 * 1024 * 1024
+MANIFEST_NAME = ".download_manifest.json"
+
 def check_disk_space():
     """检查磁盘空间"""
     import shutil
@@ -22,6 +35,203 @@ def check_disk_space():
         return False
     return True
 
+def fetch_manifest(repo_id, revision="main", endpoint=HF_ENDPOINT):
+    """获取仓库文件清单（路径、大小、LFS文件的SHA256、普通文件的git blob SHA1）"""
+    api = HfApi(endpoint=endpoint, token=HF_TOKEN)
+    info = api.model_info(repo_id, revision=revision, files_metadata=True)
+    files = []
+    for sibling in info.siblings:
+        lfs = sibling.lfs or {}
+        files.append({
+            "path": sibling.rfilename,
+            "size": lfs.get("size", sibling.size),
+            "sha256": lfs.get("sha256"),
+            "blob_id": None if sibling.lfs else sibling.blob_id
+        })
+    return {"repo_id": repo_id, "revision": info.sha or revision, "files": files}
+
+class DownloadProgress:
+    """多线程共享的下载进度，定期打印总速度"""
+
+    def __init__(self, total_bytes, interval=5.0):
+        self.total_bytes = total_bytes
+        self.done_bytes = 0
+        self.interval = interval
+        self.started = time.time()
+        self._last_print = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, n):
+        with self._lock:
+            self.done_bytes += n
+            now = time.time()
+            if now - self._last_print < self.interval:
+                return
+            self._last_print = now
+        speed = self.done_bytes / max(now - self.started, 1e-6) / 1024**2
+        percent = self.done_bytes / max(self.total_bytes, 1) * 100
+        print(f"📊 {self.done_bytes / 1024**3:.2f}GB / {self.total_bytes / 1024**3:.2f}GB ({percent:.1f}%), {speed:.1f}MB/s")
+
+def git_blob_sha1(path):
+    """按git对象格式计算文件的blob SHA1（非LFS文件在Hub上的blob_id）"""
+    path = Path(path)
+    digest = hashlib.sha1(f"blob {path.stat().st_size}\0".encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def response_total_size(response, offset):
+    """从响应头得到完整文件大小，无法确定（如压缩传输）时返回None"""
+    content_range = response.headers.get("Content-Range", "")
+    if "/" in content_range and content_range.rsplit("/", 1)[1].isdigit():
+        return int(content_range.rsplit("/", 1)[1])
+    length = response.headers.get("Content-Length")
+    if length and length.isdigit() and not response.headers.get("Content-Encoding"):
+        return int(length) + (offset if response.status_code == 206 else 0)
+    return None
+
+def download_file(session, url, dest, size=None, sha256=None, progress=None, blob_id=None):
+    """断点续传下载单个文件
+
+    数据先写入 .part 文件，已有部分通过Range请求续传；边下载边计算SHA256，
+    非LFS文件下载完成后核对git blob SHA1。清单中没有大小时按响应头核对，
+    大小和校验和都一致后才用 os.replace 原子替换为目标文件。
+    """
+    dest = Path(dest)
+    part = dest.with_name(dest.name + ".part")
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        # 续传前先把已下载部分计入哈希
+        digest = hashlib.sha256()
+        offset = part.stat().st_size if part.exists() else 0
+        if size is not None and offset > size:
+            part.unlink()
+            offset = 0
+        if offset:
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+        
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        expected_size = size
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=(10, 60)) as response:
+                if response.status_code == 416 and offset == size:
+                    pass  # .part已完整，只需校验
+                else:
+                    response.raise_for_status()
+                    if offset and response.status_code != 206:
+                        # 服务器不支持Range，从头开始
+                        digest = hashlib.sha256()
+                        offset = 0
+                    if expected_size is None:
+                        expected_size = response_total_size(response, offset)
+                    with open(part, "ab" if offset else "wb") as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                            digest.update(chunk)
+                            if progress:
+                                progress.add(len(chunk))
+        except (requests.RequestException, OSError) as e:
+            print(f"⚠️  下载中断 {dest.name} (第{attempt}次): {e}")
+            time.sleep(min(2 ** attempt, 30))
+            continue
+        
+        actual_size = part.stat().st_size
+        if expected_size is not None and actual_size != expected_size:
+            print(f"⚠️  文件大小不符 {dest.name}: {actual_size} != {expected_size}，重试")
+            if actual_size > expected_size:
+                part.unlink()
+            continue
+        if sha256 and digest.hexdigest() != sha256:
+            print(f"❌ SHA256校验失败 {dest.name}，重新下载")
+            part.unlink()
+            continue
+        if blob_id and not sha256 and git_blob_sha1(part) != blob_id:
+            print(f"❌ SHA1校验失败 {dest.name}，重新下载")
+            part.unlink()
+            continue
+        os.replace(part, dest)
+        return dest
+    
+    raise RuntimeError(f"下载失败: {dest.name} (已重试{DOWNLOAD_RETRIES}次)")
+
+def download_repos(repos, endpoint=HF_ENDPOINT, workers=DOWNLOAD_WORKERS):
+    """多个仓库共用一个线程池并行下载缺失或不完整的文件，已存在且大小一致的文件跳过
+
+    repos为 [{"repo_id", "local_dir", "revision"(可选), "manifest"(可选)}]，
+    返回 {repo_id: 是否全部下载成功}。
+    """
+    results = {}
+    pending = []
+    resumed = 0
+    for repo in repos:
+        repo_id = repo["repo_id"]
+        local_dir = Path(repo["local_dir"])
+        local_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            manifest = repo.get("manifest") or fetch_manifest(repo_id, repo.get("revision", "main"), endpoint)
+        except Exception as e:
+            print(f"❌ 获取文件清单失败 {repo_id}: {e}")
+            results[repo_id] = False
+            continue
+        with open(local_dir / MANIFEST_NAME, "w") as f:
+            json.dump(manifest, f, indent=2)
+        
+        missing = [
+            item for item in manifest["files"]
+            if not ((local_dir / item["path"]).exists() and (local_dir / item["path"]).stat().st_size == item["size"])
+        ]
+        size = sum(item["size"] or 0 for item in missing)
+        already = sum(
+            (local_dir / (item["path"] + ".part")).stat().st_size
+            for item in missing if (local_dir / (item["path"] + ".part")).exists()
+        )
+        print(f"📦 {repo_id}: 需下载 {len(missing)}/{len(manifest['files'])} 个文件, "
+              f"{(size - already) / 1024**3:.2f}GB")
+        results[repo_id] = True
+        resumed += already
+        pending.extend((repo_id, local_dir, manifest["revision"], item) for item in missing)
+    if not pending:
+        return results
+    
+    # 各仓库的大文件优先，避免最后只剩一个大分片单线程下载
+    pending.sort(key=lambda job: job[3]["size"] or 0, reverse=True)
+    total = sum(job[3]["size"] or 0 for job in pending) - resumed
+    print(f"🚀 共 {len(pending)} 个文件, {total / 1024**3:.2f}GB, {workers}个并发")
+    progress = DownloadProgress(total)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if HF_TOKEN:
+        session.headers["Authorization"] = f"Bearer {HF_TOKEN}"
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                download_file, session,
+                f"{endpoint}/{repo_id}/resolve/{revision}/{item['path']}",
+                local_dir / item["path"], item["size"], item["sha256"], progress, item.get("blob_id")
+            ): (repo_id, item) for repo_id, local_dir, revision, item in pending
+        }
+        for future in as_completed(futures):
+            repo_id, item = futures[future]
+            try:
+                future.result()
+                print(f"✅ {repo_id}/{item['path']}")
+            except Exception as e:
+                print(f"❌ {repo_id}/{item['path']}: {e}")
+                results[repo_id] = False
+    return results
+
+def download_repo(repo_id, local_dir, revision="main", endpoint=HF_ENDPOINT, workers=DOWNLOAD_WORKERS, manifest=None):
+    """下载单个仓库，见download_repos"""
+    repo = {"repo_id": repo_id, "local_dir": local_dir, "revision": revision, "manifest": manifest}
+    return download_repos([repo], endpoint, workers)[repo_id]
+
 def download_skyreels_models():
     """下载SkyReels-V2模型"""
     models = {
@@ -39,40 +249,34 @@ def download_skyreels_models():
     
     print("🤖 开始下载SkyReels-V2模型...")
     
+    pending = {}
     for model_name, config in models.items():
-        local_dir = Path(config['local_dir'])
-        
-        if local_dir.exists() and any(local_dir.iterdir()):
+        if verify_model_download(config['local_dir'], quiet=True):
             print(f"✅ 模型已存在: {model_name}")
             continue
             
         print(f"📥 下载模型: {model_name} ({config['description']})")
         print(f"🎯 目标目录: {config['local_dir']}")
-        
-        try:
-            # 创建目录
-            local_dir.mkdir(parents=True, exist_ok=True)
-            
-            # 下载模型
-            snapshot_download(
-                repo_id=config['repo_id'],
-                local_dir=config['local_dir'],
-                local_dir_use_symlinks=False,
-                resume_download=True
-            )
-            
-            print(f"✅ 模型下载完成: {model_name}")
-            
-            # 验证下载
-            if verify_model_download(config['local_dir']):
-                print(f"✅ 模型验证通过: {model_name}")
-            else:
-                print(f"❌ 模型验证失败: {model_name}")
-                
-        except Exception as e:
-            print(f"❌ 模型下载失败 {model_name}: {e}")
+        pending[model_name] = config
+    if not pending:
+        return
+    
+    # 两个模型共用线程池同时下载（已下载的文件和.part分片会被复用）
+    results = download_repos(list(pending.values()))
+    for model_name, config in pending.items():
+        if not results[config['repo_id']]:
+            print(f"❌ 模型下载失败 {model_name}: 部分文件下载失败，重新运行可断点续传")
             # 如果下载失败，尝试下载最小必需文件
             try_download_essential_files(config)
+            continue
+        
+        print(f"✅ 模型下载完成: {model_name}")
+        
+        # 验证下载
+        if verify_model_download(config['local_dir']):
+            print(f"✅ 模型验证通过: {model_name}")
+        else:
+            print(f"❌ 模型验证失败: {model_name}")
 
 def try_download_essential_files(config):
     """尝试下载核心文件"""
@@ -99,23 +303,54 @@ def try_download_essential_files(config):
         except Exception as e:
             print(f"⚠️  跳过文件 {filename}: {e}")
 
-def verify_model_download(model_dir):
-    """验证模型下载完整性"""
+def verify_model_download(model_dir, full=False, quiet=False):
+    """验证模型下载完整性
+
+    有下载清单时逐个核对文件大小，full=True时重新计算LFS文件的SHA256和普通文件的git blob SHA1；
+    没有清单（旧版本下载）时只检查必需文件。
+    """
     model_path = Path(model_dir)
     if not model_path.exists():
         return False
     
+    manifest_file = model_path / MANIFEST_NAME
+    if manifest_file.exists():
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        for item in manifest["files"]:
+            path = model_path / item["path"]
+            if not path.exists() or path.stat().st_size != item["size"]:
+                if not quiet:
+                    print(f"❌ 文件缺失或不完整: {item['path']}")
+                return False
+            if full and item["sha256"]:
+                digest = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        digest.update(chunk)
+                if digest.hexdigest() != item["sha256"]:
+                    if not quiet:
+                        print(f"❌ SHA256校验失败: {item['path']}")
+                    return False
+            elif full and item.get("blob_id") and git_blob_sha1(path) != item["blob_id"]:
+                if not quiet:
+                    print(f"❌ SHA1校验失败: {item['path']}")
+                return False
+        return True
+    
     # 检查必需文件
     required_files = ["config.json"]
     for required_file in required_files:
         if not (model_path / required_file).exists():
-            print(f"❌ 缺少必需文件: {required_file}")
+            if not quiet:
+                print(f"❌ 缺少必需文件: {required_file}")
             return False
     
     # 检查模型文件
     model_files = list(model_path.glob("*.safetensors")) + list(model_path.glob("*.bin"))
     if not model_files:
-        print(f"❌ 未找到模型权重文件")
+        if not quiet:
+            print(f"❌ 未找到模型权重文件")
         return False
     
     return True
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+SkyReels V2 模型下载脚本测试
+用本地http.server模拟Hub的resolve接口（支持Range），不访问网络。
+运行: python -m pytest -q test_download_models.py  或  python test_download_models.py
+"""
+
+import os
+import sys
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import pytest
+import requests
+
+import download_models
+
+
+class FakeHub:
+    """按URL路径提供文件内容的HTTP服务器，记录每个请求的Range头"""
+
+    def __init__(self, files, barrier=None):
+        self.files = files  # URL路径 -> 内容
+        self.barrier = barrier
+        self.requests = []
+        hub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                hub.requests.append((self.path, self.headers.get("Range")))
+                if hub.barrier is not None:
+                    hub.barrier.wait()
+                body = hub.files.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                start = 0
+                if self.headers.get("Range"):
+                    start = int(self.headers["Range"].split("=")[1].split("-")[0])
+                    if start >= len(body):
+                        self.send_response(416)
+                        self.send_header("Content-Range", f"bytes */{len(body)}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(body) - start))
+                self.end_headers()
+                self.wfile.write(body[start:])
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def hub():
+    servers = []
+
+    def start(files, barrier=None):
+        servers.append(FakeHub(files, barrier))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def git_blob_id(data):
+    return hashlib.sha1(f"blob {len(data)}\0".encode() + data).hexdigest()
+
+
+def test_resume_from_part_file(tmp_path, hub):
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    server = hub({"/org/repo/resolve/main/model.safetensors": content})
+    dest = tmp_path / "model.safetensors"
+    (tmp_path / "model.safetensors.part").write_bytes(content[:1024 * 1024])
+
+    download_models.download_file(
+        requests.Session(), f"{server.endpoint}/org/repo/resolve/main/model.safetensors", dest,
+        size=len(content), sha256=hashlib.sha256(content).hexdigest()
+    )
+    assert dest.read_bytes() == content
+    assert not (tmp_path / "model.safetensors.part").exists()
+    assert server.requests == [("/org/repo/resolve/main/model.safetensors", f"bytes={1024 * 1024}-")]
+
+
+def test_checksum_failure_raises_after_retries(tmp_path, hub, monkeypatch):
+    monkeypatch.setattr(download_models, "DOWNLOAD_RETRIES", 2)
+    content = os.urandom(64 * 1024)
+    server = hub({"/org/repo/resolve/main/model.safetensors": content[:-1] + b"x"})
+    dest = tmp_path / "model.safetensors"
+
+    with pytest.raises(RuntimeError):
+        download_models.download_file(
+            requests.Session(), f"{server.endpoint}/org/repo/resolve/main/model.safetensors", dest,
+            size=len(content), sha256=hashlib.sha256(content).hexdigest()
+        )
+    # 校验失败的.part被删除，每次重试都从头下载
+    assert not dest.exists() and not (tmp_path / "model.safetensors.part").exists()
+    assert [range_header for _, range_header in server.requests] == [None, None]
+
+
+def test_non_lfs_files_are_checked_by_size_and_blob_sha1(tmp_path, hub, monkeypatch):
+    monkeypatch.setattr(download_models, "DOWNLOAD_RETRIES", 2)
+    monkeypatch.setattr(download_models.time, "sleep", lambda seconds: None)
+    config = json.dumps({"dim": 5120}).encode()
+    server = hub({"/org/repo/resolve/main/config.json": config})
+    url = f"{server.endpoint}/org/repo/resolve/main/config.json"
+    session = requests.Session()
+
+    # 清单没有大小时按响应头核对
+    dest = download_models.download_file(session, url, tmp_path / "ok" / "config.json", blob_id=git_blob_id(config))
+    assert dest.read_bytes() == config
+
+    with pytest.raises(RuntimeError):
+        download_models.download_file(session, url, tmp_path / "sha" / "config.json", blob_id=git_blob_id(b"{}"))
+    assert not (tmp_path / "sha" / "config.json").exists()
+
+    with pytest.raises(RuntimeError):
+        download_models.download_file(session, url, tmp_path / "size" / "config.json", size=len(config) + 1)
+    assert not (tmp_path / "size" / "config.json").exists()
+
+
+def test_download_repos_shares_one_pool_across_repos(tmp_path, hub):
+    shards = {"org/df": os.urandom(256 * 1024), "org/i2v": os.urandom(256 * 1024)}
+    # 两个仓库各只有一个文件：只有两个仓库同时下载时两个请求才能一起通过屏障
+    server = hub({f"/{repo_id}/resolve/abc/model.safetensors": data for repo_id, data in shards.items()},
+                 barrier=threading.Barrier(2, timeout=10))
+    repos = [{
+        "repo_id": repo_id, "local_dir": tmp_path / repo_id.split("/")[1],
+        "manifest": {"repo_id": repo_id, "revision": "abc", "files": [{
+            "path": "model.safetensors", "size": len(data), "sha256": hashlib.sha256(data).hexdigest()
+        }]}
+    } for repo_id, data in shards.items()]
+
+    results = download_models.download_repos(repos, endpoint=server.endpoint, workers=2)
+    assert results == {"org/df": True, "org/i2v": True}
+    for repo in repos:
+        assert (repo["local_dir"] / "model.safetensors").read_bytes() == shards[repo["repo_id"]]
+        assert download_models.verify_model_download(repo["local_dir"], full=True)
+
+
+def main():
+    sys.exit(pytest.main(["-q", __file__]))
+
+
+if __name__ == "__main__":
+    main()
@@ -160,33 +160,41 @@ class SkyReelsUnlimitedTester:
             return None
     
     def monitor_task_progress(self, task_id: str, timeout_minutes: int = 60) -> bool:
-        """监控任务进度"""
+        """通过SSE事件流监控任务进度（服务端只在状态变化时推送）"""
         if not task_id:
             return False
             
         print(f"📊 监控任务进度: {task_id}")
         start_time = time.time()
         timeout_seconds = timeout_minutes * 60
+        state = {}
         
-        while time.time() - start_time < timeout_seconds:
-            try:
-                response = self.session.get(f"{self.base_url}/tasks/{task_id}/status")
-                if response.status_code == 200:
-                    data = response.json()
-                    status = data.get('status')
-                    progress = data.get('progress', 0)
+        try:
+            with self.session.get(f"{self.base_url}/tasks/{task_id}/events", stream=True, timeout=(10, 60)) as response:
+                if response.status_code != 200:
+                    print(f"\n❌ 事件流连接失败: HTTP {response.status_code}")
+                    return False
+                
+                for line in response.iter_lines(decode_unicode=True):
+                    if time.time() - start_time > timeout_seconds:
+                        break
+                    if not line or not line.startswith("data:"):
+                        continue
                     
-                    print(f"\r📈 状态: {status} | 进度: {progress*100:.1f}%", end='', flush=True)
+                    # 事件只包含变化的字段，合并到当前状态
+                    state.update(json.loads(line[5:]))
+                    status = state.get('status')
+                    progress = state.get('progress', 0)
+                    stage = state.get('stage') or ''
+                    
+                    print(f"\r📈 状态: {status} | 进度: {progress*100:.1f}% | {stage}", end='', flush=True)
                     
                     if status == 'completed':
                         print(f"\n✅ 任务完成!")
-                        result_path = data.get('result_path')
-                        if result_path:
-                            print(f"📁 结果文件: {result_path}")
                         return True
                     elif status == 'failed':
                         print(f"\n❌ 任务失败!")
-                        error = data.get('error')
+                        error = state.get('error')
                         if error:
                             print(f"错误信息: {error}")
                         return False
@@ -194,14 +202,9 @@ class SkyReelsUnlimitedTester:
                         print(f"\n⏹️  任务已取消")
                         return False
                     
-                    time.sleep(10)  # 每10秒检查一次
-                else:
-                    print(f"\n❌ 状态查询失败: HTTP {response.status_code}")
-                    return False
-                    
-            except Exception as e:
-                print(f"\n❌ 监控错误: {e}")
-                return False
+        except Exception as e:
+            print(f"\n❌ 监控错误: {e}")
+            return False
         
         print(f"\n⏰ 任务超时 ({timeout_minutes}分钟)")
         return False
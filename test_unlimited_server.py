@@ -0,0 +1,1377 @@
+#!/usr/bin/env python3
+"""
+SkyReels V2 Unlimited API 进程内测试
+不需要GPU和运行中的服务器：模拟管线、内存任务存储、inline工作线程。
+运行: python -m pytest -q test_unlimited_server.py  或  python test_unlimited_server.py
+"""
+
+import os
+import sys
+import asyncio
+import io
+import json
+import sqlite3
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from multiprocessing import shared_memory
+from pathlib import Path
+from types import SimpleNamespace
+
+os.environ.setdefault("SKYREELS_EXECUTION_MODE", "inline")
+os.environ.setdefault("SKYREELS_TASK_STORE", "memory")
+os.environ.setdefault("SKYREELS_TELEMETRY_BACKEND", "fake")
+os.environ.setdefault("SKYREELS_PIPELINE", "simulated")
+os.environ.setdefault("SKYREELS_SIMULATED_STEP_SECONDS", "0")
+os.environ.setdefault("SKYREELS_ETA_STATS", "")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from fastapi.testclient import TestClient
+from prometheus_client.parser import text_string_to_metric_families
+
+import api_server_unlimited as server
+
+
+def add_task(task_id: str, request: "server.UnlimitedVideoRequest", status: str = "queued"):
+    now = datetime.now()
+    server.task_store.add(server.TaskStatus(
+        task_id=task_id, status=status, created_at=now, updated_at=now,
+        generation_params=dict(request.model_dump(), task_id=task_id)
+    ))
+
+
+def test_cancel_during_preemption_is_not_requeued(tmp_path, monkeypatch):
+    """工作进程报告抢占后、协程恢复前到达的取消请求不能被重新排队覆盖"""
+    monkeypatch.setenv("SKYREELS_CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(server, "stream_dir_for", lambda task_id: tmp_path / "streams" / task_id)
+    request = server.UnlimitedVideoRequest(prompt="preempt race", duration=2, resolution="480p")
+    add_task("race", request)
+    checkpoint = {"segment_index": 1, "num_segments": 3, "segment_paths": [], "playlist": [],
+                  "condition": None, "segment_state": None}
+    server.write_checkpoint("race", checkpoint)
+    submitted = []
+
+    async def run_batch(gpu_id, items):
+        # 抢占结果返回之前，DELETE已把任务标记为取消
+        server.task_store.update("race", status="cancelled")
+        return [server.TaskInterrupted("preempted", checkpoint)]
+
+    async def submit(task_id, request, **kwargs):
+        submitted.append(task_id)
+
+    monkeypatch.setattr(server.worker_pool, "run_batch", run_batch)
+    monkeypatch.setattr(server.worker_pool, "can_pipeline", lambda: False)
+    monkeypatch.setattr(server.job_scheduler, "submit", submit)
+    asyncio.run(server.process_unlimited_video_generation([("race", request)]))
+
+    assert server.task_store.get("race").status == "cancelled"
+    assert submitted == []
+    assert "race" not in server.resume_checkpoints
+    assert not server.checkpoint_dir_for("race").exists()
+    server.task_store.delete("race")
+
+
+def test_cancelled_task_removes_stream_dir(tmp_path, monkeypatch):
+    """处理中取消的任务，工作进程停止后删除已写入的直播分段"""
+    monkeypatch.setenv("SKYREELS_CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(server, "stream_dir_for", lambda task_id: tmp_path / "streams" / task_id)
+    request = server.UnlimitedVideoRequest(prompt="cancel stream", duration=2, resolution="480p")
+    add_task("cancel-stream", request)
+
+    async def run_batch(gpu_id, items):
+        stream_dir = server.stream_dir_for("cancel-stream")
+        stream_dir.mkdir(parents=True)
+        (stream_dir / "segment_00000.ts").write_bytes(b"ts")
+        server.task_store.update("cancel-stream", status="cancelled")
+        return [server.TaskInterrupted("cancelled")]
+
+    monkeypatch.setattr(server.worker_pool, "run_batch", run_batch)
+    monkeypatch.setattr(server.worker_pool, "can_pipeline", lambda: False)
+    asyncio.run(server.process_unlimited_video_generation([("cancel-stream", request)]))
+
+    assert server.task_store.get("cancel-stream").status == "cancelled"
+    assert not server.stream_dir_for("cancel-stream").exists()
+    server.task_store.delete("cancel-stream")
+
+
+def parse_sse(text: str) -> list:
+    """把SSE响应体拆成事件列表：保活注释为 "keepalive"，进度事件为解析后的JSON"""
+    events = []
+    for block in filter(None, text.split("\n\n")):
+        if block.startswith(":"):
+            events.append("keepalive")
+        else:
+            name, data = block.split("\n")
+            assert name == "event: progress"
+            events.append(json.loads(data[len("data: "):]))
+    return events
+
+
+def test_sse_events_are_ordered_keepalive_and_end_on_terminal_state(monkeypatch):
+    """SSE先推送完整状态，空闲时发送保活注释，之后按顺序推送变化字段，任务结束后关闭连接并取消订阅"""
+    import httpx
+    monkeypatch.setattr(server.progress_hub, "keepalive_seconds", 0.05)
+    request = server.UnlimitedVideoRequest(prompt="sse", duration=2, resolution="480p")
+    add_task("sse", request)
+
+    async def scenario():
+        async def drive():
+            await asyncio.sleep(0.2)
+            for update in ({"status": "processing", "progress": 0.25, "stage": "生成视频关键帧"},
+                           {"progress": 0.5}, {"progress": 0.5},
+                           {"status": "completed", "progress": 1.0}):
+                server.task_store.update("sse", **update)
+                server.progress_hub.flush()
+                await asyncio.sleep(0.01)
+
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            driver = asyncio.create_task(drive())
+            response = await asyncio.wait_for(client.get("/tasks/sse/events"), 10)
+            await driver
+        return response
+
+    try:
+        response = asyncio.run(scenario())
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = parse_sse(response.text)
+        assert events[0] == {"task_id": "sse", "status": "queued", "progress": 0.0, "stage": None,
+                             "estimated_completion": None, "error": None}
+        first_update = next(index for index, event in enumerate(events) if index > 0 and event != "keepalive")
+        assert "keepalive" in events[1:first_update]
+        progress = [event for event in events[1:] if event != "keepalive"]
+        # 只推送变化字段，重复的进度不再推送；completed之后连接关闭
+        assert progress == [{"status": "processing", "progress": 0.25, "stage": "生成视频关键帧", "task_id": "sse"},
+                            {"progress": 0.5, "task_id": "sse"},
+                            {"status": "completed", "progress": 1.0, "task_id": "sse"}]
+        assert events[-1]["status"] == "completed"
+        assert "sse" not in server.progress_hub._subscribers
+
+        # 已结束的任务只推送一次完整状态后立即关闭
+        finished = parse_sse(TestClient(server.app).get("/tasks/sse/events").text)
+        assert finished == [dict(events[0], status="completed", progress=1.0, stage="生成视频关键帧")]
+    finally:
+        server.task_store.delete("sse")
+
+
+def test_websocket_events_follow_subscriptions():
+    """WebSocket订阅后先收到完整状态，之后按顺序收到变化；未知任务返回错误；任务结束后自动取消订阅"""
+    request = server.UnlimitedVideoRequest(prompt="ws", duration=2, resolution="480p")
+    add_task("ws", request)
+
+    def update(**fields):
+        server.task_store.update("ws", **fields)
+        server.progress_hub.flush()
+
+    try:
+        with TestClient(server.app).websocket_connect("/ws/tasks") as ws:
+            ws.send_json({"subscribe": ["ws"]})
+            assert ws.receive_json()["status"] == "queued"
+            ws.send_json({"subscribe": ["ghost"]})
+            assert ws.receive_json() == {"task_id": "ghost", "error": "任务未找到"}
+            ws.portal.call(lambda: update(status="processing", progress=0.4))
+            assert ws.receive_json() == {"status": "processing", "progress": 0.4, "task_id": "ws"}
+            ws.portal.call(lambda: update(status="failed", error="boom"))
+            assert ws.receive_json() == {"status": "failed", "error": "boom", "task_id": "ws"}
+            for _ in range(100):
+                if "ws" not in server.progress_hub._subscribers:
+                    break
+                time.sleep(0.01)
+            assert "ws" not in server.progress_hub._subscribers
+    finally:
+        server.task_store.delete("ws")
+
+
+def test_stream_segment_unknown_task_is_404(tmp_path, monkeypatch):
+    """未知任务的分段请求返回404，即使目录里残留同名文件"""
+    monkeypatch.setattr(server, "stream_dir_for", lambda task_id: tmp_path / task_id)
+    (tmp_path / "ghost").mkdir()
+    (tmp_path / "ghost" / "segment_00000.ts").write_bytes(b"ts")
+    response = TestClient(server.app).get("/tasks/ghost/stream/segment_00000.ts")
+    assert response.status_code == 404
+    assert response.json()["detail"] == "任务未找到"
+
+
+def first_video_pts(path: Path) -> float:
+    """读取MPEG-TS文件中第一个视频PES包的PTS（秒）"""
+    data = path.read_bytes()
+    for offset in range(0, len(data) - 187, 188):
+        packet = data[offset:offset + 188]
+        if packet[0] != 0x47 or not packet[1] & 0x40:
+            continue
+        start = 4 + (1 + packet[4] if packet[3] & 0x20 else 0)
+        payload = packet[start:]
+        if payload[:3] == b"\x00\x00\x01" and 0xE0 <= payload[3] <= 0xEF and payload[7] & 0x80:
+            b = payload[9:14]
+            pts = ((b[0] >> 1) & 7) << 30 | b[1] << 22 | (b[2] >> 1) << 15 | b[3] << 7 | b[4] >> 1
+            return pts / 90000
+    raise AssertionError(f"{path} 中没有视频PTS")
+
+
+def test_hls_segments_have_increasing_timestamps(tmp_path):
+    """每个分段的时间戳从它在整个视频中的起始时间开始，播放列表中相邻分段连续"""
+    fps, segments = 24, server.plan_segments(40, 17, 5)
+    starts = []
+    for segment in segments:
+        frames = np.full((segment["num_frames"] - segment["condition_frames"], 64, 64, 3), 40 * segment["index"], np.uint8)
+        path = tmp_path / f"segment_{segment['index']:05d}.ts"
+        server.write_video_segment(path, frames, fps, segment["start_frame"] / fps)
+        starts.append(first_video_pts(path))
+    offsets = [start - segment["start_frame"] / fps for start, segment in zip(starts, segments)]
+    assert all(later > earlier for earlier, later in zip(starts, starts[1:]))
+    # 编码器的固定起始延迟在各分段之间相同，分段之间的间隔等于前一段的时长
+    assert max(offsets) - min(offsets) < 1e-3
+
+
+def test_silent_audio_is_generated_in_the_mux(tmp_path):
+    """未配置音频模型时不写静音音频文件，拼接时由anullsrc生成音轨；有音轨文件时混流该文件"""
+    output = str(tmp_path / "out.mp4")
+    assert server.SilentAudioPipeline().generate({}, 7200.0, tmp_path / "audio.wav") is None
+    assert not (tmp_path / "audio.wav").exists()
+
+    silent = server.concat_command(tmp_path / "segments.txt", output, silent_audio=True)
+    assert silent[silent.index("-f", silent.index("-i")):silent.index("-i", silent.index("-i") + 1) + 2] == [
+        "-f", "lavfi", "-i", "anullsrc=channel_layout=stereo:sample_rate=48000"]
+    muxed = server.concat_command(tmp_path / "segments.txt", output, tmp_path / "voice.wav")
+    assert muxed[muxed.index("-i", muxed.index("-i") + 1) + 1] == str(tmp_path / "voice.wav")
+    for command in (silent, muxed):
+        assert command[command.index("-map"):command.index("-shortest") + 1] == [
+            "-map", "0:v", "-map", "1:a", "-c:v", "copy", "-c:a", "aac", "-b:a", "192k", "-shortest"]
+        assert command[-1] == output
+    plain = server.concat_command(tmp_path / "segments.txt", output)
+    assert "-map" not in plain and plain[plain.index("-c"):plain.index("-c") + 2] == ["-c", "copy"]
+
+
+class RecordingAudio(server.AudioPipeline):
+    """记录生成时间窗口的音频插件"""
+    name = "recording"
+
+    def __init__(self):
+        self.window = []
+
+    def generate(self, job, duration, output_path):
+        self.window.append(time.perf_counter())
+        time.sleep(0.3)
+        output_path.write_bytes(b"RIFF")
+        self.window.append(time.perf_counter())
+        return output_path
+
+
+def test_audio_stage_runs_alongside_denoising(tmp_path, monkeypatch):
+    """音轨在任务开始时提交，与去噪步并行生成，拼接时混流后删除"""
+    monkeypatch.setenv("SKYREELS_CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(server, "stream_dir_for", lambda task_id: tmp_path / "streams" / task_id)
+    monkeypatch.setattr(server, "video_output_path", lambda job: str(tmp_path / f"{job['task_id']}.mp4"))
+    muxed = []
+
+    def concat(paths, output, audio_path=None, silent_audio=False):
+        muxed.append((audio_path, silent_audio, Path(audio_path).exists() if audio_path else None))
+        Path(output).write_bytes(b"")
+
+    monkeypatch.setattr(server, "concat_video_segments", concat)
+    audio = RecordingAudio()
+    stage = server.AudioStage("recording", "cpu")
+    stage._pipeline = audio
+    monkeypatch.setattr(server, "_audio_stage", stage)
+
+    pipeline = server.SimulatedVideoPipeline()
+    pipeline.step_seconds = 0.02
+    steps = []
+
+    def observe(name, value, stage=None):
+        if name == "denoise_step":
+            steps.append(time.perf_counter())
+
+    job = {"task_id": "audio", "prompt": "audio", "resolution": "480p", "duration": 2, "fps": 24,
+           "num_inference_steps": 10, "seed": 1, "enable_audio": True}
+    server.SegmentedGenerationEngine(pipeline).run(job, lambda *args: None, observe)
+
+    audio_start, audio_end = audio.window
+    assert audio_start < steps[-1] and audio_end > steps[0]
+    assert muxed == [(tmp_path / "streams" / "audio" / "audio.wav", False, True)]
+    assert not (tmp_path / "streams" / "audio" / "audio.wav").exists()
+
+    stage._pipeline = server.SilentAudioPipeline()
+    server.SegmentedGenerationEngine(pipeline).run(dict(job, task_id="silent"), lambda *args: None)
+    assert muxed[-1] == (None, True, None)
+
+
+def test_telemetry_sampler_keeps_latest_and_history():
+    """采样写入最新结果和环形缓冲区，采样失败保留上一次结果，后台线程按间隔采样"""
+    backend = server.FakeTelemetryBackend(gpu_count=2, total_gb=80.0, used_gb=4.0)
+    sampler = server.GPUTelemetrySampler(backend, interval=0.01, history_size=3)
+    sampler.sample_once()
+    latest = sampler.latest()
+    assert latest["backend"] == "fake" and latest["total_gpus"] == 2 and latest["total_memory"] == 160.0
+    assert [gpu["free"] for gpu in latest["gpus"]] == [76.0, 76.0]
+
+    backend.used_gb = 10.0
+    sampler.sample_once()
+    assert [entry["allocated"] for entry in sampler.history()] == [[4.0, 4.0], [10.0, 10.0]]
+    assert sampler.history(window_seconds=-1) == []
+
+    backend.sample = lambda: 1 / 0
+    sampler.sample_once()
+    assert sampler.latest()["gpus"][0]["allocated"] == 10.0
+
+    backend.sample = server.FakeTelemetryBackend.sample.__get__(backend)
+    sampler.start()
+    try:
+        for _ in range(200):
+            if len(sampler.history()) == 3:
+                break
+            time.sleep(0.01)
+    finally:
+        sampler.stop()
+    assert len(sampler.history()) == 3  # 环形缓冲区只保留history_size个采样
+
+
+def test_task_progress_attaches_latest_gpu_stats(monkeypatch):
+    """进度回调把采样器的最新结果附到任务上，不直接访问CUDA"""
+    sampler = server.GPUTelemetrySampler(server.FakeTelemetryBackend(used_gb=7.0))
+    sampler.sample_once()
+    monkeypatch.setattr(server, "gpu_telemetry", sampler)
+    monkeypatch.setattr(server.worker_pool, "can_pipeline", lambda: False)
+    monkeypatch.setattr(server.torch.cuda, "mem_get_info", lambda *args: pytest.fail("不应访问CUDA"))
+    request = server.UnlimitedVideoRequest(prompt="telemetry", duration=2, resolution="480p")
+    add_task("telemetry", request)
+    seen = {}
+
+    async def run_batch(gpu_id, items):
+        (task_id, job, on_progress), = items
+        on_progress({"stage": "denoise", "progress": 0.5})
+        seen["gpu_stats"] = server.task_store.get(task_id).gpu_stats
+        return [RuntimeError("stop after progress")]
+
+    monkeypatch.setattr(server.worker_pool, "run_batch", run_batch)
+    asyncio.run(server.process_unlimited_video_generation([("telemetry", request)]))
+    assert seen["gpu_stats"] == sampler.latest()
+    assert seen["gpu_stats"]["gpus"][0]["allocated"] == 7.0
+    server.task_store.delete("telemetry")
+
+
+def test_telemetry_backend_fallback(monkeypatch):
+    """auto: NVML不可用时回退到torch；显式nvml时报错；fake按SKYREELS_FAKE_GPU_COUNT模拟GPU"""
+    monkeypatch.setitem(sys.modules, "pynvml", None)
+    backend = server.create_telemetry_backend("auto")
+    assert isinstance(backend, server.TorchTelemetryBackend)
+    assert len(backend.sample()) == torch.cuda.device_count()
+    with pytest.raises(ImportError):
+        server.create_telemetry_backend("nvml")
+
+    class FakeNVML:
+        """最小的pynvml替身：一块GPU"""
+        @staticmethod
+        def nvmlInit():
+            pass
+
+        @staticmethod
+        def nvmlDeviceGetCount():
+            return 1
+
+        @staticmethod
+        def nvmlDeviceGetHandleByIndex(index):
+            return index
+
+        @staticmethod
+        def nvmlDeviceGetName(handle):
+            return b"NVML GPU"
+
+        @staticmethod
+        def nvmlDeviceGetMemoryInfo(handle):
+            return SimpleNamespace(used=2 * 1024**3, free=6 * 1024**3, total=8 * 1024**3)
+
+        @staticmethod
+        def nvmlDeviceGetUtilizationRates(handle):
+            return SimpleNamespace(gpu=55)
+
+    monkeypatch.setitem(sys.modules, "pynvml", FakeNVML)
+    backend = server.create_telemetry_backend("auto")
+    assert backend.name == "nvml"
+    assert backend.sample() == [{"gpu_id": 0, "name": "NVML GPU", "allocated": 2.0, "cached": 2.0,
+                                 "free": 6.0, "total": 8.0, "utilization": 55}]
+
+    monkeypatch.setenv("SKYREELS_FAKE_GPU_COUNT", "3")
+    backend = server.create_telemetry_backend("fake")
+    assert backend.name == "fake" and len(backend.sample()) == 3
+
+
+class CountingEncoder:
+    """记录调用次数的文本编码器，每条文本返回不同的嵌入"""
+
+    def __init__(self, offset: float = 0.0):
+        self.calls = []
+        self.offset = offset
+
+    def encode(self, text, *args, **kwargs):
+        self.calls.append(text)
+        return torch.full((4, 8), float(len(self.calls)) + self.offset)
+
+
+def test_embedding_cache_hits_and_separates_keys(tmp_path):
+    """相同文本（空白归一化后）命中缓存；负向提示词和不同模型的编码器各自缓存；磁盘层跨实例共享"""
+    cache = server.PromptEmbeddingCache(1024**2, str(tmp_path / "embeddings"))
+    df, other = CountingEncoder(), CountingEncoder(offset=100.0)
+    encode_df = cache.wrap(df.encode, "/models/df:T5", "cpu")
+    encode_other = cache.wrap(other.encode, "/models/df540:T5", "cpu")
+
+    prompt = encode_df("a quiet lake")
+    assert torch.equal(encode_df("  a quiet   lake "), prompt)
+    negative = encode_df("blurry, low quality")
+    assert not torch.equal(negative, prompt)
+    assert torch.equal(encode_df("blurry, low quality"), negative)
+    assert df.calls == ["a quiet lake", "blurry, low quality"]
+
+    # 另一个模型的编码器不复用df的嵌入
+    assert torch.equal(encode_other("a quiet lake"), torch.full((4, 8), 101.0))
+    assert other.calls == ["a quiet lake"]
+    assert cache.stats == {"memory_hit": 2, "disk_hit": 0, "miss": 3}
+
+    # 非单条字符串的调用原样透传，不缓存
+    encode_df(["a quiet lake"])
+    assert df.calls[-1] == ["a quiet lake"]
+
+    fresh = server.PromptEmbeddingCache(1024**2, str(tmp_path / "embeddings"))
+    reloaded = fresh.wrap(CountingEncoder(offset=-50.0).encode, "/models/df:T5", "cpu")
+    assert torch.equal(reloaded("a quiet lake"), prompt)
+    assert fresh.stats["disk_hit"] == 1
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    """内存层按字节数限制，淘汰最久未使用的条目；超过上限的单个张量不进入内存层"""
+    tensor_bytes = 4 * 8 * 4
+    cache = server.PromptEmbeddingCache(2 * tensor_bytes)
+    keys = [cache.make_key("enc", text) for text in ("a", "b", "c")]
+    cache.put(keys[0], torch.zeros(4, 8))
+    cache.put(keys[1], torch.ones(4, 8))
+    assert cache.get(keys[0]) is not None  # a成为最近使用
+    cache.put(keys[2], torch.full((4, 8), 2.0))
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+    assert cache._bytes == 2 * tensor_bytes
+
+    cache.put(cache.make_key("enc", "huge"), torch.zeros(3, 4, 8))
+    assert cache.get(cache.make_key("enc", "huge")) is None
+    assert cache._bytes == 2 * tensor_bytes
+
+
+def test_eta_estimator_fits_and_falls_back_by_level(tmp_path):
+    """按 (分辨率, 步数, GPU) 拟合：完全匹配、其他步数、其他分辨率按像素缩放、其他GPU，依次回退"""
+    path = tmp_path / "eta.json"
+    estimator = server.ETAEstimator(str(path))
+    assert estimator.predict("480p", 10, 48, "GPU A") == (None, "default")
+
+    estimator.record("480p", 10, "GPU A", 48, {"model_init": 5.0, "denoise": 96.0, "encode": 8.0, "audio": 4.0})
+    # setup 5s + 48帧 × (10步 × 0.2s + 0.25s)
+    assert estimator.predict("480p", 10, 48, "GPU A") == (pytest.approx(113.0), "exact")
+    assert estimator.predict("480p", 20, 48, "GPU A") == (pytest.approx(5.0 + 48 * (20 * 0.2 + 0.25)), "steps")
+    scale = 720 * 1280 / (480 * 832)
+    assert estimator.predict("720p", 10, 48, "GPU A") == (pytest.approx(5.0 + 48 * scale * (10 * 0.2 + 0.25)),
+                                                          "resolution")
+    assert estimator.predict("480p", 10, 48, "GPU B")[1] == "other_gpu"
+
+    # 指数滑动平均，且持久化后可重新加载
+    estimator.record("480p", 10, "GPU A", 48, {"model_init": 15.0, "denoise": 192.0, "encode": 24.0})
+    entry = estimator.stats["480p|10|GPU A"]
+    assert entry["n"] == 2 and entry["setup"] == pytest.approx(8.0) and entry["denoise"] == pytest.approx(0.26)
+    assert server.ETAEstimator(str(path)).predict("480p", 10, 48, "GPU A") == estimator.predict("480p", 10, 48, "GPU A")
+
+
+@pytest.mark.parametrize("slots, expected", [(1, [150.0, 250.0, 350.0]), (2, [100.0, 150.0, 200.0])])
+def test_queue_etas_model_concurrent_slots(monkeypatch, slots, expected):
+    """每个GPU有多个执行槽位时排队任务并行占用槽位；执行中任务占用一个槽位直到其预计完成时间"""
+    scheduler = server.GPUJobScheduler(1, max_concurrent_per_gpu=slots)
+    monkeypatch.setattr(server, "job_scheduler", scheduler)
+    monkeypatch.setattr(server, "predict_generation_seconds", lambda request, gpu_id=0: (100.0, "exact"))
+    request = server.UnlimitedVideoRequest(prompt="eta", duration=2, resolution="480p")
+    task_ids = [f"eta-{slots}-{name}" for name in ("running", "q1", "q2", "q3")]
+    for task_id in task_ids:
+        add_task(task_id, request)
+    now = datetime.now()
+    server.task_store.update(task_ids[0], status="processing", estimated_completion=now + server.timedelta(seconds=50))
+    scheduler.running[task_ids[0]] = 0
+
+    async def enqueue():
+        for task_id in task_ids[1:]:
+            await scheduler.submit(task_id, request)
+    asyncio.run(enqueue())
+    try:
+        server.refresh_queue_etas()
+        etas = [(server.task_store.get(task_id).estimated_completion - now).total_seconds() for task_id in task_ids[1:]]
+        assert etas == pytest.approx(expected, abs=1.0)
+    finally:
+        for task_id in task_ids:
+            server.task_store.delete(task_id)
+
+
+def test_plan_segments_rejects_window_not_larger_than_overlap():
+    """窗口不大于重叠帧数时报错，而不是死循环"""
+    for segment_frames, overlap_frames in ((17, 17), (9, 17), (97, -1)):
+        with pytest.raises(ValueError):
+            server.plan_segments(200, segment_frames, overlap_frames)
+    segments = server.plan_segments(200, 97, 17)
+    assert sum(s["num_frames"] - s["condition_frames"] for s in segments) == 200
+
+
+def test_memory_planner_validates_segment_window(monkeypatch):
+    monkeypatch.setenv("SKYREELS_SEGMENT_FRAMES", "17")
+    monkeypatch.setenv("SKYREELS_OVERLAP_FRAMES", "17")
+    with pytest.raises(ValueError):
+        server.MemoryPlanner()
+
+    # 缩小窗口的方案放不下重叠帧：显式请求时拒绝，自动选择时跳过
+    monkeypatch.setenv("SKYREELS_SEGMENT_FRAMES", "25")
+    planner = server.MemoryPlanner()
+    assert planner.window_frames("cpu_offload_small_window") <= planner.overlap_frames
+    request = server.UnlimitedVideoRequest(prompt="small window", duration=2, resolution="480p",
+                                           execution_plan="cpu_offload_small_window")
+    decision = planner.plan(request)
+    assert decision["plan"] is None and "重叠帧数" in decision["reason"]
+    request.execution_plan = None
+    assert planner.plan(request)["plan"] != "cpu_offload_small_window"
+
+
+def test_sqlite_store_throttles_progress_writes(tmp_path):
+    """进度心跳节流写库，状态变化立即写入，关闭时补写未写库的进度"""
+    store = server.SQLiteTaskStore(str(tmp_path / "tasks.db"), progress_save_seconds=3600)
+    store.load()
+    now = datetime.now()
+    store.add(server.TaskStatus(task_id="t", status="processing", created_at=now, updated_at=now,
+                                generation_params={}))
+
+    def stored():
+        conn = sqlite3.connect(tmp_path / "tasks.db")
+        try:
+            return server.TaskStatus.model_validate_json(
+                conn.execute("SELECT data FROM tasks WHERE task_id = 't'").fetchone()[0])
+        finally:
+            conn.close()
+
+    for step in range(100):
+        store.update("t", progress=step / 100, stage="去噪", gpu_stats={"gpus": []})
+    assert store.get("t").progress == 0.99
+    assert stored().progress == 0.0
+
+    store.update("t", status="completed", progress=1.0)
+    assert stored().status == "completed" and stored().progress == 1.0
+
+    store.add(server.TaskStatus(task_id="u", status="processing", created_at=now, updated_at=now,
+                                generation_params={}))
+    store.update("u", progress=0.5)
+    store.close()
+    reopened = server.SQLiteTaskStore(str(tmp_path / "tasks.db"))
+    reopened.load()
+    assert reopened.get("u").progress == 0.5
+    reopened.close()
+
+
+def test_interval_checkpoint_does_not_wait_for_encoder(tmp_path, monkeypatch):
+    """窗口内的定时checkpoint在前一分段仍在编码时推迟，不阻塞去噪循环"""
+    monkeypatch.setenv("SKYREELS_CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(server, "stream_dir_for", lambda task_id: tmp_path / "streams" / task_id)
+    engine = server.SegmentedGenerationEngine(server.SimulatedVideoPipeline())
+    engine.checkpoint_interval = 0
+    job = {"task_id": "interval", "duration": 2, "fps": 24, "num_inference_steps": 4, "seed": 1}
+    session = server.GenerationSession(engine, "df", job, lambda *args: None, lambda *args: None)
+    encoding = Future()
+    session.context["encodes"].append(encoding)
+
+    engine.pipeline.step_batch([session.state])
+    started = time.perf_counter()
+    assert session.after_step() is False
+    assert time.perf_counter() - started < 0.5
+    assert server.read_checkpoint("interval") is None
+
+    encoding.set_result(None)
+    engine.pipeline.step_batch([session.state])
+    session.after_step()
+    checkpoint = server.read_checkpoint("interval")
+    assert checkpoint is not None and checkpoint["segment_state"] == {"step": 2}
+
+
+def test_encode_backlog_only_pauses_the_owning_session(tmp_path, monkeypatch):
+    """连续批处理中一个任务的分段编码积压时只暂停该任务，同批的其他任务继续去噪直到完成"""
+    monkeypatch.setenv("SKYREELS_CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(server, "stream_dir_for", lambda task_id: tmp_path / "streams" / task_id)
+    monkeypatch.setattr(server, "video_output_path", lambda job: str(tmp_path / f"{job['task_id']}.mp4"))
+    monkeypatch.setattr(server, "concat_video_segments", lambda paths, output, *audio: Path(output).write_bytes(b"mp4"))
+    monkeypatch.setattr(server, "_segment_encoder", server.SegmentEncoder(1))
+    gate = __import__("threading").Event()
+
+    def write_video_segment(path, frames, fps, start_seconds=0.0):
+        if "slow" in str(path):
+            gate.wait(30)
+        Path(path).write_bytes(b"ts")
+    monkeypatch.setattr(server, "write_video_segment", write_video_segment)
+
+    def job(task_id):
+        return {"task_id": task_id, "prompt": task_id, "resolution": "480p", "duration": 8, "fps": 24,
+                "num_inference_steps": 4, "guidance_scale": 6.0, "seed": 1, "enable_audio": False}
+
+    async def scenario():
+        pool = server.GPUWorkerPool(["cpu"], "simulated", "inline")
+        pool.start()
+        try:
+            for _ in range(500):
+                if pool.workers[0]["supports_step_batching"]:
+                    break
+                await asyncio.sleep(0.01)
+            batch = asyncio.create_task(pool.run_batch(0, [(task_id, job(task_id), lambda message: None)
+                                                           for task_id in ("slow", "fast")]))
+            await asyncio.sleep(0.05)
+            fast = pool._pending["fast"]["future"]
+            slow = pool._pending["slow"]["future"]
+            await asyncio.wait_for(asyncio.shield(fast), 20)
+            # 慢任务第一个分段仍在编码：它在提交第二段后暂停，没有拖住快任务
+            assert not slow.done() and server.get_segment_encoder().saturated("slow")
+            gate.set()
+            return await asyncio.wait_for(batch, 20)
+        finally:
+            gate.set()
+            await pool.stop()
+
+    results = asyncio.run(scenario())
+    assert results == [str(tmp_path / "slow.mp4"), str(tmp_path / "fast.mp4")]
+
+
+def test_segment_encoder_submit_never_blocks():
+    """submit不阻塞；按提交方计数，除正在编码的一段外还有max_pending段排队时饱和"""
+    gate = __import__("threading").Event()
+    encoder = server.SegmentEncoder(1)
+    encoder._encode = lambda path, frames, fps, on_done, future, start_seconds: (gate.wait(10), future.set_result(path))
+    started = time.perf_counter()
+    futures = [encoder.submit(Path(f"a{i}.ts"), None, 24, owner="a") for i in range(4)]
+    assert time.perf_counter() - started < 0.5
+    assert encoder.saturated("a") and not encoder.saturated("b")
+    assert encoder.wait_ready(["a", "b"], timeout=0) and not encoder.wait_ready(["a"], timeout=0.01)
+    gate.set()
+    assert encoder.wait_ready(["a"], timeout=10)
+    assert [future.result(10) for future in futures] == [Path(f"a{i}.ts") for i in range(4)]
+
+
+def test_frame_ring_put_never_waits_and_reclaims_dead_worker_slots():
+    """槽位用尽时立即退回pickle；工作进程退出后回收发往它的槽位和它创建的共享内存"""
+    frames = np.full((2, 512, 1024, 3), 7, np.uint8)
+    ring = server.SharedFrameRing(2, frames.nbytes)
+    try:
+        assert ring.put(frames, owner=0) is not None
+        assert ring.put(frames, owner=1) is not None
+        started = time.perf_counter()
+        assert ring.pack({"condition": frames}, owner=0)["condition"] is frames
+        assert time.perf_counter() - started < 0.05
+        assert ring.in_flight() == 2
+
+        ring.release(0)
+        assert ring.in_flight() == 1
+        assert ring.put(frames, owner=0) is not None
+
+        # 工作进程写入自己的环后退出，API进程映射过的共享内存随release删除
+        worker_ring = server.SharedFrameRing(1, frames.nbytes)
+        descriptor = worker_ring.put(frames)
+        name = descriptor["__shared_frames__"]
+        assert (ring.unpack({"condition": descriptor}, owner=1)["condition"] == 7).all()
+        worker_ring._shm.close()
+        ring.release(1)
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=name)
+    finally:
+        ring.close()
+
+
+def test_weight_loading_reports_progress_per_shard(tmp_path):
+    """预热和加载都按分片报告进度：每完成一个文件一次，按字节数递增到1.0"""
+    from safetensors.torch import save_file
+    shards = []
+    for index, numel in enumerate((1000, 3000)):
+        shards.append(tmp_path / f"diffusion_pytorch_model-{index + 1:05d}-of-00002.safetensors")
+        save_file({f"blocks.{index}.weight": torch.zeros(numel)}, str(shards[-1]))
+    torch.save({"weight": torch.zeros(10)}, tmp_path / "Wan2.1_VAE.pth")
+    weights = server.index_model_weights(tmp_path)
+    sizes = [path.stat().st_size for path in weights["files"]]
+    assert weights["tensors"] == 2 and len(weights["files"]) == 3
+
+    prefetched = []
+    server.prefetch_files(weights["files"], prefetched.append, workers=1)
+    assert prefetched == pytest.approx([sum(sizes[:n]) / sum(sizes) for n in (1, 2, 3)])
+
+    # 官方加载器在构造期间按属性调用safetensors.torch.load_file和torch.load
+    import safetensors.torch
+    loaded = []
+    with server.weight_load_progress(shards, loaded.append):
+        safetensors.torch.load_file(str(shards[1]))
+        torch.load(tmp_path / "Wan2.1_VAE.pth")  # 不在列表中的文件不计入
+        safetensors.torch.load_file(str(shards[0]))
+        safetensors.torch.load_file(str(shards[0]))  # 重复加载不重复计入
+    safetensors.torch.load_file(str(shards[0]))  # with块外不再回调
+    shard_sizes = [path.stat().st_size for path in shards]
+    assert loaded == pytest.approx([shard_sizes[1] / sum(shard_sizes), 1.0])
+
+
+def test_download_supports_range_if_range_and_etag(tmp_path):
+    """下载接口：完整响应、Range续传、If-Range不匹配时返回完整文件、If-None-Match返回304"""
+    video = tmp_path / "video.mp4"
+    payload = bytes(range(256)) * 4096
+    video.write_bytes(payload)
+    request = server.UnlimitedVideoRequest(prompt="download", duration=2, resolution="480p")
+    add_task("download", request, status="completed")
+    server.task_store.update("download", result_path=str(video))
+    client = TestClient(server.app)
+    try:
+        full = client.get("/tasks/download/download")
+        assert full.status_code == 200 and full.content == payload
+        etag = full.headers["etag"]
+        assert full.headers["accept-ranges"] == "bytes"
+
+        partial = client.get("/tasks/download/download", headers={"Range": "bytes=1000-"})
+        assert partial.status_code == 206 and partial.content == payload[1000:]
+        assert partial.headers["content-range"] == f"bytes 1000-{len(payload) - 1}/{len(payload)}"
+
+        resumed = client.get("/tasks/download/download", headers={"Range": "bytes=10-19", "If-Range": etag})
+        assert resumed.status_code == 206 and resumed.content == payload[10:20]
+        changed = client.get("/tasks/download/download", headers={"Range": "bytes=10-19", "If-Range": '"stale"'})
+        assert changed.status_code == 200 and changed.content == payload
+
+        assert client.get("/tasks/download/download", headers={"If-None-Match": etag}).status_code == 304
+        head = client.head("/tasks/download/download")
+        assert head.status_code == 200 and head.content == b""
+        assert client.get("/tasks/download/download",
+                          headers={"Range": f"bytes={len(payload)}-"}).status_code == 416
+    finally:
+        server.task_store.delete("download")
+
+
+def test_download_through_nginx_uses_accel_redirect(tmp_path):
+    """经nginx的请求（X-Sendfile-Type/X-Accel-Mapping）只返回内部URI，映射之外的路径和直连请求照常发送文件"""
+    video = tmp_path / "videos" / "clip 1.mp4"
+    video.parent.mkdir()
+    video.write_bytes(b"mp4" * 1000)
+    request = server.UnlimitedVideoRequest(prompt="accel", duration=2, resolution="480p")
+    add_task("accel", request, status="completed")
+    server.task_store.update("accel", result_path=str(video))
+    client = TestClient(server.app)
+    nginx = {"X-Sendfile-Type": "X-Accel-Redirect", "X-Accel-Mapping": f"/elsewhere/=/_x/,{tmp_path}/=/_outputs/"}
+    try:
+        redirected = client.get("/tasks/accel/download", headers=dict(nginx, Range="bytes=0-9"))
+        assert redirected.status_code == 200 and redirected.content == b""
+        assert redirected.headers["x-accel-redirect"] == "/_outputs/videos/clip%201.mp4"
+        assert redirected.headers["content-type"] == "video/mp4"
+        assert redirected.headers["content-disposition"] == 'attachment; filename="clip 1.mp4"'
+        # If-None-Match仍由API处理
+        etag = redirected.headers["etag"]
+        assert client.get("/tasks/accel/download", headers=dict(nginx, **{"If-None-Match": etag})).status_code == 304
+
+        unmapped = client.get("/tasks/accel/download", headers=dict(nginx, **{"X-Accel-Mapping": "/elsewhere/=/_x/"}))
+        assert "x-accel-redirect" not in unmapped.headers and unmapped.content == video.read_bytes()
+        direct = client.get("/tasks/accel/download")
+        assert "x-accel-redirect" not in direct.headers and direct.content == video.read_bytes()
+    finally:
+        server.task_store.delete("accel")
+
+
+def test_scheduler_orders_by_priority_then_fifo():
+    """高优先级先出队，同优先级先到先出；queue_position为真实排名，取消后后面的任务前移"""
+    scheduler = server.GPUJobScheduler(1, max_concurrent_per_gpu=1)
+    started = []
+
+    async def handler(batch, gpu_id):
+        started.extend(task_id for task_id, _ in batch)
+
+    async def scenario():
+        positions = {}
+        for task_id, priority in (("a", 0), ("b", 5), ("c", 0), ("d", 5), ("e", 10)):
+            positions[task_id] = await scheduler.submit(task_id, task_id, priority=priority)
+        assert positions == {"a": 1, "b": 1, "c": 3, "d": 2, "e": 1}
+        assert [task_id for task_id, _ in scheduler.queued()] == ["e", "b", "d", "a", "c"]
+        assert [scheduler.queue_position(task_id) for task_id in "abcde"] == [4, 2, 5, 3, 1]
+
+        assert scheduler.cancel("b") and not scheduler.cancel("b")
+        assert scheduler.queue_position("b") is None
+        assert [scheduler.queue_position(task_id) for task_id in "acde"] == [3, 4, 2, 1]
+
+        scheduler.start(handler)
+        try:
+            for _ in range(200):
+                if not scheduler.queued() and not scheduler.running:
+                    break
+                await asyncio.sleep(0.005)
+        finally:
+            await scheduler.stop()
+
+    asyncio.run(scenario())
+    assert started == ["e", "d", "a", "c"]
+
+
+def test_full_queue_is_rejected_with_429(monkeypatch):
+    """队列已满时/generate返回429且不留下任务；抢占后的重新排队不受上限限制"""
+    scheduler = server.GPUJobScheduler(1, max_queue_size=1)
+    monkeypatch.setattr(server, "job_scheduler", scheduler)
+    monkeypatch.setattr(server, "task_store", server.TaskStore())
+    client = TestClient(server.app)
+    body = {"prompt": "queue limit", "resolution": "480p", "duration": 2}
+
+    first = client.post("/generate", json=body)
+    assert first.status_code == 200 and first.json()["queue_position"] == 1
+    rejected = client.post("/generate", json=body)
+    assert rejected.status_code == 429 and rejected.json()["detail"] == "任务队列已满 (1)"
+    assert len(server.task_store) == 1 and scheduler.queued()[0][0] == first.json()["task_id"]
+
+    with pytest.raises(server.QueueFullError):
+        asyncio.run(scheduler.submit("direct", None))
+    assert asyncio.run(scheduler.submit("requeued", None, enforce_limit=False)) == 2
+
+
+def test_batch_members_are_admitted_with_the_batch():
+    """合批时每个后续任务都要与已合并的任务一起通过准入，放不下的留在队列"""
+    def admit(payload, gpu_id, alongside):
+        return payload + sum(alongside) <= 10
+
+    async def scenario():
+        scheduler = server.GPUJobScheduler(1, max_concurrent_per_gpu=4, batch_key=lambda payload: "same",
+                                           batch_limit=lambda payload, gpu_id: 4, admit=admit)
+        for index in range(3):
+            await scheduler.submit(f"t{index}", 4)
+        assert scheduler._can_start(0)
+        batch = scheduler._pop_batch(0)
+        return batch, scheduler.queued()
+
+    batch, queued = asyncio.run(scenario())
+    assert [task_id for task_id, _ in batch] == ["t0", "t1"]
+    assert [task_id for task_id, _ in queued] == ["t2"]
+
+
+def test_generate_batch_is_all_or_nothing(monkeypatch):
+    """批内任一任务被拒绝时整批都不入队，之前的任务也不留在任务存储和队列中"""
+    client = TestClient(server.app)
+    before_tasks, before_queue = len(server.task_store), server.job_scheduler.queued()
+    good = {"prompt": "batch ok", "resolution": "480p", "duration": 2}
+    for bad in ({"model": "missing"}, {"execution_plan": "warp_drive"}):
+        response = client.post("/generate/batch", json={"requests": [good, dict(good, **bad), good]})
+        assert response.status_code == 400
+        assert len(server.task_store) == before_tasks
+        assert server.job_scheduler.queued() == before_queue
+
+    # 入队阶段失败（队列在校验之后被占满）时回滚已入队的任务
+    submit = server.job_scheduler.submit
+    calls = []
+
+    async def flaky_submit(task_id, payload, **kwargs):
+        calls.append(task_id)
+        if len(calls) == 2:
+            raise server.QueueFullError("任务队列已满")
+        return await submit(task_id, payload, **kwargs)
+
+    monkeypatch.setattr(server.job_scheduler, "submit", flaky_submit)
+    response = client.post("/generate/batch", json={"requests": [good, good, good]})
+    assert response.status_code == 429
+    assert len(server.task_store) == before_tasks
+    assert server.job_scheduler.queued() == before_queue
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def isolated_store(request, tmp_path, monkeypatch):
+    """替换为独立的任务存储（内存或SQLite），调度器只记录提交"""
+    store = server.TaskStore() if request.param == "memory" else server.SQLiteTaskStore(str(tmp_path / "tasks.db"))
+    store.load()
+    submitted = []
+
+    async def submit(task_id, payload, **kwargs):
+        submitted.append(task_id)
+        return len(submitted)
+
+    monkeypatch.setattr(server, "task_store", store)
+    monkeypatch.setattr(server.job_scheduler, "submit", submit)
+    monkeypatch.setattr(server, "refresh_queue_etas", lambda: None)
+    yield store, submitted
+    store.close()
+
+
+def lookups(result: str) -> float:
+    return server.RESULT_CACHE_LOOKUPS.labels(result=result)._value.get()
+
+
+def test_identical_request_reuses_inflight_and_completed_task(isolated_store, tmp_path):
+    """固定seed的相同请求：执行中时合并到同一任务，完成后直接返回结果，不再提交调度器"""
+    store, submitted = isolated_store
+    client = TestClient(server.app)
+    body = {"prompt": "cache me", "resolution": "480p", "duration": 2, "seed": 7}
+    first = client.post("/generate", json=body).json()
+    assert first["cached"] is False
+
+    hits, inflight = lookups("hit"), lookups("inflight")
+    queued = client.post("/generate", json=body).json()
+    assert queued["task_id"] == first["task_id"] and queued["cached"] is True and queued["status"] == "queued"
+    store.update(first["task_id"], status="processing")
+    running = client.post("/generate", json=body)
+    assert running.json()["task_id"] == first["task_id"] and running.json()["status"] == "processing"
+    assert lookups("inflight") == inflight + 2
+
+    video = tmp_path / "cached.mp4"
+    video.write_bytes(b"mp4")
+    store.update(first["task_id"], status="completed", result_path=str(video))
+    completed = client.post("/generate", json=body).json()
+    assert completed["task_id"] == first["task_id"] and completed["status"] == "completed" and completed["cached"]
+    assert lookups("hit") == hits + 1
+    assert submitted == [first["task_id"]]
+
+    # 参数不同或未设置seed时不复用
+    assert client.post("/generate", json=dict(body, seed=8)).json()["cached"] is False
+    assert client.post("/generate", json=dict(body, seed=None)).json()["cached"] is False
+    assert len(submitted) == 3
+
+
+@pytest.mark.parametrize("outcome", ["failed", "cancelled", "evicted"])
+def test_failed_cancelled_or_evicted_task_is_never_served_from_cache(isolated_store, tmp_path, outcome):
+    """失败、取消或结果文件已被淘汰的任务不作为缓存结果返回，相同请求重新生成"""
+    store, submitted = isolated_store
+    client = TestClient(server.app)
+    body = {"prompt": f"do not reuse {outcome}", "resolution": "480p", "duration": 2, "seed": 11}
+    first = client.post("/generate", json=body).json()
+    if outcome == "evicted":
+        store.update(first["task_id"], status="completed", result_path=str(tmp_path / "gone.mp4"))
+    else:
+        store.update(first["task_id"], status=outcome)
+
+    second = client.post("/generate", json=body).json()
+    assert second["cached"] is False and second["task_id"] != first["task_id"]
+    assert submitted == [first["task_id"], second["task_id"]]
+    # 新任务之后成为缓存命中的对象
+    assert client.post("/generate", json=body).json()["task_id"] == second["task_id"]
+
+
+def metric_samples(client: TestClient) -> dict:
+    """抓取/metrics并按 (指标名, 标签) 索引样本值"""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    return {(sample.name, tuple(sorted(sample.labels.items()))): sample.value
+            for family in text_string_to_metric_families(response.text) for sample in family.samples}
+
+
+def test_metrics_expose_counters_and_histograms_that_move_with_a_task(tmp_path, monkeypatch):
+    """/metrics暴露计数器和直方图；在inline工作线程上跑完一个模拟任务后这些值随之变化"""
+    monkeypatch.setenv("SKYREELS_CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(server, "stream_dir_for", lambda task_id: tmp_path / "streams" / task_id)
+    monkeypatch.setattr(server, "video_output_path", lambda job: str(tmp_path / f"{job['task_id']}.mp4"))
+    monkeypatch.setattr(server, "concat_video_segments",
+                        lambda paths, output, *audio: Path(output).write_bytes(
+                            b"".join(Path(path).read_bytes() for path in paths)))
+    client = TestClient(server.app)
+    frames = ("skyreels_frames_generated_total", ())
+    denoise_steps = ("skyreels_denoise_step_seconds_count", ())
+    denoise_stage = ("skyreels_stage_duration_seconds_count", (("stage", "denoise"),))
+    eta_error = ("skyreels_eta_error_ratio_count", ())
+    completed = ("skyreels_tasks", (("status", "completed"),))
+    before = metric_samples(client)
+    for key in (frames, denoise_steps, eta_error, completed):
+        assert key in before
+    assert ("skyreels_eta_error_ratio_bucket", (("le", "+Inf"),)) in before
+    assert ("skyreels_batch_size_bucket", (("le", "1.0"),)) in before
+
+    request = server.UnlimitedVideoRequest(prompt="metrics", duration=2, resolution="480p",
+                                           num_inference_steps=10, enable_audio=False, seed=11)
+    add_task("metrics", request)
+
+    async def scenario():
+        pool = server.GPUWorkerPool(["cpu"], "simulated", "inline")
+        pool.start()
+        monkeypatch.setattr(server, "worker_pool", pool)
+        try:
+            await server.process_unlimited_video_generation([("metrics", request)], gpu_id=0)
+        finally:
+            await pool.stop()
+
+    try:
+        asyncio.run(scenario())
+        assert server.task_store.get("metrics").status == "completed"
+        after = metric_samples(client)
+    finally:
+        server.task_store.delete("metrics")
+    assert after[frames] - before[frames] == request.duration * request.fps
+    assert after[denoise_steps] > before[denoise_steps]
+    assert after[denoise_stage] > before.get(denoise_stage, 0)
+    assert after[eta_error] == before[eta_error] + 1
+    assert after[completed] == before[completed] + 1
+
+
+def test_memory_planner_counts_batch_members(monkeypatch):
+    """同批一起开始的任务计入显存预算"""
+    planner = server.MemoryPlanner()
+    monkeypatch.setattr(planner, "gpu_memory", lambda: [{"total": 80.0, "free": 80.0}])
+    request = server.UnlimitedVideoRequest(prompt="batch", duration=2, resolution="1080p", execution_plan="full_gpu")
+    estimate = planner.estimate(request, "full_gpu")
+    fits = int((80.0 * planner.headroom - estimate["weights_gb"]) // estimate["activation_gb"])
+    assert fits >= 1
+    assert planner.can_start(request, 0, [request] * (fits - 1))
+    assert not planner.can_start(request, 0, [request] * fits)
+
+
+
+def test_memory_planner_respects_live_free_memory(monkeypatch):
+    """准入同时看预留和实时空闲显存：其他进程占用显存时即使GPU上没有任务也要等待"""
+    planner = server.MemoryPlanner()
+    request = server.UnlimitedVideoRequest(prompt="live", duration=2, resolution="720p", execution_plan="full_gpu")
+    estimate = planner.estimate(request, "full_gpu")
+    backend = server.FakeTelemetryBackend(total_gb=80.0)
+    sampler = server.GPUTelemetrySampler(backend)
+    monkeypatch.setattr(server, "gpu_telemetry", sampler)
+    monkeypatch.setattr(server.worker_pool, "model_warm", lambda gpu_id, model: False)
+    sampler.sample_once()
+    assert planner.can_start(request, 0)
+
+    backend.used_gb = 80.0 - estimate["vram_gb"] / planner.headroom + 1
+    sampler.sample_once()
+    assert not planner.can_start(request, 0)
+    # 模型已常驻时权重已在已用显存里，只需放下激活
+    monkeypatch.setattr(server.worker_pool, "model_warm", lambda gpu_id, model: True)
+    assert planner.can_start(request, 0)
+
+    # 预留已经放不下时，实时空闲再多也不开始（刚开始的任务可能还没分配显存）
+    backend.used_gb = 0.0
+    sampler.sample_once()
+    fits = int((80.0 * planner.headroom - estimate["weights_gb"]) // estimate["activation_gb"])
+    for index in range(fits):
+        planner.reserve(f"running-{index}", request, 0)
+    assert not planner.can_start(request, 0)
+    planner.release("running-0")
+    assert planner.can_start(request, 0)
+
+
+def test_scheduler_rechecks_admission_without_notifications():
+    """准入依赖实时显存时，没有任务结束也会定期重新检查"""
+    admitted = {"ok": False}
+    scheduler = server.GPUJobScheduler(gpu_count=1, max_concurrent_per_gpu=1, max_queue_size=10,
+                                       admit=lambda payload, gpu_id, alongside: admitted["ok"],
+                                       admit_poll_seconds=0.01)
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def handler(batch, gpu_id):
+            started.set()
+
+        scheduler.start(handler)
+        try:
+            await scheduler.submit("waiting", "payload")
+            await asyncio.sleep(0.05)
+            assert not started.is_set()
+            admitted["ok"] = True  # 例如其他进程释放了显存
+            await asyncio.wait_for(started.wait(), 1)
+        finally:
+            await scheduler.stop()
+
+    asyncio.run(scenario())
+
+class FakeTransformer:
+    """逐样本独立的DiT替身：输出只依赖本样本的latent、timestep和文本条件"""
+    dtype = None
+
+    def __call__(self, x, t, context, fps):
+        assert x.shape[0] == t.shape[0] == context.shape[0] == len(fps)
+        return (0.3 * x + t[:, None, :, None, None] / 1000
+                + context.mean(dim=(1, 2))[:, None, None, None, None] + torch.sin(x))
+
+
+class FakeTextEncoder:
+    def encode(self, prompt):
+        generator = torch.Generator().manual_seed(sum(map(ord, prompt)))
+        return torch.randn(1, 8, 4, generator=generator)
+
+
+class FakeVAE:
+    """形状与Wan VAE一致：时间压缩4（因果，首帧单独），空间压缩8，16个latent通道"""
+
+    def encode(self, videos):
+        results = []
+        for video in videos:
+            pooled = F.avg_pool3d(video[None], (1, 8, 8))[0]
+            latent = torch.cat([pooled[:, :1], pooled[:, 1:].unflatten(1, (-1, 4)).mean(2)], dim=1)
+            results.append(latent.repeat(6, 1, 1, 1)[:16])
+        return results
+
+    def decode(self, latents):
+        results = []
+        for latent in latents:
+            frames = torch.cat([latent[:, :1], latent[:, 1:].repeat_interleave(4, dim=1)], dim=1)
+            video = torch.tanh(frames[:3]).repeat_interleave(8, dim=2).repeat_interleave(8, dim=3)
+            results.append(video)
+        return results
+
+
+class FakeFlowScheduler:
+    """接口与FlowUniPCMultistepScheduler一致的多步欧拉调度器，保留上一步的sample和模型输出"""
+
+    def __init__(self, num_train_timesteps=1000, shift=1, use_dynamic_shifting=False):
+        self.model_outputs = [None, None]
+        self.last_sample = None
+        self._step_index = None
+
+    def set_timesteps(self, steps, device=None, shift=1.0):
+        sigmas = torch.linspace(1.0, 0.0, steps + 1)
+        self.sigmas = shift * sigmas / (1 + (shift - 1) * sigmas)
+        self.timesteps = self.sigmas[:-1] * 1000
+
+    def step(self, model_output, timestep, sample, return_dict=False, generator=None):
+        if self._step_index is None:
+            self._step_index = 0
+        velocity = model_output
+        if self.model_outputs[-1] is not None and self.last_sample is not None:
+            velocity = 1.5 * model_output - 0.5 * self.model_outputs[-1]
+        self.model_outputs = [self.model_outputs[-1], model_output]
+        self.last_sample = sample
+        sigma, sigma_next = self.sigmas[self._step_index], self.sigmas[self._step_index + 1]
+        self._step_index += 1
+        return (sample + (sigma_next - sigma) * velocity,)
+
+
+def fake_skyreels_pipeline():
+    pipeline = server.SkyReelsV2Pipeline("/nonexistent")
+    pipeline.device = "cpu"
+    pipeline.weight_dtype = torch.float32
+    pipeline.negative_prompt = "blurry"
+    pipeline.scheduler_class = FakeFlowScheduler
+    pipeline.pipe = SimpleNamespace(transformer=FakeTransformer(), text_encoder=FakeTextEncoder(), vae=FakeVAE())
+    return pipeline
+
+
+def skyreels_job(seed, prompt="a quiet lake", guidance=5.0):
+    return {"task_id": f"job{seed}", "prompt": prompt, "resolution": "480p", "fps": 24, "num_inference_steps": 6,
+            "guidance_scale": guidance, "seed": seed, "overlap_frames": 5, "execution_plan": "full_gpu"}
+
+
+def test_skyreels_step_batch_matches_sequential_steps():
+    """同批推进的任务（不同进度、有无CFG、有无前缀）与逐个推进的结果一致"""
+    pipeline = fake_skyreels_pipeline()
+    segment = {"index": 1, "start_frame": 17, "condition_frames": 5, "num_frames": 17}
+    condition = np.random.default_rng(0).integers(0, 255, (5, 480, 832, 3), dtype=np.uint8)
+    jobs = [(skyreels_job(1), None), (skyreels_job(2, "a busy street"), condition),
+            (skyreels_job(3, guidance=1.0), condition)]
+
+    expected = []
+    for job, job_condition in jobs:
+        state = pipeline.begin_segment(job, segment, job_condition)
+        while state["step"] < state["total_steps"]:
+            pipeline.step_batch([state])
+        expected.append(pipeline.finish_segment(state)[0])
+
+    states = [pipeline.begin_segment(job, segment, job_condition) for job, job_condition in jobs]
+    pipeline.step_batch(states[:1])  # 第一个任务先走一步，之后与其他任务处于不同timestep
+    active = list(states)
+    while active:
+        pipeline.step_batch(active)
+        active = [state for state in active if state["step"] < state["total_steps"]]
+    for state, frames in zip(states, expected):
+        result, overlap = pipeline.finish_segment(state)
+        assert result.shape == (17, 480, 832, 3) and result.dtype == np.uint8
+        np.testing.assert_array_equal(result, frames)
+        assert overlap.shape[0] == 5
+
+
+def test_skyreels_checkpoint_restore_continues_the_same_trajectory():
+    """窗口中途导出的去噪状态经weights_only读写后恢复，结果与不中断时一致"""
+    pipeline = fake_skyreels_pipeline()
+    segment = {"index": 0, "start_frame": 0, "condition_frames": 0, "num_frames": 17}
+    job = skyreels_job(7)
+
+    state = pipeline.begin_segment(job, segment, None)
+    while state["step"] < state["total_steps"]:
+        pipeline.step_batch([state])
+    expected = pipeline.finish_segment(state)[0]
+
+    state = pipeline.begin_segment(job, segment, None)
+    for _ in range(3):
+        pipeline.step_batch([state])
+    buffer = io.BytesIO()
+    torch.save(pipeline.checkpoint_segment(state), buffer)
+    buffer.seek(0)
+    restored = pipeline.restore_segment(job, segment, None, torch.load(buffer, weights_only=True))
+    assert restored["step"] == 3
+    while restored["step"] < restored["total_steps"]:
+        pipeline.step_batch([restored])
+    np.testing.assert_array_equal(pipeline.finish_segment(restored)[0], expected)
+
+    # 交接帧由当前步的x0预测解码
+    state = pipeline.begin_segment(job, segment, None)
+    pipeline.step_batch([state])
+    assert pipeline.handoff_condition(state).shape == (5, 480, 832, 3)
+
+
+def run_pipelined_on_fake_devices(tmp_path, monkeypatch, devices, handoff_fraction, duration=8):
+    """在多个CPU"设备"上用模拟管线跑一个多GPU流水线任务，返回 (结果路径, 各分段所在的工作线程)"""
+    monkeypatch.setenv("SKYREELS_CHECKPOINT_DIR", str(tmp_path / "checkpoints"))
+    monkeypatch.setattr(server, "stream_dir_for", lambda task_id: tmp_path / "streams" / task_id)
+    monkeypatch.setattr(server, "video_output_path", lambda job: str(tmp_path / f"{job['task_id']}.mp4"))
+    monkeypatch.setattr(server, "concat_video_segments",
+                        lambda paths, output, *audio: Path(output).write_bytes(
+                            b"".join(Path(path).read_bytes() for path in paths)))
+    job = {"task_id": "pipelined", "prompt": "pipeline", "resolution": "480p", "duration": duration, "fps": 24,
+           "num_inference_steps": 8, "guidance_scale": 6.0, "seed": 3, "enable_audio": False}
+
+    async def scenario():
+        pool = server.GPUWorkerPool(devices, "simulated", "inline")
+        pool.handoff_fraction = handoff_fraction
+        pool.start()
+        try:
+            for _ in range(500):
+                if all(w["supports_step_batching"] for w in pool.workers):
+                    break
+                await asyncio.sleep(0.01)
+            placement = []
+            for worker in pool.workers:
+                send = worker["conn"].send
+
+                def record(message, send=send, worker_id=worker["worker_id"]):
+                    if message.get("type") == "segment":
+                        placement.append((message["segment"]["index"], worker_id))
+                    send(message)
+                worker["conn"].send = record
+            can_pipeline = pool.can_pipeline()
+            result = await pool.run_pipelined(0, "pipelined", job, lambda message: None)
+            return can_pipeline, result, placement
+        finally:
+            await pool.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_pipelined_generation_on_fake_cpu_devices(tmp_path, monkeypatch):
+    """多GPU流水线在3个CPU设备上运行：分段轮流派发，结果按顺序拼接"""
+    can_pipeline, result, placement = run_pipelined_on_fake_devices(tmp_path, monkeypatch, ["cpu"] * 3, 0.5)
+    segments = server.plan_segments(8 * 24, int(os.getenv("SKYREELS_SEGMENT_FRAMES", "97")),
+                                    int(os.getenv("SKYREELS_OVERLAP_FRAMES", "17")))
+    assert can_pipeline
+    assert sorted(index for index, _ in placement) == list(range(len(segments)))
+    assert {worker_id for _, worker_id in placement} == {0, 1, 2}
+    streams = sorted((tmp_path / "streams" / "pipelined").glob("segment_*.ts"))
+    assert len(streams) == len(segments)
+    assert Path(result).read_bytes() == b"".join(path.read_bytes() for path in streams)
+
+
+def test_exact_handoff_disables_pipelining():
+    """交接比例为1.0（默认，等最终重叠帧）时不走多GPU流水线"""
+    pool = server.GPUWorkerPool(["cpu"] * 2, "simulated", "inline")
+    pool.workers = [{"state": "ready", "supports_step_batching": True}] * 2
+    pool.handoff_fraction = 1.0
+    assert not pool.can_pipeline()
+    pool.handoff_fraction = 0.8
+    assert pool.can_pipeline()
+
+
+def test_pipelined_task_occupies_every_participating_gpu(monkeypatch):
+    """流水线任务占用其他GPU的执行槽位并预留显存，放不下的GPU不参与，结束后全部释放"""
+    scheduler = server.GPUJobScheduler(3, max_concurrent_per_gpu=1, admit=lambda payload, gpu_id, alongside: gpu_id != 2)
+    planner = server.MemoryPlanner()
+    request = server.UnlimitedVideoRequest(prompt="pipeline occupancy", duration=8, resolution="480p")
+    add_task("spread", request)
+    observed = {}
+
+    async def run_pipelined(gpu_id, task_id, job, on_progress, gpu_ids=None):
+        observed["gpu_ids"] = gpu_ids
+        observed["per_gpu"] = scheduler.stats()["per_gpu"]
+        observed["reserved"] = sorted(planner.reservations)
+        # GPU 1已被本任务占满，其他任务借不到
+        observed["other"] = scheduler.occupy("other", request, [1])
+        raise RuntimeError("stop after placement")
+
+    monkeypatch.setattr(server, "job_scheduler", scheduler)
+    monkeypatch.setattr(server, "memory_planner", planner)
+    monkeypatch.setattr(server.worker_pool, "can_pipeline", lambda: True)
+    monkeypatch.setattr(server.worker_pool, "run_pipelined", run_pipelined)
+    scheduler.running["spread"] = 0
+    asyncio.run(server.process_unlimited_video_generation([("spread", request)], gpu_id=0))
+
+    assert observed["gpu_ids"] == [0, 1]
+    assert observed["per_gpu"] == {0: 1, 1: 1, 2: 0}
+    assert observed["reserved"] == ["spread", "spread@1"]
+    assert observed["other"] == []
+    scheduler.running.pop("spread")
+    assert scheduler.borrowed == {} and planner.reservations == {}
+    assert server.task_store.get("spread").status == "failed"
+    server.task_store.delete("spread")
+
+
+class ToyWanVAE(torch.nn.Module):
+    """内部接口与WanVAE_一致的小型因果VAE：解码器的每层因果卷积都在_feat_map中保留前2帧，逐latent帧解码"""
+
+    def __init__(self, channels=4):
+        super().__init__()
+        torch.manual_seed(0)
+        self.conv2 = torch.nn.Conv3d(channels, channels, 1)
+        # 空间感受野2个latent像素，落在tile边缘权重为0的区域内
+        self.layers = torch.nn.ModuleList([
+            torch.nn.Conv3d(channels, 8, (3, 3, 3), padding=(0, 1, 1)),
+            torch.nn.Conv3d(8, 8, (3, 3, 3), padding=(0, 1, 1)),
+            torch.nn.Conv3d(8, 8, (3, 1, 1)),
+            torch.nn.Conv3d(8, 3, (3, 1, 1)),
+        ])
+        self.clear_cache()
+
+    def clear_cache(self):
+        self._feat_map = [None] * len(self.layers)
+        self._conv_idx = [0]
+
+    def decoder(self, x, feat_cache, feat_idx):
+        first = feat_cache[0] is None
+        for layer in self.layers:
+            index = feat_idx[0]
+            cache = feat_cache[index]
+            if cache is None:
+                cache = x.new_zeros(*x.shape[:2], 2, *x.shape[3:])
+            x = torch.cat([cache, x], dim=2)
+            feat_cache[index] = x[:, :, -2:].clone()
+            x = torch.tanh(layer(x))
+            feat_idx[0] += 1
+        # 因果时间上采样：首个latent帧对应1帧，之后每帧对应4帧
+        x = x.repeat_interleave(4, dim=2)[:, :, -1:] if first else x.repeat_interleave(4, dim=2)
+        return x.repeat_interleave(8, dim=3).repeat_interleave(8, dim=4)
+
+    def decode(self, z, scale):
+        self.clear_cache()
+        z = z / scale[1].view(1, -1, 1, 1, 1) + scale[0].view(1, -1, 1, 1, 1)
+        x = self.conv2(z)
+        outputs = []
+        for i in range(z.shape[2]):
+            self._conv_idx = [0]
+            outputs.append(self.decoder(x[:, :, i:i + 1], feat_cache=self._feat_map, feat_idx=self._conv_idx))
+        self.clear_cache()
+        return torch.cat(outputs, dim=2)
+
+
+def toy_wan_vae():
+    model = ToyWanVAE()
+    scale = [torch.linspace(-0.1, 0.1, 4), torch.linspace(0.8, 1.2, 4)]
+    full_decode = lambda latents: model.decode(latents, scale).float().clamp_(-1, 1)
+    return SimpleNamespace(vae=model, scale=scale), full_decode
+
+
+@torch.no_grad()
+def test_tiled_decode_with_causal_cache_matches_full_decode():
+    vae, full_decode = toy_wan_vae()
+    latents = torch.randn(1, 4, 9, 40, 48, generator=torch.Generator().manual_seed(1))
+    expected = full_decode(latents)
+    decoder = server.TiledVAEDecoder(full_decode, 1.0, stream=server.wan_decode_stream(vae))
+    # 预算只够 32×32 的tile和少量帧：空间和时间都要分块
+    budget = decoder.cost(1, 2, 32, 32)
+    assert decoder.plan_tiles(tuple(latents.shape), budget)[0] < latents.shape[2]
+    tiled = decoder(latents, budget)
+    assert tiled.shape == expected.shape == (1, 3, 33, 320, 384)
+    assert torch.allclose(tiled, expected, atol=1e-5)
+    # 没有逐帧接口时退回为每个时间块补上下文的近似解码，块边界之后与完整解码不一致
+    approximate = server.TiledVAEDecoder(full_decode, 1.0, overlap_frames=1)(latents, budget)
+    assert approximate.shape == expected.shape
+    assert not torch.allclose(approximate, expected, atol=1e-5)
+
+
+def test_wan_decode_stream_requires_wan_internals():
+    assert server.wan_decode_stream(SimpleNamespace(decode=lambda latents: latents)) is None
+
+
+def main():
+    sys.exit(pytest.main(["-q", __file__]))
+
+
+if __name__ == "__main__":
+    main()